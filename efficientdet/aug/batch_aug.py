@@ -0,0 +1,200 @@
+# Copyright 2020 Google Research. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Batch level augmentation of normalized images and their anchor targets.
+
+Every op draws its random parameters per example and applies them to the
+whole [batch, height, width, 3] batch with masked vectorized ops, instead of
+building a graph of conditionals for each example.
+"""
+import tensorflow as tf
+
+# Normalization of InputProcessor.normalize_image.
+MEAN_RGB = [0.485, 0.456, 0.406]
+STDDEV_RGB = [0.229, 0.224, 0.225]
+
+
+def _random_mask(batch_size, prob):
+  """Returns a [batch_size] bool tensor, each True with probability prob."""
+  return tf.random.uniform([batch_size]) < prob
+
+
+def _select(mask, x, y):
+  """Selects x where the per example mask is True, else y."""
+  mask = tf.reshape(mask, [-1] + [1] * (x.shape.rank - 1))
+  return tf.where(mask, x, y)
+
+
+def random_horizontal_flip(images,
+                           cls_targets,
+                           box_targets,
+                           boxes,
+                           image_scales,
+                           prob=0.5):
+  """Flips examples of a batch and their targets horizontally.
+
+  The anchor grid of each level is symmetric, so the anchor targets of a
+  flipped image are the targets of the mirrored anchors, with negated x
+  offsets.
+
+  The whole padded image is mirrored, not only its valid region: the right
+  padding of a letterboxed example moves to its left, unlike the images seen
+  at inference, and the groundtruth boxes are mirrored about the padded width,
+  so they may lie beyond the width of the original image. This keeps the
+  targets exact, since the anchor grid is only symmetric about the center of
+  the padded image, and the boxes consistent with the flipped pixels.
+
+  Args:
+    images: a tensor of normalized images with shape [batch, height, width, 3].
+    cls_targets: a dict of level to class targets with shape [batch, height_l,
+      width_l, num_anchors].
+    box_targets: a dict of level to box targets with shape [batch, height_l,
+      width_l, num_anchors * 4], encoded as [ty, tx, th, tw].
+    boxes: groundtruth boxes with shape [batch, N, 4] in original image
+      coordinates, padded with -1.
+    image_scales: a tensor with shape [batch] of the scales from images to
+      original images.
+    prob: probability of flipping each example.
+
+  Returns:
+    The flipped (images, cls_targets, box_targets, boxes).
+  """
+  flip = _random_mask(tf.shape(images)[0], prob)
+  images = _select(flip, tf.reverse(images, [2]), images)
+  flipped_cls_targets, flipped_box_targets = {}, {}
+  for level in cls_targets:
+    flipped_cls_targets[level] = _select(
+        flip, tf.reverse(cls_targets[level], [2]), cls_targets[level])
+    box_target = tf.reverse(box_targets[level], [2])
+    shape = tf.shape(box_target)
+    box_target = tf.reshape(box_target, tf.concat([shape[:3], [-1, 4]], 0))
+    box_target *= tf.constant([1, -1, 1, 1], box_target.dtype)
+    flipped_box_targets[level] = _select(
+        flip, tf.reshape(box_target, shape), box_targets[level])
+
+  width = tf.cast(tf.shape(images)[2], boxes.dtype) * tf.cast(
+      tf.expand_dims(image_scales, -1), boxes.dtype)
+  ymin, xmin, ymax, xmax = tf.unstack(boxes, axis=-1)
+  flipped_boxes = tf.stack([ymin, width - xmax, ymax, width - xmin], -1)
+  is_padding = tf.reduce_all(tf.equal(boxes, -1), -1, keepdims=True)
+  flipped_boxes = tf.where(is_padding, boxes, flipped_boxes)
+  boxes = _select(flip, flipped_boxes, boxes)
+  return images, flipped_cls_targets, flipped_box_targets, boxes
+
+
+def random_color(images, prob=0.5, brightness=0.2, contrast=0.3,
+                 saturation=0.3):
+  """Randomly changes brightness, contrast and saturation of examples.
+
+  Args:
+    images: a tensor of normalized images with shape [batch, height, width, 3].
+      Pixels that are zero in all channels are padding and stay zero.
+    prob: probability of changing the color of each example.
+    brightness: max delta of the brightness in [0, 1] pixel values.
+    contrast: max relative change of the contrast.
+    saturation: max relative change of the saturation.
+
+  Returns:
+    The augmented images.
+  """
+  inputs = images
+  images = tf.cast(images, tf.float32)
+  batch_size = tf.shape(images)[0]
+  apply = tf.reshape(_random_mask(batch_size, prob), [-1, 1, 1, 1])
+  is_valid = tf.logical_not(
+      tf.reduce_all(tf.equal(images, 0), -1, keepdims=True))
+  images = images * STDDEV_RGB + MEAN_RGB
+
+  def _factor(max_delta, center):
+    return tf.random.uniform([batch_size, 1, 1, 1], center - max_delta,
+                             center + max_delta)
+
+  images += _factor(brightness, 0.)
+  valid = tf.cast(is_valid, tf.float32)
+  mean = tf.reduce_sum(images * valid, [1, 2, 3], keepdims=True) / tf.maximum(
+      3 * tf.reduce_sum(valid, [1, 2, 3], keepdims=True), 1)
+  images = (images - mean) * _factor(contrast, 1.) + mean
+  gray = tf.reduce_sum(images * [0.299, 0.587, 0.114], -1, keepdims=True)
+  images = (images - gray) * _factor(saturation, 1.) + gray
+  images = (tf.clip_by_value(images, 0., 1.) - MEAN_RGB) / STDDEV_RGB
+  images = tf.cast(tf.where(is_valid, images, 0.), inputs.dtype)
+  return tf.where(apply, images, inputs)
+
+
+def gridmask(images, prob=0.5, ratio=0.6):
+  """Masks a grid of squares with random unit size and offsets per example.
+
+  Like aug.gridmask without the rotation: each example gets a grid with a
+  unit size drawn from the same range, and a (1 - ratio) * unit square of
+  each unit is set to zero, the mean color of normalized images.
+
+  Args:
+    images: a tensor of normalized images with shape [batch, height, width, 3].
+    prob: probability of masking each example.
+    ratio: kept fraction of each side of a grid unit.
+
+  Returns:
+    The masked images.
+  """
+  shape = tf.shape(images)
+  batch_size = shape[0]
+  height = tf.cast(shape[1], tf.float32)
+  width = tf.cast(shape[2], tf.float32)
+  unit = tf.random.uniform([batch_size, 1, 1],
+                           tf.minimum(height * 0.5, width * 0.3),
+                           tf.maximum(height * 0.5, width * 0.3) + 1)
+  offset_y = tf.random.uniform([batch_size, 1, 1]) * unit
+  offset_x = tf.random.uniform([batch_size, 1, 1]) * unit
+  mask_size = unit * (1 - ratio)
+  ys = tf.reshape(tf.range(height), [1, -1, 1])
+  xs = tf.reshape(tf.range(width), [1, 1, -1])
+  masked = tf.logical_and(
+      tf.math.floormod(ys + offset_y, unit) < mask_size,
+      tf.math.floormod(xs + offset_x, unit) < mask_size)
+  masked = tf.logical_and(
+      masked, tf.reshape(_random_mask(batch_size, prob), [-1, 1, 1]))
+  return images * tf.cast(tf.logical_not(masked), images.dtype)[..., None]
+
+
+def augment(images,
+            cls_targets,
+            box_targets,
+            boxes,
+            image_scales,
+            hflip_prob=0.,
+            color_prob=0.,
+            gridmask_prob=0.):
+  """Applies the batch level augmentations with the given probabilities.
+
+  Args:
+    images: a tensor of normalized images with shape [batch, height, width, 3].
+    cls_targets: a dict of level to class targets.
+    box_targets: a dict of level to box targets.
+    boxes: groundtruth boxes with shape [batch, N, 4], padded with -1.
+    image_scales: a tensor with shape [batch] of the scales to original images.
+    hflip_prob: probability of flipping each example.
+    color_prob: probability of changing the color of each example.
+    gridmask_prob: probability of grid masking each example.
+
+  Returns:
+    The augmented (images, cls_targets, box_targets, boxes).
+  """
+  if hflip_prob:
+    images, cls_targets, box_targets, boxes = random_horizontal_flip(
+        images, cls_targets, box_targets, boxes, image_scales, hflip_prob)
+  if color_prob:
+    images = random_color(images, color_prob)
+  if gridmask_prob:
+    images = gridmask(images, gridmask_prob)
+  return images, cls_targets, box_targets, boxes
@@ -0,0 +1,114 @@
+# Copyright 2020 Google Research. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Batch augmentation tests."""
+from absl import logging
+import tensorflow as tf
+
+from aug import batch_aug
+from keras import anchors
+
+
+class BatchAugTest(tf.test.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    tf.random.set_seed(111111)
+
+  def _label(self, labeler, boxes):
+    cls_targets, box_targets, _ = labeler.label_anchors(
+        boxes, tf.ones([boxes.shape[0], 1]))
+    return ({k: v[None] for k, v in cls_targets.items()},
+            {k: v[None] for k, v in box_targets.items()})
+
+  def test_horizontal_flip(self):
+    """Flipped targets are the targets of the mirrored boxes."""
+    labeler = anchors.AnchorLabeler(
+        anchors.Anchors(3, 5, 3, [1.0, 2.0, 0.5], 4.0, 128), 5)
+    boxes = tf.constant([[10., 20., 60., 50.], [40., 70., 120., 127.]])
+    mirrored = tf.constant([[10., 78., 60., 108.], [40., 1., 120., 58.]])
+    cls_targets, box_targets = self._label(labeler, boxes)
+    expected_cls, expected_box = self._label(labeler, mirrored)
+    images = tf.random.uniform([1, 128, 128, 3])
+    # Groundtruth in original coordinates, twice the image size.
+    gt_boxes = tf.concat([boxes * 2, -tf.ones([1, 4])], 0)[None]
+    flipped = batch_aug.random_horizontal_flip(images, cls_targets,
+                                               box_targets, gt_boxes,
+                                               tf.constant([2.]), prob=1.)
+    self.assertAllEqual(flipped[0], images[:, :, ::-1])
+    for level in cls_targets:
+      self.assertAllEqual(flipped[1][level], expected_cls[level])
+      self.assertAllClose(flipped[2][level], expected_box[level], atol=1e-5)
+    self.assertAllClose(flipped[3][0],
+                        tf.concat([mirrored * 2, -tf.ones([1, 4])], 0))
+
+    unchanged = batch_aug.random_horizontal_flip(images, cls_targets,
+                                                 box_targets, gt_boxes,
+                                                 tf.constant([2.]), prob=0.)
+    self.assertAllEqual(unchanged[0], images)
+    self.assertAllEqual(unchanged[3], gt_boxes)
+
+  def test_horizontal_flip_moves_padding(self):
+    """Mirrors the padded image, so the right padding moves to the left."""
+    # A 128x64 image padded on the right to 128x128, at the original scale.
+    images = tf.pad(
+        tf.random.uniform([1, 128, 64, 3], 0.1, 1.),
+        [[0, 0], [0, 0], [0, 64], [0, 0]])
+    cls_targets = {3: tf.zeros([1, 16, 16, 9], tf.int32)}
+    box_targets = {3: tf.zeros([1, 16, 16, 36])}
+    gt_boxes = tf.constant([[[10., 20., 60., 50.]]])
+    flipped, _, _, flipped_boxes = batch_aug.random_horizontal_flip(
+        images, cls_targets, box_targets, gt_boxes, tf.constant([1.]), prob=1.)
+    self.assertAllEqual(flipped[:, :, :64], tf.zeros([1, 128, 64, 3]))
+    self.assertAllEqual(flipped[:, :, 64:], images[:, :, 63::-1])
+    # Boxes are mirrored about the padded width, beyond the original width.
+    self.assertAllClose(flipped_boxes, [[[10., 78., 60., 108.]]])
+
+  def test_random_color(self):
+    """Keeps padding and unselected examples, and the dtype."""
+    images = tf.random.normal([4, 32, 32, 3])
+    images = tf.pad(images[:, :24], [[0, 0], [0, 8], [0, 0], [0, 0]])
+    self.assertAllEqual(batch_aug.random_color(images, prob=0.), images)
+    colored = batch_aug.random_color(images, prob=1.)
+    self.assertNotAllClose(colored[:, :24], images[:, :24])
+    self.assertAllEqual(colored[:, 24:], images[:, 24:])
+    half = batch_aug.random_color(tf.cast(images, tf.float16), prob=1.)
+    self.assertEqual(half.dtype, tf.float16)
+
+  def test_gridmask(self):
+    """Masks a grid of squares of each selected example."""
+    images = tf.ones([4, 64, 96, 3])
+    self.assertAllEqual(batch_aug.gridmask(images, prob=0.), images)
+    masked = batch_aug.gridmask(images, prob=1.)
+    self.assertEqual(masked.shape, images.shape)
+    masked_ratio = 1 - tf.reduce_mean(masked, [1, 2, 3])
+    self.assertAllGreater(masked_ratio, 0.)
+    self.assertAllLess(masked_ratio, 0.5)
+
+  def test_augment(self):
+    """Runs all augmentations in a tf.function."""
+    cls_targets = {3: tf.zeros([2, 8, 8, 9], tf.int32)}
+    box_targets = {3: tf.zeros([2, 8, 8, 36])}
+    augment = tf.function(batch_aug.augment)
+    images, _, _, boxes = augment(
+        tf.random.normal([2, 64, 64, 3]), cls_targets, box_targets,
+        -tf.ones([2, 5, 4]), tf.ones([2]), hflip_prob=0.5, color_prob=0.5,
+        gridmask_prob=0.5)
+    self.assertEqual(images.shape, (2, 64, 64, 3))
+    self.assertAllEqual(boxes, -tf.ones([2, 5, 4]))
+
+
+if __name__ == '__main__':
+  logging.set_verbosity(logging.WARNING)
+  tf.test.main()
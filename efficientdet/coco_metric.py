@@ -17,12 +17,15 @@
 Implements the interface of COCO API and metric_fn in tf.TPUEstimator.
 COCO API: github.com/cocodataset/cocoapi/
 """
+import collections
+import concurrent.futures
 import json
 import os
 from absl import logging
 import numpy as np
 from pycocotools.coco import COCO
 from pycocotools.cocoeval import COCOeval
+from pycocotools.cocoeval import Params
 import tensorflow as tf
 
 from keras import label_util
@@ -34,7 +37,8 @@ class EvaluationMetric():
   This class cannot inherit from tf.keras.metrics.Metric due to numpy.
   """
 
-  def __init__(self, filename=None, testdev_dir=None, label_map=None):
+  def __init__(self, filename=None, testdev_dir=None, label_map=None,
+               backend='pycocotools', num_workers=None):
     """Constructs COCO evaluation class.
 
     The class provides the interface to metrics_fn in TPUEstimator. The
@@ -49,7 +53,15 @@ class EvaluationMetric():
       testdev_dir: folder name for testdev data. If None, run eval without
         groundtruth, and filename will be ignored.
       label_map: a dict from id to class name. Used for per-class AP.
+      backend: 'pycocotools' to evaluate with COCOeval, or 'numpy' to use the
+        vectorized evaluate_detections() which matches COCOeval results.
+      num_workers: the number of threads to evaluate categories in parallel
+        with the numpy backend. Use the executor default if None.
     """
+    if backend not in ('pycocotools', 'numpy'):
+      raise ValueError('Unknown eval backend: {}'.format(backend))
+    self.backend = backend
+    self.num_workers = num_workers
     self.label_map = label_map
     self.filename = filename
     self.testdev_dir = testdev_dir
@@ -77,6 +89,9 @@ class EvaluationMetric():
       coco_metric: float numpy array with shape [12] representing the
         coco-style evaluation metrics.
     """
+    if self.backend == 'numpy' and not self.testdev_dir:
+      return self._evaluate_numpy()
+
     if self.filename:
       coco_gt = COCO(self.filename)
     else:
@@ -86,22 +101,7 @@ class EvaluationMetric():
 
     if self.testdev_dir:
       # Run on test-dev dataset.
-      box_result_list = []
-      for det in self.detections:
-        box_result_list.append({
-            'image_id': int(det[0]),
-            'category_id': int(det[6]),
-            'bbox': np.around(
-                det[1:5].astype(np.float64), decimals=2).tolist(),
-            'score': float(np.around(det[5], decimals=3)),
-        })
-      json.encoder.FLOAT_REPR = lambda o: format(o, '.3f')
-      # Must be in the formst of 'detections_test-dev2017_xxx_results'.
-      fname = 'detections_test-dev2017_test_results'
-      output_path = os.path.join(self.testdev_dir, fname + '.json')
-      logging.info('Writing output json file to: %s', output_path)
-      with tf.io.gfile.GFile(output_path, 'w') as fid:
-        json.dump(box_result_list, fid)
+      self.write_testdev(self.detections)
       return np.array([-1.], dtype=np.float32)
     else:
       # Run on validation dataset.
@@ -115,24 +115,64 @@ class EvaluationMetric():
       coco_eval.summarize()
       coco_metrics = coco_eval.stats
 
-      if self.label_map:
-        # Get per_class AP, see pycocotools/cocoeval.py:334
-        # TxRxKxAxM: iouThrs x recThrs x catIds x areaRng x maxDets
-        # Use areaRng_id=0 ('all') and maxDets_id=-1 (200) in default
-        precision = coco_eval.eval['precision'][:, :, :, 0, -1]
-        # Ideally, label_map should match the eval set, but it is possible that
-        # some classes has no data in the eval set.
-        ap_perclass = [0] * max(precision.shape[-1], len(self.label_map))
-        for c in range(precision.shape[-1]):  # iterate over all classes
-          precision_c = precision[:, :, c]
-          # Only consider values if > -1.
-          precision_c = precision_c[precision_c > -1]
-          ap_c = np.mean(precision_c) if precision_c.size else -1.
-          ap_perclass[c] = ap_c
-        coco_metrics = np.concatenate((coco_metrics, ap_perclass))
-
       # Return the concat normal and per-class AP.
-      return np.array(coco_metrics, dtype=np.float32)
+      return self.concat_per_class_ap(coco_metrics,
+                                      coco_eval.eval['precision'])
+
+  def _evaluate_numpy(self):
+    """Evaluates with detections from all images with evaluate_detections."""
+    if self.filename:
+      coco_gt = COCO(self.filename)
+      annotations = coco_gt.dataset['annotations']
+      cat_ids = sorted(coco_gt.getCatIds())
+    else:
+      annotations = self.dataset['annotations']
+      cat_ids = sorted(c['id'] for c in self.dataset['categories'])
+    params = Params(iouType='bbox')
+    precision, recall = evaluate_detections(
+        params, cat_ids, np.array(self.detections),
+        _annotations_to_array(annotations), self.num_workers)
+    coco_metrics = summarize(params, precision, recall)
+    return self.concat_per_class_ap(coco_metrics, precision)
+
+  def write_testdev(self, detections):
+    """Writes detections to a JSON file for the test-dev server."""
+    box_result_list = []
+    for det in detections:
+      box_result_list.append({
+          'image_id': int(det[0]),
+          'category_id': int(det[6]),
+          'bbox': np.around(
+              det[1:5].astype(np.float64), decimals=2).tolist(),
+          'score': float(np.around(det[5], decimals=3)),
+      })
+    json.encoder.FLOAT_REPR = lambda o: format(o, '.3f')
+    # Must be in the formst of 'detections_test-dev2017_xxx_results'.
+    fname = 'detections_test-dev2017_test_results'
+    output_path = os.path.join(self.testdev_dir, fname + '.json')
+    logging.info('Writing output json file to: %s', output_path)
+    with tf.io.gfile.GFile(output_path, 'w') as fid:
+      json.dump(box_result_list, fid)
+
+  def concat_per_class_ap(self, coco_metrics, precision):
+    """Appends per-class AP to coco_metrics if label_map is set."""
+    if self.label_map:
+      # Get per_class AP, see pycocotools/cocoeval.py:334
+      # TxRxKxAxM: iouThrs x recThrs x catIds x areaRng x maxDets
+      # Use areaRng_id=0 ('all') and maxDets_id=-1 (200) in default
+      precision = precision[:, :, :, 0, -1]
+      # Ideally, label_map should match the eval set, but it is possible that
+      # some classes has no data in the eval set.
+      ap_perclass = [0] * max(precision.shape[-1], len(self.label_map))
+      for c in range(precision.shape[-1]):  # iterate over all classes
+        precision_c = precision[:, :, c]
+        # Only consider values if > -1.
+        precision_c = precision_c[precision_c > -1]
+        ap_c = np.mean(precision_c) if precision_c.size else -1.
+        ap_perclass[c] = ap_c
+      coco_metrics = np.concatenate((coco_metrics, ap_perclass))
+
+    return np.array(coco_metrics, dtype=np.float32)
 
   def result(self):
     """Return the metric values (and compute it if needed)."""
@@ -244,3 +284,492 @@ class EvaluationMetric():
             metrics_dict[name] = (metrics[i + len(self.metric_names)],
                                   update_op)
         return metrics_dict
+
+
+class ArrayBuffer():
+  """A preallocated numpy buffer of rows that grows geometrically."""
+
+  def __init__(self, row_shape=(), dtype=np.float32, capacity=1024):
+    self._data = np.empty((capacity,) + tuple(row_shape), dtype=dtype)
+    self._size = 0
+
+  def __len__(self):
+    return self._size
+
+  @property
+  def data(self):
+    """Returns a view of the rows appended so far."""
+    return self._data[:self._size]
+
+  def append(self, rows):
+    """Appends rows with shape [N, *row_shape]."""
+    size = self._size + len(rows)
+    if size > len(self._data):
+      data = np.empty((max(size, 2 * len(self._data)),) + self._data.shape[1:],
+                      dtype=self._data.dtype)
+      data[:self._size] = self._data[:self._size]
+      self._data = data
+    self._data[self._size:size] = rows
+    self._size = size
+
+
+def box_iou(dt_boxes, gt_boxes, gt_crowd):
+  """Computes IOU between [x, y, width, height] boxes like maskUtils.iou().
+
+  Args:
+    dt_boxes: detection boxes with shape [D, 4].
+    gt_boxes: groundtruth boxes with shape [G, 4].
+    gt_crowd: bool array with shape [G]. The union of a crowd groundtruth is
+      the detection area.
+
+  Returns:
+    A float64 array with shape [D, G].
+  """
+  dt_boxes = np.asarray(dt_boxes, dtype=np.float64)
+  gt_boxes = np.asarray(gt_boxes, dtype=np.float64)
+  iw = (np.minimum(dt_boxes[:, None, 0] + dt_boxes[:, None, 2],
+                   gt_boxes[None, :, 0] + gt_boxes[None, :, 2]) -
+        np.maximum(dt_boxes[:, None, 0], gt_boxes[None, :, 0]))
+  ih = (np.minimum(dt_boxes[:, None, 1] + dt_boxes[:, None, 3],
+                   gt_boxes[None, :, 1] + gt_boxes[None, :, 3]) -
+        np.maximum(dt_boxes[:, None, 1], gt_boxes[None, :, 1]))
+  intersection = np.where((iw > 0) & (ih > 0), iw * ih, 0.)
+  dt_areas = dt_boxes[:, 2] * dt_boxes[:, 3]
+  gt_areas = gt_boxes[:, 2] * gt_boxes[:, 3]
+  union = np.where(gt_crowd[None, :], dt_areas[:, None],
+                   dt_areas[:, None] + gt_areas[None, :] - intersection)
+  return np.divide(intersection, union, out=np.zeros_like(intersection),
+                   where=intersection > 0)
+
+
+def evaluate_image(params, gt_boxes, gt_areas, gt_crowd, dt_boxes, dt_scores):
+  """Matches detections of one image and class like COCOeval.evaluateImg().
+
+  All area ranges and iou thresholds are matched at once, so only the greedy
+  loop over detections in descending score order is left in python.
+
+  Args:
+    params: pycocotools Params for bbox evaluation.
+    gt_boxes: groundtruth boxes with shape [G, 4] in [x, y, width, height].
+    gt_areas: groundtruth areas with shape [G].
+    gt_crowd: bool array with shape [G], True for crowd groundtruth.
+    dt_boxes: detection boxes with shape [D, 4] in [x, y, width, height].
+    dt_scores: detection scores with shape [D].
+
+  Returns:
+    A tuple (order, matched, ignored, num_gts), where order is the indices of
+    the top maxDets[-1] detections in descending score order, matched and
+    ignored are bool arrays with shape [A, len(order), T], and num_gts is the
+    number of non-ignored groundtruth of each area range.
+  """
+  area_rng = np.asarray(params.areaRng, dtype=np.float64)
+  thresholds = np.minimum(params.iouThrs, 1 - 1e-10)
+  order = np.argsort(-dt_scores, kind='mergesort')[:params.maxDets[-1]]
+  dt_boxes = dt_boxes[order]
+  dt_areas = dt_boxes[:, 2] * dt_boxes[:, 3]
+  gt_ignored = (gt_crowd[None, :] | (gt_areas[None, :] < area_rng[:, 0:1]) |
+                (gt_areas[None, :] > area_rng[:, 1:2]))
+  dt_outside = ((dt_areas[None, :] < area_rng[:, 0:1]) |
+                (dt_areas[None, :] > area_rng[:, 1:2]))
+
+  num_gts, num_dets = len(gt_boxes), len(order)
+  shape = (len(area_rng), num_dets, len(thresholds))
+  matched = np.zeros(shape, dtype=bool)
+  ignored = np.zeros(shape, dtype=bool)
+  if num_gts and num_dets:
+    ious = box_iou(dt_boxes, gt_boxes, gt_crowd)
+    # [A, T, G]: groundtruth matched by a previous detection.
+    taken = np.zeros((len(area_rng), len(thresholds), num_gts), dtype=bool)
+    for d in range(num_dets):
+      candidates = (ious[d] >= thresholds[:, None]) & ~taken
+      # Like pycocotools, prefer regular groundtruth to ignored ones, and
+      # pick the last one among the best overlapping groundtruth.
+      regular = candidates & ~gt_ignored[:, None, :]
+      candidates = np.where(
+          np.any(regular, axis=-1, keepdims=True), regular, candidates)
+      found = np.any(candidates, axis=-1)
+      best = num_gts - 1 - np.argmax(
+          np.where(candidates, ious[d], -1.)[..., ::-1], axis=-1)
+      matched[:, d] = found
+      ignored[:, d] = found & np.take_along_axis(gt_ignored, best, axis=1)
+      # Crowd groundtruth can be matched by many detections.
+      a, t = np.nonzero(found)
+      taken[a, t, best[a, t]] = ~gt_crowd[best[a, t]]
+  # Unmatched detections outside of the area range are ignored.
+  ignored |= ~matched & dt_outside[:, :, None]
+  return order, matched, ignored, np.count_nonzero(~gt_ignored, axis=1)
+
+
+def _accumulate_category(params, area_ids, image_ids, ranks, scores, matched,
+                         ignored, num_gts, present):
+  """Computes precision [T, R, A, M] and recall [T, A, M] of a category."""
+  num_thresholds = len(params.iouThrs)
+  num_areas = len(params.areaRng)
+  precision = -np.ones((num_thresholds, len(params.recThrs), num_areas,
+                        len(params.maxDets)))
+  recall = -np.ones((num_thresholds, num_areas, len(params.maxDets)))
+
+  # Sort by area range, then in the order of pycocotools: score descending
+  # with ties broken by image id and the rank in the image.
+  order = np.lexsort((ranks, image_ids, -scores, area_ids))
+  area_ids, ranks = area_ids[order], ranks[order]
+  tps = matched[order] & ~ignored[order]
+  fps = ~matched[order] & ~ignored[order]
+
+  for a in range(num_areas):
+    if not present[a] or num_gts[a] == 0:
+      continue
+    start = np.searchsorted(area_ids, a, side='left')
+    end = np.searchsorted(area_ids, a, side='right')
+    for m, max_det in enumerate(params.maxDets):
+      selected = ranks[start:end] < max_det
+      tp_sum = np.cumsum(tps[start:end][selected], axis=0, dtype=float).T
+      fp_sum = np.cumsum(fps[start:end][selected], axis=0, dtype=float).T
+      num_dets = tp_sum.shape[1]
+      rc = tp_sum / num_gts[a]
+      pr = tp_sum / (fp_sum + tp_sum + np.spacing(1))
+      recall[:, a, m] = rc[:, -1] if num_dets else 0
+      # Make precision monotonically decreasing.
+      pr = np.maximum.accumulate(pr[:, ::-1], axis=1)[:, ::-1]
+      for t in range(num_thresholds):
+        inds = np.searchsorted(rc[t], params.recThrs, side='left')
+        q = np.zeros(len(params.recThrs))
+        q[inds < num_dets] = pr[t, inds[inds < num_dets]]
+        precision[t, :, a, m] = q
+  return precision, recall
+
+
+def _stack_categories(params, results):
+  """Stacks per-category (precision, recall) into COCOeval.eval layout."""
+  if not results:
+    return (-np.ones((len(params.iouThrs), len(params.recThrs), 0,
+                      len(params.areaRng), len(params.maxDets))),
+            -np.ones((len(params.iouThrs), 0, len(params.areaRng),
+                      len(params.maxDets))))
+  precision, recall = zip(*results)
+  return np.stack(precision, axis=2), np.stack(recall, axis=1)
+
+
+def accumulate(params, cat_ids, match_keys, match_scores, match_tps,
+               match_ignored, gt_counts, num_workers=None):
+  """Computes COCO precision and recall from per-image match results.
+
+  This is a vectorized equivalent of pycocotools COCOeval.accumulate(), where
+  categories are accumulated in parallel.
+
+  Args:
+    params: pycocotools Params for bbox evaluation.
+    cat_ids: a sorted list of category ids to evaluate.
+    match_keys: int array with shape [N, 4], each row representing [class,
+      area range index, image_id, rank of the detection in the image].
+    match_scores: float array with shape [N] for detection scores.
+    match_tps: bool array with shape [N, T], True if the detection is matched
+      to a groundtruth at each of the T iou thresholds.
+    match_ignored: bool array with shape [N, T], True if the detection is
+      ignored at each of the T iou thresholds.
+    gt_counts: int array with shape [M, 3], each row representing [class, area
+      range index, number of non-ignored groundtruth] of an (image, class).
+    num_workers: the number of threads. Use the executor default if None.
+
+  Returns:
+    A tuple (precision, recall) with shape [T, R, K, A, M] and [T, K, A, M].
+  """
+  num_areas = len(params.areaRng)
+  order = np.argsort(match_keys[:, 0], kind='stable')
+  match_keys, match_scores = match_keys[order], match_scores[order]
+  match_tps, match_ignored = match_tps[order], match_ignored[order]
+
+  def accumulate_category(cat_id):
+    start = np.searchsorted(match_keys[:, 0], cat_id, side='left')
+    end = np.searchsorted(match_keys[:, 0], cat_id, side='right')
+    # Categories without match results are absent, like pycocotools.
+    counts = gt_counts[gt_counts[:, 0] == cat_id]
+    num_gts = np.bincount(counts[:, 1], counts[:, 2], minlength=num_areas)
+    present = np.bincount(counts[:, 1], minlength=num_areas) > 0
+    keys = match_keys[start:end]
+    return _accumulate_category(params, keys[:, 1], keys[:, 2], keys[:, 3],
+                                match_scores[start:end],
+                                match_tps[start:end],
+                                match_ignored[start:end], num_gts, present)
+
+  with concurrent.futures.ThreadPoolExecutor(num_workers) as executor:
+    results = list(executor.map(accumulate_category, cat_ids))
+  return _stack_categories(params, results)
+
+
+def _split_by_image(rows):
+  """Groups rows by the image id in the first column."""
+  rows = rows[np.argsort(rows[:, 0], kind='stable')]
+  image_ids, starts = np.unique(rows[:, 0], return_index=True)
+  return dict(zip(image_ids, np.split(rows, starts[1:])))
+
+
+def evaluate_detections(params, cat_ids, detections, groundtruth,
+                        num_workers=None):
+  """Evaluates detections with numpy, a replacement of COCOeval.
+
+  Like EvaluationMetric, only images with detections are evaluated. Each
+  category is matched and accumulated in parallel.
+
+  Args:
+    params: pycocotools Params for bbox evaluation.
+    cat_ids: a sorted list of category ids to evaluate.
+    detections: an array with each row representing [image_id, x, y, width,
+      height, score, class].
+    groundtruth: an array with each row representing [image_id, x, y, width,
+      height, area, is_crowd, class].
+    num_workers: the number of threads. Use the executor default if None.
+
+  Returns:
+    A tuple (precision, recall) with shape [T, R, K, A, M] and [T, K, A, M].
+  """
+  num_areas = len(params.areaRng)
+  groundtruth = groundtruth[np.isin(groundtruth[:, 0], detections[:, 0])]
+  dt_classes = detections[:, 6].astype(np.int64)
+  gt_classes = groundtruth[:, 7].astype(np.int64)
+
+  def evaluate_category(cat_id):
+    dts_by_image = _split_by_image(detections[dt_classes == cat_id])
+    gts_by_image = _split_by_image(groundtruth[gt_classes == cat_id])
+    area_ids, image_ids, ranks, scores, matched, ignored = ([], [], [], [],
+                                                            [], [])
+    num_gts = np.zeros(num_areas, dtype=np.int64)
+    for image_id in sorted(set(dts_by_image) | set(gts_by_image)):
+      dts = dts_by_image.get(image_id, np.zeros((0, 7), detections.dtype))
+      gts = gts_by_image.get(image_id, np.zeros((0, 8), groundtruth.dtype))
+      order, image_matched, image_ignored, image_num_gts = evaluate_image(
+          params, gts[:, 1:5], gts[:, 5], gts[:, 6] > 0, dts[:, 1:5],
+          dts[:, 5])
+      num_dets = len(order)
+      area_ids.append(np.repeat(np.arange(num_areas), num_dets))
+      image_ids.append(np.full(num_areas * num_dets, image_id))
+      ranks.append(np.tile(np.arange(num_dets), num_areas))
+      scores.append(np.tile(dts[order, 5], num_areas))
+      matched.append(image_matched.reshape(-1, len(params.iouThrs)))
+      ignored.append(image_ignored.reshape(-1, len(params.iouThrs)))
+      num_gts += image_num_gts
+    if not area_ids:
+      return _accumulate_category(
+          params, np.zeros(0, np.int64), np.zeros(0), np.zeros(0, np.int64),
+          np.zeros(0), np.zeros((0, len(params.iouThrs)), bool),
+          np.zeros((0, len(params.iouThrs)), bool), num_gts,
+          np.zeros(num_areas, bool))
+    return _accumulate_category(
+        params, np.concatenate(area_ids), np.concatenate(image_ids),
+        np.concatenate(ranks), np.concatenate(scores),
+        np.concatenate(matched), np.concatenate(ignored), num_gts,
+        np.ones(num_areas, bool))
+
+  with concurrent.futures.ThreadPoolExecutor(num_workers) as executor:
+    results = list(executor.map(evaluate_category, cat_ids))
+  return _stack_categories(params, results)
+
+
+def _annotations_to_array(annotations):
+  """Converts COCO annotations to rows like StreamingEvaluationMetric."""
+  return np.array([[
+      ann['image_id'], *ann['bbox'], ann['area'], ann.get('iscrowd', 0),
+      ann['category_id']
+  ] for ann in annotations], dtype=np.float64).reshape(-1, 8)
+
+
+def summarize(params, precision, recall):
+  """Computes the 12 COCO metrics like pycocotools COCOeval.summarize()."""
+
+  def _summarize(ap=1, iou_thr=None, area_rng='all', max_dets=100):
+    a = params.areaRngLbl.index(area_rng)
+    m = params.maxDets.index(max_dets)
+    s = precision[..., a, m] if ap == 1 else recall[..., a, m]
+    if iou_thr is not None:
+      s = s[np.where(iou_thr == params.iouThrs)[0]]
+    s = s[s > -1]
+    return np.mean(s) if s.size else -1
+
+  max_dets = params.maxDets
+  return np.array([
+      _summarize(1),
+      _summarize(1, iou_thr=.5, max_dets=max_dets[2]),
+      _summarize(1, iou_thr=.75, max_dets=max_dets[2]),
+      _summarize(1, area_rng='small', max_dets=max_dets[2]),
+      _summarize(1, area_rng='medium', max_dets=max_dets[2]),
+      _summarize(1, area_rng='large', max_dets=max_dets[2]),
+      _summarize(0, max_dets=max_dets[0]),
+      _summarize(0, max_dets=max_dets[1]),
+      _summarize(0, max_dets=max_dets[2]),
+      _summarize(0, area_rng='small', max_dets=max_dets[2]),
+      _summarize(0, area_rng='medium', max_dets=max_dets[2]),
+      _summarize(0, area_rng='large', max_dets=max_dets[2]),
+  ])
+
+
+class StreamingEvaluationMetric(EvaluationMetric):
+  """COCO evaluation metric that matches detections as batches arrive.
+
+  Detections and groundtruth are stored in growable columnar numpy buffers
+  instead of python objects. Each image is matched against its groundtruth in
+  update_state() and only compact per-detection match results are kept, so
+  result() only needs to accumulate them.
+  """
+
+  def __init__(self, filename=None, testdev_dir=None, label_map=None,
+               backend='pycocotools', num_workers=None):
+    self.params = Params(iouType='bbox')
+    # Only used by the pycocotools backend for its per-image evaluateImg().
+    self.coco_eval = COCOeval(iouType='bbox')
+    self.coco_eval.params = self.params
+    self.coco_gt = COCO(filename) if filename and not testdev_dir else None
+    super().__init__(filename, testdev_dir, label_map, backend, num_workers)
+
+  def reset_states(self):
+    """Reset the buffers."""
+    super().reset_states()
+    num_thresholds = len(self.params.iouThrs)
+    # [image_id, x, y, width, height, score, class]
+    self.detections = ArrayBuffer([7], np.float32)
+    # [image_id, x, y, width, height, area, is_crowd, class]
+    self.groundtruth = ArrayBuffer([8], np.float64)
+    # [class, area range index, image_id, rank of the detection in the image]
+    self.match_keys = ArrayBuffer([4], np.int64)
+    self.match_scores = ArrayBuffer([], np.float32)
+    self.match_tps = ArrayBuffer([num_thresholds], bool)
+    self.match_ignored = ArrayBuffer([num_thresholds], bool)
+    # [class, area range index, number of non-ignored groundtruth]
+    self.gt_counts = ArrayBuffer([3], np.int64)
+
+  def evaluate(self):
+    """Accumulates the match results of all images.
+
+    Returns:
+      coco_metric: float numpy array with shape [12] representing the
+        coco-style evaluation metrics.
+    """
+    if self.testdev_dir:
+      self.write_testdev(self.detections.data)
+      return np.array([-1.], dtype=np.float32)
+
+    if self.coco_gt:
+      cat_ids = sorted(self.coco_gt.getCatIds())
+    else:
+      cat_ids = np.unique(self.groundtruth.data[:, 7].astype(np.int64))
+    precision, recall = accumulate(self.params, cat_ids, self.match_keys.data,
+                                   self.match_scores.data,
+                                   self.match_tps.data,
+                                   self.match_ignored.data,
+                                   self.gt_counts.data, self.num_workers)
+    coco_metrics = summarize(self.params, precision, recall)
+    return self.concat_per_class_ap(coco_metrics, precision)
+
+  def update_state(self, groundtruth_data, detections):
+    """Update detection results and match them against groundtruth data.
+
+    Args:
+      groundtruth_data: Groundtruth annotations in a tensor with each row
+        representing [y1, x1, y2, x2, is_crowd, area, class].
+      detections: Detection results in a tensor with each row representing
+        [image_id, x, y, width, height, score, class].
+    """
+    for i, det in enumerate(detections):
+      # Filter out detections with predicted class label = -1.
+      det = det[det[:, -1] > -1]
+      if det.shape[0] == 0:
+        continue
+      image_id = det[0, 0]
+      if image_id == -1:
+        image_id = self.image_id
+      det[:, 0] = image_id
+      self.detections.append(det)
+
+      if not self.testdev_dir:
+        if self.coco_gt:
+          gts = _annotations_to_array(self.coco_gt.imgToAnns[int(image_id)])
+        else:
+          gts = self._add_groundtruth(groundtruth_data[i], image_id)
+        self._match_image(int(image_id), gts, det)
+
+      self.image_id += 1
+
+  def _add_groundtruth(self, groundtruth_data, image_id):
+    """Appends groundtruth of an image and returns the appended rows."""
+    groundtruth_data = groundtruth_data[groundtruth_data[:, -1] > -1]
+    negative = np.where(groundtruth_data[:, 6] < 0)[0]
+    if negative.size:
+      groundtruth_data = groundtruth_data[:negative[0]]
+    y1, x1, y2, x2 = np.split(groundtruth_data[:, 0:4], 4, axis=1)
+    rows = np.concatenate([
+        np.full_like(x1, image_id), x1, y1, x2 - x1, y2 - y1,
+        (x2 - x1) * (y2 - y1), groundtruth_data[:, 4:5],
+        groundtruth_data[:, 6:7]
+    ], axis=1)
+    self.groundtruth.append(rows)
+    return rows
+
+  def _match_image(self, image_id, gts, det):
+    """Matches detections of an image and appends the compact results."""
+    if self.backend == 'pycocotools':
+      self._match_image_pycocotools(image_id, gts, det)
+      return
+    gt_classes = gts[:, 7].astype(np.int64)
+    det_classes = det[:, 6].astype(np.int64)
+    for cat_id in np.union1d(gt_classes, det_classes):
+      cat_gts = gts[gt_classes == cat_id]
+      cat_det = det[det_classes == cat_id]
+      order, matched, ignored, num_gts = evaluate_image(
+          self.params, cat_gts[:, 1:5], cat_gts[:, 5], cat_gts[:, 6] > 0,
+          cat_det[:, 1:5], cat_det[:, 5])
+      for a in range(len(self.params.areaRng)):
+        self._append_matches(image_id, cat_id, a, cat_det[order, 5],
+                             matched[a], ignored[a], num_gts[a])
+
+  def _append_matches(self, image_id, cat_id, area_index, scores, matched,
+                      ignored, num_gts):
+    """Appends the match results of an (image, class, area range)."""
+    num_dets = len(scores)
+    self.match_keys.append(
+        np.stack([
+            np.full(num_dets, cat_id),
+            np.full(num_dets, area_index),
+            np.full(num_dets, image_id),
+            np.arange(num_dets)
+        ], axis=1))
+    self.match_scores.append(scores)
+    self.match_tps.append(matched)
+    self.match_ignored.append(ignored)
+    self.gt_counts.append([[cat_id, area_index, num_gts]])
+
+  def _match_image_pycocotools(self, image_id, gts, det):
+    """Matches detections of an image with COCOeval.evaluateImg()."""
+    # pylint: disable=protected-access
+    gts_by_cat = collections.defaultdict(list)
+    for row in gts:
+      gts_by_cat[image_id, int(row[7])].append({
+          'id': int(self.annotation_id),
+          'bbox': [row[1], row[2], row[3], row[4]],
+          'area': row[5],
+          'iscrowd': int(row[6]),
+          'ignore': int(row[6]),
+      })
+      self.annotation_id += 1
+    dts_by_cat = collections.defaultdict(list)
+    first_id = len(self.detections) - len(det) + 1
+    for i, d in enumerate(det):
+      dts_by_cat[image_id, int(d[6])].append({
+          'id': first_id + i,
+          'bbox': [d[1], d[2], d[3], d[4]],
+          'area': d[3] * d[4],
+          'score': d[5],
+          'iscrowd': 0,
+      })
+    self.coco_eval._gts = gts_by_cat
+    self.coco_eval._dts = dts_by_cat
+
+    max_det = self.params.maxDets[-1]
+    for key in sorted(set(gts_by_cat) | set(dts_by_cat)):
+      cat_id = key[1]
+      self.coco_eval.ious = {key: self.coco_eval.computeIoU(*key)}
+      for a, area_rng in enumerate(self.params.areaRng):
+        e = self.coco_eval.evaluateImg(image_id, cat_id, area_rng, max_det)
+        self._append_matches(image_id, cat_id, a,
+                             np.asarray(e['dtScores'], np.float32),
+                             e['dtMatches'].T > 0,
+                             e['dtIgnore'].T.astype(bool),
+                             np.count_nonzero(e['gtIgnore'] == 0))
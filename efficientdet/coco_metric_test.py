@@ -14,11 +14,52 @@
 # ==============================================================================
 """Tests for coco_metric."""
 
+import json
+import os
+
 from absl import logging
+import numpy as np
 import tensorflow.compat.v1 as tf
 import coco_metric
 
 
+def _synthetic_batches(num_batches=4, batch_size=4, num_classes=5, seed=0):
+  """Generates random (groundtruth_data, detections) batches."""
+  rng = np.random.RandomState(seed)
+  batches = []
+  for b in range(num_batches):
+    # [y1, x1, y2, x2, is_crowd, area, class], padded with -1.
+    groundtruth_data = -np.ones((batch_size, 10, 7), dtype=np.float32)
+    # [image_id, x, y, width, height, score, class], padded with class -1.
+    detections = -np.ones((batch_size, 20, 7), dtype=np.float32)
+    for i in range(batch_size):
+      num_gts = rng.randint(1, 10)
+      yx = rng.uniform(0, 400, size=(num_gts, 2))
+      hw = rng.uniform(4, 150, size=(num_gts, 2))
+      groundtruth_data[i, :num_gts, 0:2] = yx
+      groundtruth_data[i, :num_gts, 2:4] = yx + hw
+      groundtruth_data[i, :num_gts, 4] = rng.uniform(size=num_gts) < 0.1
+      groundtruth_data[i, :num_gts, 6] = rng.randint(1, num_classes + 1,
+                                                     size=num_gts)
+
+      num_dets = rng.randint(1, 20)
+      matched = rng.randint(num_gts, size=num_dets)
+      jitter = rng.normal(0, 8, size=(num_dets, 4))
+      detections[i, :num_dets, 0] = b * batch_size + i + 1
+      detections[i, :num_dets, 1] = yx[matched, 1] + jitter[:, 0]
+      detections[i, :num_dets, 2] = yx[matched, 0] + jitter[:, 1]
+      detections[i, :num_dets, 3] = hw[matched, 1] + jitter[:, 2]
+      detections[i, :num_dets, 4] = hw[matched, 0] + jitter[:, 3]
+      # Rounded to have score ties across images.
+      detections[i, :num_dets, 5] = rng.uniform(size=num_dets).round(1)
+      detections[i, :num_dets, 6] = np.where(
+          rng.uniform(size=num_dets) < 0.8,
+          groundtruth_data[i, matched, 6],
+          rng.randint(1, num_classes + 1, size=num_dets))
+    batches.append((groundtruth_data, detections))
+  return batches
+
+
 class CocoMetricTest(tf.test.TestCase):
 
   def setUp(self):
@@ -48,6 +89,91 @@ class CocoMetricTest(tf.test.TestCase):
     self.assertAllClose(coco_metrics['AP_/bicycle'][0], 0.0)
 
 
+class StreamingCocoMetricTest(tf.test.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.batches = _synthetic_batches()
+    self.label_map = {i: 'class_%d' % i for i in range(1, 6)}
+
+  def _evaluate(self, evaluator):
+    for groundtruth_data, detections in self.batches:
+      evaluator.update_state(groundtruth_data.copy(), detections.copy())
+    return evaluator.result()
+
+  def test_same_as_pycocotools(self):
+    expected = self._evaluate(
+        coco_metric.EvaluationMetric(label_map=self.label_map))
+    metrics = self._evaluate(
+        coco_metric.StreamingEvaluationMetric(label_map=self.label_map))
+    self.assertEqual(metrics.shape, (17,))
+    self.assertAllClose(metrics, expected)
+
+  def _write_json(self):
+    """Writes the groundtruth of self.batches with scaled areas to a file."""
+    dataset = {'images': [], 'annotations': [], 'categories': []}
+    for b, (groundtruth_data, _) in enumerate(self.batches):
+      for i, gts in enumerate(groundtruth_data):
+        image_id = b * len(groundtruth_data) + i + 1
+        dataset['images'].append({'id': image_id})
+        for gt in gts[gts[:, -1] > -1]:
+          dataset['annotations'].append({
+              'id': len(dataset['annotations']) + 1,
+              'image_id': image_id,
+              'category_id': int(gt[6]),
+              'bbox': [float(gt[1]), float(gt[0]),
+                       float(gt[3] - gt[1]), float(gt[2] - gt[0])],
+              'area': float((gt[3] - gt[1]) * (gt[2] - gt[0]) * 0.8),
+              'iscrowd': int(gt[4]),
+          })
+    dataset['categories'] = [{'id': i} for i in range(1, 7)]
+    filename = os.path.join(self.get_temp_dir(), 'instances.json')
+    with open(filename, 'w') as f:
+      json.dump(dataset, f)
+    return filename
+
+  def test_same_as_pycocotools_with_json(self):
+    filename = self._write_json()
+    expected = self._evaluate(coco_metric.EvaluationMetric(filename=filename))
+    metrics = self._evaluate(
+        coco_metric.StreamingEvaluationMetric(filename=filename))
+    self.assertAllClose(metrics, expected)
+
+  def test_numpy_backend(self):
+    expected = self._evaluate(
+        coco_metric.EvaluationMetric(label_map=self.label_map))
+    metrics = self._evaluate(
+        coco_metric.EvaluationMetric(
+            label_map=self.label_map, backend='numpy', num_workers=2))
+    self.assertAllClose(metrics, expected)
+    metrics = self._evaluate(
+        coco_metric.StreamingEvaluationMetric(
+            label_map=self.label_map, backend='numpy'))
+    self.assertAllClose(metrics, expected)
+
+  def test_numpy_backend_with_json(self):
+    filename = self._write_json()
+    expected = self._evaluate(coco_metric.EvaluationMetric(filename=filename))
+    metrics = self._evaluate(
+        coco_metric.EvaluationMetric(filename=filename, backend='numpy'))
+    self.assertAllClose(metrics, expected)
+    metrics = self._evaluate(
+        coco_metric.StreamingEvaluationMetric(
+            filename=filename, backend='numpy'))
+    self.assertAllClose(metrics, expected)
+
+  def test_unknown_backend(self):
+    with self.assertRaises(ValueError):
+      coco_metric.EvaluationMetric(backend='cocoapi')
+
+  def test_array_buffer(self):
+    buffer = coco_metric.ArrayBuffer([2], np.int64, capacity=2)
+    buffer.append([[1, 2]])
+    buffer.append([[3, 4], [5, 6], [7, 8]])
+    self.assertLen(buffer, 4)
+    self.assertAllEqual(buffer.data, [[1, 2], [3, 4], [5, 6], [7, 8]])
+
+
 if __name__ == '__main__':
   logging.set_verbosity(logging.WARNING)
   tf.test.main()
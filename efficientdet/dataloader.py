@@ -13,6 +13,11 @@
 # limitations under the License.
 # ==============================================================================
 """Data loader and processing."""
+import hashlib
+import json
+import os
+import uuid
+
 from absl import logging
 import tensorflow as tf
 
@@ -21,6 +26,9 @@ from keras import anchors
 from object_detection import preprocessor
 from object_detection import tf_example_decoder
 
+# Bump to invalidate the eval caches when the cached format changes.
+EVAL_CACHE_VERSION = 3
+
 
 class InputProcessor:
   """Base class of Input processor."""
@@ -119,14 +127,19 @@ class InputProcessor:
     self._crop_offset_x = offset_x
     self._crop_offset_y = offset_y
 
-  def set_scale_factors_to_output_size(self):
-    """Set the parameters to resize input image to self._output_size."""
+  def set_scale_factors_to_output_size(self, scale=1.0):
+    """Set the parameters to resize input image to self._output_size.
+
+    Args:
+      scale: an extra factor of the image scale, such as for multi-scale test
+        time augmentation. Images scaled beyond the output size are cropped.
+    """
     # Compute the scale_factor using rounded scaled image size.
     height = tf.cast(tf.shape(self._image)[0], tf.float32)
     width = tf.cast(tf.shape(self._image)[1], tf.float32)
     image_scale_y = tf.cast(self._output_size[0], tf.float32) / height
     image_scale_x = tf.cast(self._output_size[1], tf.float32) / width
-    image_scale = tf.minimum(image_scale_x, image_scale_y)
+    image_scale = tf.minimum(image_scale_x, image_scale_y) * scale
     scaled_height = tf.cast(height * image_scale, tf.int32)
     scaled_width = tf.cast(width * image_scale, tf.int32)
     self._image_scale = image_scale
@@ -240,6 +253,35 @@ def pad_to_fixed_size(data, pad_value, output_shape):
   return padded_data
 
 
+def check_precomputed_anchor_targets(params, is_training):
+  """Checks that anchor targets do not depend on random augmentation.
+
+  Precomputed anchor targets are only valid if the boxes are preprocessed the
+  same way for every epoch, i.e. for eval or for training without jitter, flip
+  and other augmentations.
+
+  Args:
+    params: a dict of parameters.
+    is_training: whether the targets are used for training.
+
+  Raises:
+    ValueError: if the training preprocessing is random.
+  """
+  if not is_training:
+    return
+  if (params['input_rand_hflip'] or params['jitter_min'] != 1.0 or
+      params['jitter_max'] != 1.0 or params.get('grid_mask', None) or
+      params.get('autoaugment_policy', None)):
+    raise ValueError('precomputed_anchor_targets requires input_rand_hflip, '
+                     'grid_mask and autoaugment_policy to be unset and '
+                     'jitter_min = jitter_max = 1.0.')
+  target_size = params.get('target_size', None)
+  if target_size and (utils.parse_image_size(target_size) !=
+                      utils.parse_image_size(params['image_size'])):
+    raise ValueError('precomputed_anchor_targets requires target_size to be '
+                     'unset or equal to image_size.')
+
+
 class InputReader:
   """Input reader for dataset."""
 
@@ -256,6 +298,72 @@ class InputReader:
     self._max_instances_per_image = max_instances_per_image or 100
     self._debug = debug
 
+  def _preprocess(self, data, params):
+    """Preprocesses the decoded image and groundtruth boxes and classes."""
+    image = data['image']
+    boxes = data['groundtruth_boxes']
+    classes = data['groundtruth_classes']
+    classes = tf.reshape(tf.cast(classes, dtype=tf.float32), [-1, 1])
+
+    if self._is_training:
+      # Training time preprocessing.
+      if params['skip_crowd_during_training']:
+        indices = tf.where(tf.logical_not(data['groundtruth_is_crowd']))
+        classes = tf.gather_nd(classes, indices)
+        boxes = tf.gather_nd(boxes, indices)
+
+      if params.get('grid_mask', None):
+        from aug import gridmask  # pylint: disable=g-import-not-at-top
+        image, boxes = gridmask.gridmask(image, boxes)
+
+      if params.get('autoaugment_policy', None):
+        from aug import autoaugment  # pylint: disable=g-import-not-at-top
+        if params['autoaugment_policy'] == 'randaug':
+          image, boxes = autoaugment.distort_image_with_randaugment(
+              image, boxes, num_layers=1, magnitude=15)
+        else:
+          image, boxes = autoaugment.distort_image_with_autoaugment(
+              image, boxes, params['autoaugment_policy'])
+
+    input_processor = DetectionInputProcessor(image, params['image_size'],
+                                              boxes, classes)
+    input_processor.normalize_image()
+    if self._is_training:
+      if params['input_rand_hflip']:
+        input_processor.random_horizontal_flip()
+
+      input_processor.set_training_random_scale_factors(
+          params['jitter_min'], params['jitter_max'],
+          params.get('target_size', None))
+    else:
+      input_processor.set_scale_factors_to_output_size()
+    image = input_processor.resize_and_crop_image()
+    boxes, classes = input_processor.resize_and_crop_boxes()
+    return image, boxes, classes, input_processor
+
+  @tf.autograph.experimental.do_not_convert
+  def anchor_targets_parser(self, value, example_decoder, anchor_labeler,
+                            params):
+    """Computes the sparse anchor targets of a single serialized tf.Example.
+
+    The targets are the ones dataset_parser would assign, which is only
+    deterministic when no random augmentation is enabled.
+
+    Args:
+      value: a single serialized tf.Example string.
+      example_decoder: TF example decoder.
+      anchor_labeler: anchor box labeler.
+      params: a dict of extra parameters.
+
+    Returns:
+      The (indices, cls_targets, box_targets, num_positives) tuple of
+      AnchorLabeler.label_anchors_sparse.
+    """
+    with tf.name_scope('anchor_targets_parser'):
+      data = example_decoder.decode(value)
+      _, boxes, classes, _ = self._preprocess(data, params)
+      return anchor_labeler.label_anchors_sparse(boxes, classes)
+
   @tf.autograph.experimental.do_not_convert
   def dataset_parser(self, value, example_decoder, anchor_labeler, params):
     """Parse data to a fixed dimension input image and learning targets.
@@ -296,73 +404,203 @@ class InputReader:
     with tf.name_scope('parser'):
       data = example_decoder.decode(value)
       source_id = data['source_id']
-      image = data['image']
-      boxes = data['groundtruth_boxes']
-      classes = data['groundtruth_classes']
-      classes = tf.reshape(tf.cast(classes, dtype=tf.float32), [-1, 1])
       areas = data['groundtruth_area']
       is_crowds = data['groundtruth_is_crowd']
       image_masks = data.get('groundtruth_instance_masks', [])
+      image, boxes, classes, input_processor = self._preprocess(data, params)
+      # Assign anchors.
+      if params.get('precomputed_anchor_targets', False):
+        msg = 'ERROR: anchor targets were computed for different anchors'
+        with tf.control_dependencies([
+            tf.debugging.assert_equal(
+                data['anchor_target_num_anchors'],
+                tf.constant(anchor_labeler.num_anchors, tf.int64),
+                message=msg)
+        ]):
+          (cls_targets, box_targets,
+           num_positives) = anchor_labeler.densify_targets(
+               data['anchor_target_indices'], data['anchor_target_classes'],
+               data['anchor_target_boxes'],
+               data['anchor_target_num_positives'])
+      else:
+        (cls_targets, box_targets,
+         num_positives) = anchor_labeler.label_anchors(boxes, classes)
 
-      if self._is_training:
-        # Training time preprocessing.
-        if params['skip_crowd_during_training']:
-          indices = tf.where(tf.logical_not(data['groundtruth_is_crowd']))
-          classes = tf.gather_nd(classes, indices)
-          boxes = tf.gather_nd(boxes, indices)
-
-        if params.get('grid_mask', None):
-          from aug import gridmask  # pylint: disable=g-import-not-at-top
-          image, boxes = gridmask.gridmask(image, boxes)
-
-        if params.get('autoaugment_policy', None):
-          from aug import autoaugment  # pylint: disable=g-import-not-at-top
-          if params['autoaugment_policy'] == 'randaug':
-            image, boxes = autoaugment.distort_image_with_randaugment(
-                image, boxes, num_layers=1, magnitude=15)
-          else:
-            image, boxes = autoaugment.distort_image_with_autoaugment(
-                image, boxes, params['autoaugment_policy'])
-
-      input_processor = DetectionInputProcessor(image, params['image_size'],
-                                                boxes, classes)
-      input_processor.normalize_image()
-      if self._is_training:
-        if params['input_rand_hflip']:
-          input_processor.random_horizontal_flip()
+      image_scale = (input_processor.image_scale_to_original *
+                     data.get('decode_ratio', 1.))
+      source_id, boxes, is_crowds, areas, classes = self._pad_groundtruth(
+          source_id, boxes * image_scale, is_crowds, areas, classes)
+      if params['mixed_precision']:
+        dtype = tf.keras.mixed_precision.global_policy().compute_dtype
+        image = tf.cast(image, dtype=dtype)
+        box_targets = tf.nest.map_structure(
+            lambda box_target: tf.cast(box_target, dtype=dtype), box_targets)
+      return (image, cls_targets, box_targets, num_positives, source_id,
+              image_scale, boxes, is_crowds, areas, classes, image_masks)
 
-        input_processor.set_training_random_scale_factors(
-            params['jitter_min'], params['jitter_max'],
-            params.get('target_size', None))
-      else:
-        input_processor.set_scale_factors_to_output_size()
+  def _pad_groundtruth(self, source_id, boxes, is_crowds, areas, classes):
+    """Pads groundtruth data for evaluation."""
+    source_id = tf.where(tf.equal(source_id, tf.constant('')), '-1', source_id)
+    source_id = tf.strings.to_number(source_id)
+    is_crowds = tf.cast(is_crowds, dtype=tf.float32)
+    boxes = pad_to_fixed_size(boxes, -1, [self._max_instances_per_image, 4])
+    is_crowds = pad_to_fixed_size(is_crowds, 0,
+                                  [self._max_instances_per_image, 1])
+    areas = pad_to_fixed_size(areas, -1, [self._max_instances_per_image, 1])
+    classes = pad_to_fixed_size(classes, -1, [self._max_instances_per_image, 1])
+    return source_id, boxes, is_crowds, areas, classes
+
+  @tf.autograph.experimental.do_not_convert
+  def cache_parser(self, value, example_decoder, anchor_labeler, params):
+    """Parses a tf.Example to the compact eval example stored in the cache.
+
+    The image is resized and padded to image_size but stored as uint8 before
+    normalization, and the anchor targets are stored sparse.
+
+    Args:
+      value: a single serialized tf.Example string.
+      example_decoder: TF example decoder.
+      anchor_labeler: anchor box labeler.
+      params: a dict of extra parameters.
+
+    Returns:
+      A dict of tensors, expanded to the dataset_parser outputs by
+      cached_example_parser.
+    """
+    with tf.name_scope('cache_parser'):
+      data = example_decoder.decode(value)
+      boxes = data['groundtruth_boxes']
+      classes = tf.reshape(
+          tf.cast(data['groundtruth_classes'], dtype=tf.float32), [-1, 1])
+      # Resize in float and round, instead of truncating to uint8.
+      input_processor = DetectionInputProcessor(
+          tf.cast(data['image'], tf.float32), params['image_size'], boxes,
+          classes)
+      input_processor.set_scale_factors_to_output_size()
       image = input_processor.resize_and_crop_image()
+      image = tf.cast(tf.clip_by_value(tf.round(image), 0, 255), tf.uint8)
       boxes, classes = input_processor.resize_and_crop_boxes()
-      # Assign anchors.
-      (cls_targets, box_targets,
-       num_positives) = anchor_labeler.label_anchors(boxes, classes)
-
-      source_id = tf.where(
-          tf.equal(source_id, tf.constant('')), '-1', source_id)
-      source_id = tf.strings.to_number(source_id)
-
-      # Pad groundtruth data for evaluation.
-      image_scale = input_processor.image_scale_to_original
-      boxes *= image_scale
-      is_crowds = tf.cast(is_crowds, dtype=tf.float32)
-      boxes = pad_to_fixed_size(boxes, -1, [self._max_instances_per_image, 4])
-      is_crowds = pad_to_fixed_size(is_crowds, 0,
-                                    [self._max_instances_per_image, 1])
-      areas = pad_to_fixed_size(areas, -1, [self._max_instances_per_image, 1])
-      classes = pad_to_fixed_size(classes, -1,
-                                  [self._max_instances_per_image, 1])
+      if params.get('precomputed_anchor_targets', False):
+        targets = (data['anchor_target_indices'],
+                   data['anchor_target_classes'], data['anchor_target_boxes'],
+                   data['anchor_target_num_positives'])
+      else:
+        targets = anchor_labeler.label_anchors_sparse(boxes, classes)
+      image_scale = (input_processor.image_scale_to_original *
+                     data.get('decode_ratio', 1.))
+      source_id, boxes, is_crowds, areas, classes = self._pad_groundtruth(
+          data['source_id'], boxes * image_scale,
+          data['groundtruth_is_crowd'], data['groundtruth_area'], classes)
+      image_size = utils.parse_image_size(params['image_size'])
+      # Size of the image before padding.
+      valid_size = tf.minimum(
+          tf.stack([
+              input_processor._scaled_height,  # pylint: disable=protected-access
+              input_processor._scaled_width  # pylint: disable=protected-access
+          ]), image_size)
+      return {
+          'image': image,
+          'valid_size': valid_size,
+          'anchor_target_indices': tf.cast(targets[0], tf.int32),
+          'anchor_target_classes': tf.cast(targets[1], tf.int32),
+          'anchor_target_boxes': tf.cast(targets[2], tf.float32),
+          'anchor_target_num_positives': tf.cast(targets[3], tf.float32),
+          'source_id': source_id,
+          'image_scale': image_scale,
+          'boxes': boxes,
+          'is_crowds': is_crowds,
+          'areas': areas,
+          'classes': classes,
+      }
+
+  @tf.autograph.experimental.do_not_convert
+  def cached_example_parser(self, example, anchor_labeler, params):
+    """Expands a cached example to the outputs of dataset_parser."""
+    with tf.name_scope('cached_example_parser'):
+      input_processor = InputProcessor(example['image'], params['image_size'])
+      image = input_processor.normalize_image()
+      # Padding is zero after normalization, as in dataset_parser.
+      valid_size = example['valid_size']
+      mask = tf.logical_and(
+          tf.range(tf.shape(image)[0])[:, None] < valid_size[0],
+          tf.range(tf.shape(image)[1])[None, :] < valid_size[1])
+      image *= tf.cast(mask[:, :, None], image.dtype)
+      cls_targets, box_targets, num_positives = anchor_labeler.densify_targets(
+          example['anchor_target_indices'], example['anchor_target_classes'],
+          example['anchor_target_boxes'],
+          example['anchor_target_num_positives'])
       if params['mixed_precision']:
         dtype = tf.keras.mixed_precision.global_policy().compute_dtype
         image = tf.cast(image, dtype=dtype)
         box_targets = tf.nest.map_structure(
             lambda box_target: tf.cast(box_target, dtype=dtype), box_targets)
-      return (image, cls_targets, box_targets, num_positives, source_id,
-              image_scale, boxes, is_crowds, areas, classes, image_masks)
+      return (image, cls_targets, box_targets, num_positives,
+              example['source_id'], example['image_scale'], example['boxes'],
+              example['is_crowds'], example['areas'], example['classes'], [])
+
+  def eval_cache_path(self, params, input_context=None):
+    """Returns the cache dir of this dataset and the current params.
+
+    The dir name is a hash of the input files, the input shard and of all
+    params the cached examples depend on, so changing e.g. image_size uses a
+    new cache.
+
+    Args:
+      params: a dict of parameters, with eval_cache_dir.
+      input_context: the tf.distribute.InputContext of this input pipeline.
+    """
+    keys = ('image_size', 'min_level', 'max_level', 'num_scales',
+            'aspect_ratios', 'anchor_scale', 'num_classes',
+            'regenerate_source_id', 'precomputed_anchor_targets',
+            'sparse_anchor_matching', 'reduced_jpeg_decode')
+    fingerprint = {key: params.get(key, None) for key in keys}
+    fingerprint['image_size'] = utils.parse_image_size(params['image_size'])
+    fingerprint['files'] = sorted(tf.io.gfile.glob(self._file_pattern))
+    fingerprint['max_instances_per_image'] = self._max_instances_per_image
+    fingerprint['version'] = EVAL_CACHE_VERSION
+    if input_context:
+      fingerprint['shard'] = (input_context.num_input_pipelines,
+                              input_context.input_pipeline_id)
+    digest = hashlib.sha1(
+        json.dumps(fingerprint, sort_keys=True, default=str).encode('utf-8'))
+    return os.path.join(params['eval_cache_dir'], digest.hexdigest())
+
+  def load_eval_cache(self, dataset, cache_path):
+    """Returns the cached dataset, writing it in a full pass if needed.
+
+    The examples are saved to a new subdir of cache_path, and the name of the
+    subdir is written to a marker file once all examples are saved. Eval loops
+    that read only part of the dataset, e.g. with take(), thus never leave a
+    partial cache behind.
+
+    Args:
+      dataset: the dataset of cache_parser examples to cache.
+      cache_path: the cache dir, from eval_cache_path.
+
+    Returns:
+      The dataset loaded from the cache.
+    """
+    marker_path = os.path.join(cache_path, 'complete')
+    if not tf.io.gfile.exists(marker_path):
+      data_dir = uuid.uuid4().hex
+      logging.info('Writing eval cache to %s', cache_path)
+      tf.data.experimental.save(dataset, os.path.join(cache_path, data_dir))
+      with tf.io.gfile.GFile(marker_path, 'w') as f:
+        f.write(data_dir)
+    with tf.io.gfile.GFile(marker_path) as f:
+      data_dir = f.read().strip()
+    return tf.data.experimental.load(
+        os.path.join(cache_path, data_dir), dataset.element_spec)
+
+  def batch_augment(self, params, images, cls_targets, box_targets,
+                    num_positives, source_ids, image_scales, boxes, *args):
+    """Applies the batch level augmentations to one batch of data."""
+    from aug import batch_aug  # pylint: disable=g-import-not-at-top
+    images, cls_targets, box_targets, boxes = batch_aug.augment(
+        images, cls_targets, box_targets, boxes, image_scales,
+        **params['batch_augmentation'])
+    return (images, cls_targets, box_targets, num_positives, source_ids,
+            image_scales, boxes) + args
 
   @tf.autograph.experimental.do_not_convert
   def process_example(self, params, batch_size, images, cls_targets,
@@ -411,10 +649,27 @@ class InputReader:
                                     params['aspect_ratios'],
                                     params['anchor_scale'],
                                     params['image_size'])
-    anchor_labeler = anchors.AnchorLabeler(input_anchors, params['num_classes'])
+    anchor_labeler = anchors.AnchorLabeler(
+        input_anchors,
+        params['num_classes'],
+        sparse_matching=params.get('sparse_anchor_matching', False))
+    precomputed_anchor_targets = params.get('precomputed_anchor_targets',
+                                            False)
+    if precomputed_anchor_targets:
+      check_precomputed_anchor_targets(params, self._is_training)
+    output_size, max_scale = None, 1.0
+    if params.get('reduced_jpeg_decode', False):
+      output_size = utils.parse_image_size(
+          (self._is_training and params.get('target_size', None)) or
+          params['image_size'])
+      if self._is_training:
+        max_scale = params['jitter_max']
     example_decoder = tf_example_decoder.TfExampleDecoder(
         include_mask='segmentation' in params['heads'],
-        regenerate_source_id=params['regenerate_source_id']
+        regenerate_source_id=params['regenerate_source_id'],
+        include_anchor_targets=precomputed_anchor_targets,
+        output_size=output_size,
+        max_scale=max_scale,
     )
 
     batch_size = batch_size or params['batch_size']
@@ -447,10 +702,32 @@ class InputReader:
       map_fn = lambda value: self.dataset_parser(value, example_decoder,
                                                  anchor_labeler, params)
     # pylint: enable=g-long-lambda
+    if params.get('eval_cache_dir', None) and not self._is_training:
+      if 'segmentation' in params['heads']:
+        raise ValueError('eval_cache_dir does not support segmentation.')
+      cache_path = self.eval_cache_path(params, input_context)
+      logging.info('Eval cache: %s', cache_path)
+      if params.get('dataset_type', None) == 'sstable':
+        cache_fn = lambda key, value: self.cache_parser(
+            value, example_decoder, anchor_labeler, params)
+      else:
+        cache_fn = lambda value: self.cache_parser(value, example_decoder,
+                                                   anchor_labeler, params)
+      dataset = self.load_eval_cache(
+          dataset.map(cache_fn, num_parallel_calls=tf.data.AUTOTUNE),
+          cache_path)
+      map_fn = lambda example: self.cached_example_parser(
+          example, anchor_labeler, params)
     dataset = dataset.map(
         map_fn, num_parallel_calls=tf.data.AUTOTUNE)
     dataset = dataset.prefetch(batch_size)
     dataset = dataset.batch(batch_size, drop_remainder=params['drop_remainder'])
+    if self._is_training and params.get('batch_augmentation', None):
+      if 'segmentation' in params['heads']:
+        raise ValueError('batch_augmentation does not support segmentation.')
+      dataset = dataset.map(
+          lambda *args: self.batch_augment(params, *args),
+          num_parallel_calls=tf.data.AUTOTUNE)
     dataset = dataset.map(
         lambda *args: self.process_example(params, batch_size, *args))
     dataset = dataset.prefetch(tf.data.AUTOTUNE)
@@ -20,6 +20,7 @@ import dataloader
 import hparams_config
 import test_util
 
+from dataset import create_anchor_target_tfrecord
 from keras import anchors
 from object_detection import tf_example_decoder
 
@@ -45,6 +46,105 @@ class DataloaderTest(tf.test.TestCase):
                                    params)
     self.assertEqual(len(result), 11)
 
+  def test_precomputed_anchor_targets(self):
+    params = hparams_config.get_detection_config('efficientdet-d0').as_dict()
+    input_anchors = anchors.Anchors(params['min_level'], params['max_level'],
+                                    params['num_scales'],
+                                    params['aspect_ratios'],
+                                    params['anchor_scale'],
+                                    params['image_size'])
+    anchor_labeler = anchors.AnchorLabeler(input_anchors, params['num_classes'])
+    tfrecord_path = test_util.make_fake_tfrecord(self.get_temp_dir())
+    output_path = tfrecord_path + '.targets'
+    count = create_anchor_target_tfrecord.create_anchor_target_tfrecord(
+        tfrecord_path, output_path, params, is_training=False)
+    self.assertEqual(count, 1)
+
+    reader = dataloader.InputReader(tfrecord_path, False)
+    expected = reader.dataset_parser(
+        next(iter(tf.data.TFRecordDataset([tfrecord_path]))),
+        tf_example_decoder.TfExampleDecoder(), anchor_labeler, params)
+    result = reader.dataset_parser(
+        next(iter(tf.data.TFRecordDataset([output_path]))),
+        tf_example_decoder.TfExampleDecoder(include_anchor_targets=True),
+        anchor_labeler, dict(params, precomputed_anchor_targets=True))
+    for level in range(params['min_level'], params['max_level'] + 1):
+      self.assertAllEqual(result[1][level], expected[1][level])
+      self.assertAllClose(result[2][level], expected[2][level])
+    self.assertEqual(result[3], expected[3])
+
+    with self.assertRaises(ValueError):
+      dataloader.check_precomputed_anchor_targets(params, is_training=True)
+
+  def test_eval_cache(self):
+    params = hparams_config.get_detection_config('efficientdet-d0').as_dict()
+    params['eval_cache_dir'] = self.get_temp_dir()
+    params['image_size'] = 256
+    tfrecord_path = test_util.make_fake_tfrecord(self.get_temp_dir())
+    reader = dataloader.InputReader(tfrecord_path, False)
+    expected = next(iter(reader(dict(params, eval_cache_dir=None), None, 1)))
+    cache_path = reader.eval_cache_path(params)
+    for _ in range(2):  # Write the cache, then read it.
+      # Eval loops read a fixed number of steps.
+      images, labels = next(iter(reader(params, None, 1).take(1)))
+      self.assertAllClose(images, expected[0], atol=0.02)
+      self.assertAllClose(labels, expected[1])
+      # The marker file and a single data dir.
+      self.assertLen(tf.io.gfile.listdir(cache_path), 2)
+    self.assertNotEqual(cache_path,
+                        reader.eval_cache_path(dict(params, image_size=384)))
+
+  def test_batch_augmentation(self):
+    params = hparams_config.get_detection_config('efficientdet-d0').as_dict()
+    params.update(image_size=256, input_rand_hflip=False, jitter_min=1.0,
+                  jitter_max=1.0)
+    tfrecord_path = test_util.make_fake_tfrecord(self.get_temp_dir())
+    reader = dataloader.InputReader(tfrecord_path, True)
+    images, labels = next(iter(reader(params, None, 1)))
+    params['batch_augmentation'] = {'hflip_prob': 1.0}
+    flipped_images, flipped_labels = next(iter(reader(params, None, 1)))
+    self.assertAllEqual(flipped_images, images[:, :, ::-1])
+    for level in range(params['min_level'], params['max_level'] + 1):
+      self.assertAllEqual(flipped_labels['cls_targets_%d' % level],
+                          labels['cls_targets_%d' % level][:, :, ::-1])
+    self.assertAllEqual(flipped_labels['mean_num_positives'],
+                        labels['mean_num_positives'])
+
+  def test_reduced_jpeg_decode(self):
+    example = next(iter(tf.data.TFRecordDataset(
+        [test_util.make_fake_tfrecord(self.get_temp_dir())])))
+    for output_size, max_scale, ratio in [((128, 128), 1.0, 4),
+                                          ((128, 128), 2.0, 2),
+                                          ((256, 512), 1.5, 1)]:
+      data = tf_example_decoder.TfExampleDecoder(
+          output_size=output_size, max_scale=max_scale).decode(example)
+      self.assertEqual(data['decode_ratio'], ratio)
+      self.assertAllEqual(tf.shape(data['image']), [512 // ratio] * 2 + [3])
+      self.assertEqual(data['height'], 512)
+
+    params = hparams_config.get_detection_config('efficientdet-d0').as_dict()
+    params['image_size'] = 128
+    reader = dataloader.InputReader(
+        test_util.make_fake_tfrecord(self.get_temp_dir()), False)
+    expected = next(iter(reader(params, None, 1)))
+    result = next(iter(reader(dict(params, reduced_jpeg_decode=True), None, 1)))
+    self.assertAllClose(result, expected, atol=0.02)
+
+    # A size that the ratio does not divide is rounded up by libjpeg.
+    tfrecord_path = test_util.make_fake_tfrecord(
+        self.create_tempdir().full_path, height=601, width=1001)
+    data = tf_example_decoder.TfExampleDecoder(output_size=(128, 128)).decode(
+        next(iter(tf.data.TFRecordDataset([tfrecord_path]))))
+    self.assertAllEqual(tf.shape(data['image']), [151, 251, 3])
+    self.assertAllClose(data['decode_ratio'], 1001 / 251)
+    reader = dataloader.InputReader(tfrecord_path, False)
+    _, expected = next(iter(reader(params, None, 1)))
+    _, result = next(iter(reader(dict(params, reduced_jpeg_decode=True), None,
+                                 1)))
+    self.assertAllClose(result['groundtruth_data'],
+                        expected['groundtruth_data'])
+    self.assertAllClose(result['image_scales'], expected['image_scales'])
+
 
 if __name__ == '__main__':
   tf.test.main()
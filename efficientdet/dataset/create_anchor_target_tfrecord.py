@@ -0,0 +1,135 @@
+# Copyright 2020 Google Research. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+r"""Add precomputed sparse anchor targets to detection TFRecords.
+
+Only the matched anchors are stored: their flat indices, class targets and
+encoded box targets. Use the output with precomputed_anchor_targets=True to
+skip anchor labeling in the input pipeline. The targets depend on the model
+config, so they must be created with the same image size and anchor config as
+used for training, and training must not use random jitter, flip or
+augmentation.
+
+Example usage:
+    python dataset/create_anchor_target_tfrecord.py \
+      --file_pattern=/tmp/coco/val-*.tfrecord --output_dir=/tmp/coco_targets \
+      --model_name=efficientdet-d0 --eval
+"""
+import os
+
+from absl import app
+from absl import flags
+from absl import logging
+import tensorflow as tf
+
+import dataloader
+import hparams_config
+import utils
+from dataset import tfrecord_util
+from keras import anchors
+from object_detection import tf_example_decoder
+
+flags.DEFINE_string('file_pattern', None, 'Glob for input TFRecord files.')
+flags.DEFINE_string('output_dir', None, 'Directory of the output files, which '
+                    'keep the names of the input files.')
+flags.DEFINE_string('model_name', 'efficientdet-d0',
+                    'model name for config and image_size')
+flags.DEFINE_string(
+    'hparams', '', 'Comma separated k=v pairs of hyperparameters or a module'
+    ' containing attributes to use as hyperparameters.')
+flags.DEFINE_bool('eval', False, 'If True, create targets for eval, which '
+                  'keeps crowd boxes.')
+FLAGS = flags.FLAGS
+
+
+def add_anchor_targets(serialized_example, indices, cls_targets, box_targets,
+                       num_positives, num_anchors):
+  """Returns the serialized example with the sparse anchor targets added."""
+  example = tf.train.Example.FromString(serialized_example)
+  feature = example.features.feature
+  feature['image/anchor_targets/indices'].CopyFrom(
+      tfrecord_util.int64_list_feature(indices.tolist()))
+  feature['image/anchor_targets/classes'].CopyFrom(
+      tfrecord_util.int64_list_feature(cls_targets.tolist()))
+  feature['image/anchor_targets/boxes'].CopyFrom(
+      tfrecord_util.float_list_feature(box_targets.reshape([-1]).tolist()))
+  feature['image/anchor_targets/num_positives'].CopyFrom(
+      tfrecord_util.float_list_feature([float(num_positives)]))
+  feature['image/anchor_targets/num_anchors'].CopyFrom(
+      tfrecord_util.int64_feature(num_anchors))
+  return example.SerializeToString()
+
+
+def create_anchor_target_tfrecord(input_path, output_path, params, is_training):
+  """Writes a copy of input_path with anchor targets to output_path.
+
+  Args:
+    input_path: path of the input TFRecord file.
+    output_path: path of the output TFRecord file.
+    params: a dict of parameters.
+    is_training: whether the targets are created for training.
+
+  Returns:
+    The number of written examples.
+  """
+  dataloader.check_precomputed_anchor_targets(params, is_training)
+  input_anchors = anchors.Anchors(params['min_level'], params['max_level'],
+                                  params['num_scales'],
+                                  params['aspect_ratios'],
+                                  params['anchor_scale'],
+                                  params['image_size'])
+  anchor_labeler = anchors.AnchorLabeler(
+      input_anchors,
+      params['num_classes'],
+      sparse_matching=params.get('sparse_anchor_matching', False))
+  example_decoder = tf_example_decoder.TfExampleDecoder(
+      regenerate_source_id=params['regenerate_source_id'])
+  reader = dataloader.InputReader(input_path, is_training)
+
+  def _parse(value):
+    return (value,) + tuple(
+        reader.anchor_targets_parser(value, example_decoder, anchor_labeler,
+                                     params))
+
+  dataset = tf.data.TFRecordDataset(input_path).map(
+      _parse, num_parallel_calls=tf.data.AUTOTUNE).prefetch(tf.data.AUTOTUNE)
+  count = 0
+  with tf.io.TFRecordWriter(output_path) as writer:
+    for value, indices, cls_targets, box_targets, num_positives in dataset:
+      writer.write(
+          add_anchor_targets(value.numpy(), indices.numpy(),
+                             cls_targets.numpy(), box_targets.numpy(),
+                             num_positives.numpy(), anchor_labeler.num_anchors))
+      count += 1
+  return count
+
+
+def main(_):
+  config = hparams_config.get_detection_config(FLAGS.model_name)
+  config.override(FLAGS.hparams)
+  config.image_size = utils.parse_image_size(config.image_size)
+  params = config.as_dict()
+
+  tf.io.gfile.makedirs(FLAGS.output_dir)
+  for input_path in sorted(tf.io.gfile.glob(FLAGS.file_pattern)):
+    output_path = os.path.join(FLAGS.output_dir, os.path.basename(input_path))
+    count = create_anchor_target_tfrecord(input_path, output_path, params,
+                                          not FLAGS.eval)
+    logging.info('Wrote %d examples to %s', count, output_path)
+
+
+if __name__ == '__main__':
+  flags.mark_flag_as_required('file_pattern')
+  flags.mark_flag_as_required('output_dir')
+  app.run(main)
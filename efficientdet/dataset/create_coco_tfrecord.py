@@ -60,6 +60,10 @@ flags.DEFINE_string('caption_annotations_file', '', 'File containing image '
 flags.DEFINE_string('output_file_prefix', '/tmp/train', 'Path to output file')
 flags.DEFINE_integer('num_shards', 32, 'Number of shards for output file.')
 flags.DEFINE_integer('num_threads', None, 'Number of threads to run.')
+flags.DEFINE_boolean(
+    'shard_writers', False, 'If True, each worker process writes a subset of '
+    'the shards itself instead of sending examples to the main process. The '
+    'output is the same for any number of workers.')
 FLAGS = flags.FLAGS
 
 
@@ -202,6 +206,42 @@ def _pool_create_tf_example(args):
   return create_tf_example(*args)
 
 
+# Arguments shared by all shard writers, set once per worker process.
+_SHARD_WRITER_ARGS = {}
+
+
+def _init_shard_writer(args):
+  _SHARD_WRITER_ARGS.update(args)
+
+
+def _get_annotation(img_to_annotation, image_id):
+  if img_to_annotation:
+    return img_to_annotation[image_id]
+  else:
+    return None
+
+
+def _pool_write_shard(shard):
+  """Writes the images idx with idx % num_shards == shard to the shard file."""
+  args = _SHARD_WRITER_ARGS
+  num_shards = args['num_shards']
+  total_num_annotations_skipped = 0
+  output_path = args['output_path'] + '-%05d-of-%05d.tfrecord' % (shard,
+                                                                  num_shards)
+  with tf.io.TFRecordWriter(output_path) as writer:
+    for image in args['images'][shard::num_shards]:
+      _, tf_example, num_annotations_skipped = create_tf_example(
+          image, args['image_dir'],
+          _get_annotation(args['img_to_obj_annotation'], image['id']),
+          args['category_index'],
+          _get_annotation(args['img_to_caption_annotation'], image['id']),
+          args['include_masks'])
+      total_num_annotations_skipped += num_annotations_skipped
+      # Sort the feature map, whose order otherwise depends on the process.
+      writer.write(tf_example.SerializeToString(deterministic=True))
+  return total_num_annotations_skipped
+
+
 def _load_object_annotations(object_annotations_file):
   """Loads object annotation JSON file."""
   with tf.io.gfile.GFile(object_annotations_file, 'r') as fid:
@@ -263,7 +303,8 @@ def _create_tf_record_from_coco_annotations(image_info_file,
                                             num_shards,
                                             object_annotations_file=None,
                                             caption_annotations_file=None,
-                                            include_masks=False):
+                                            include_masks=False,
+                                            shard_writers=False):
   """Loads COCO annotation json files and converts to tf.Record format.
 
   Args:
@@ -280,13 +321,11 @@ def _create_tf_record_from_coco_annotations(image_info_file,
     caption_annotations_file: JSON file containing caption annotations.
     include_masks: Whether to include instance segmentations masks
       (PNG encoded) in the result. default: False.
+    shard_writers: If True, each worker process creates and writes whole
+      shards, which keeps the main process out of the way for large datasets.
   """
 
   logging.info('writing to output path: %s', output_path)
-  writers = [
-      tf.io.TFRecordWriter(output_path + '-%05d-of-%05d.tfrecord' %
-                           (i, num_shards)) for i in range(num_shards)
-  ]
   images = _load_images_info(image_info_file)
 
   img_to_obj_annotation = None
@@ -299,31 +338,49 @@ def _create_tf_record_from_coco_annotations(image_info_file,
     img_to_caption_annotation = (
         _load_caption_annotations(caption_annotations_file))
 
-  def _get_object_annotation(image_id):
-    if img_to_obj_annotation:
-      return img_to_obj_annotation[image_id]
-    else:
-      return None
-
-  def _get_caption_annotation(image_id):
-    if img_to_caption_annotation:
-      return img_to_caption_annotation[image_id]
-    else:
-      return None
+  if shard_writers:
+    shard_writer_args = {
+        'images': images,
+        'image_dir': image_dir,
+        'img_to_obj_annotation': img_to_obj_annotation,
+        'category_index': category_index,
+        'img_to_caption_annotation': img_to_caption_annotation,
+        'include_masks': include_masks,
+        'output_path': output_path,
+        'num_shards': num_shards,
+    }
+    num_workers = min(FLAGS.num_threads or os.cpu_count(), num_shards)
+    with multiprocessing.Pool(num_workers, _init_shard_writer,
+                              (shard_writer_args,)) as pool:
+      total_num_annotations_skipped = 0
+      for shard, num_annotations_skipped in enumerate(
+          pool.imap(_pool_write_shard, range(num_shards))):
+        logging.info('Finished shard %d of %d', shard, num_shards)
+        total_num_annotations_skipped += num_annotations_skipped
+    logging.info('Finished writing, skipped %d annotations.',
+                 total_num_annotations_skipped)
+    return
 
+  writers = [
+      tf.io.TFRecordWriter(output_path + '-%05d-of-%05d.tfrecord' %
+                           (i, num_shards)) for i in range(num_shards)
+  ]
   pool = multiprocessing.Pool(FLAGS.num_threads)
   total_num_annotations_skipped = 0
   for idx, (_, tf_example, num_annotations_skipped) in enumerate(
       pool.imap(
           _pool_create_tf_example,
-          [(image, image_dir, _get_object_annotation(image['id']),
-            category_index, _get_caption_annotation(image['id']), include_masks)
-           for image in images])):
+          ((image, image_dir,
+            _get_annotation(img_to_obj_annotation, image['id']),
+            category_index,
+            _get_annotation(img_to_caption_annotation, image['id']),
+            include_masks) for image in images))):
     if idx % 100 == 0:
       logging.info('On image %d of %d', idx, len(images))
 
     total_num_annotations_skipped += num_annotations_skipped
-    writers[idx % num_shards].write(tf_example.SerializeToString())
+    writers[idx % num_shards].write(
+        tf_example.SerializeToString(deterministic=True))
 
   pool.close()
   pool.join()
@@ -356,7 +413,8 @@ def main(_):
                                           FLAGS.num_shards,
                                           FLAGS.object_annotations_file,
                                           FLAGS.caption_annotations_file,
-                                          FLAGS.include_masks)
+                                          FLAGS.include_masks,
+                                          FLAGS.shard_writers)
 
 
 if __name__ == '__main__':
@@ -255,6 +255,42 @@ class CreateCocoTFRecordTest(tf.test.TestCase):
     self.assertTrue(os.path.exists(output_path + '-00000-of-00002.tfrecord'))
     self.assertTrue(os.path.exists(output_path + '-00001-of-00002.tfrecord'))
 
+  def test_shard_writers_output_is_deterministic(self):
+    tmp_dir = self.get_temp_dir()
+    rng = np.random.RandomState(0)
+    images, annotations = [], []
+    for i in range(7):
+      file_name = 'shard_image_%d.jpg' % i
+      image_data = rng.randint(0, 255, size=(32, 48, 3), dtype=np.uint8)
+      PIL.Image.fromarray(image_data, 'RGB').save(
+          os.path.join(tmp_dir, file_name))
+      images.append({'file_name': file_name, 'height': 32, 'width': 48,
+                     'id': i + 1})
+      annotations.append({'area': 64., 'iscrowd': False, 'image_id': i + 1,
+                          'bbox': [4, 4, 8 + i, 8], 'category_id': 1,
+                          'id': 100 + i})
+    annotation_file = os.path.join(tmp_dir, 'shard_annotation.json')
+    with open(annotation_file, 'w') as annotation_fid:
+      json.dump({'images': images, 'annotations': annotations,
+                 'categories': [{'name': 'dog', 'id': 1}]}, annotation_fid)
+
+    def create(name, num_threads, shard_writers):
+      flags.FLAGS.num_threads = num_threads
+      output_path = os.path.join(tmp_dir, name)
+      create_coco_tfrecord._create_tf_record_from_coco_annotations(
+          annotation_file, tmp_dir, output_path, num_shards=3,
+          object_annotations_file=annotation_file,
+          shard_writers=shard_writers)
+      shards = []
+      for i in range(3):
+        with open(output_path + '-%05d-of-00003.tfrecord' % i, 'rb') as f:
+          shards.append(f.read())
+      return shards
+
+    expected = create('serial', 1, False)
+    self.assertAllEqual(create('one_writer', 1, True), expected)
+    self.assertAllEqual(create('two_writers', 2, True), expected)
+
 
 if __name__ == '__main__':
   logging.set_verbosity(logging.WARNING)
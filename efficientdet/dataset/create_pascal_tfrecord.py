@@ -21,6 +21,7 @@ Example usage:
 import hashlib
 import io
 import json
+import multiprocessing
 import os
 
 from absl import app
@@ -82,6 +83,10 @@ def define_flags():
                        'difficult instances')
   flags.DEFINE_integer('num_shards', 100, 'Number of shards for output file.')
   flags.DEFINE_integer('num_images', None, 'Max number of imags to process.')
+  flags.DEFINE_integer('num_threads', None, 'Number of shard writer processes.')
+  flags.DEFINE_boolean(
+      'shard_writers', False, 'If True, each worker process writes a subset of '
+      'the shards itself. The output is the same for any number of workers.')
 
 
 def get_image_id(filename):
@@ -109,7 +114,8 @@ def dict_to_tf_example(data,
                        images_dir,
                        label_map_dict,
                        ignore_difficult_instances=False,
-                       ann_json_dict=None):
+                       ann_json_dict=None,
+                       image_id=None):
   """Convert XML derived dict to tf.Example proto.
 
   Notice that this function normalizes the bounding box coordinates provided
@@ -123,6 +129,7 @@ def dict_to_tf_example(data,
     ignore_difficult_instances: Whether to skip difficult instances in the
       dataset  (default: False).
     ann_json_dict: annotation json dictionary.
+    image_id: int image id. If None, the next global image id is used.
 
   Returns:
     example: The converted tf.Example.
@@ -141,7 +148,8 @@ def dict_to_tf_example(data,
 
   width = int(data['size']['width'])
   height = int(data['size']['height'])
-  image_id = get_image_id(data['filename'])
+  if image_id is None:
+    image_id = get_image_id(data['filename'])
   if ann_json_dict:
     image = {
         'file_name': data['filename'],
@@ -239,6 +247,99 @@ def dict_to_tf_example(data,
   return example
 
 
+def _read_example_data(annotations_dir, example):
+  """Reads and parses the xml annotation of one example."""
+  path = os.path.join(annotations_dir, example + '.xml')
+  with tf.io.gfile.GFile(path, 'r') as fid:
+    xml_str = fid.read()
+  xml = etree.fromstring(xml_str)
+  return tfrecord_util.recursive_parse_xml_to_dict(xml)['annotation']
+
+
+# Arguments shared by all shard writers, set once per worker process.
+_SHARD_WRITER_ARGS = {}
+
+
+def _init_shard_writer(args):
+  _SHARD_WRITER_ARGS.update(args)
+
+
+def _pool_write_shard(shard):
+  """Writes the examples idx with idx % num_shards == shard to the shard file.
+
+  Image ids follow the position of the example across all years, the same as
+  the serial path. Annotation ids are assigned later by the main process.
+
+  Args:
+    shard: int index of the shard to write.
+
+  Returns:
+    A tuple (images, annotations) of the json entries of this shard.
+  """
+  args = _SHARD_WRITER_ARGS
+  num_shards = args['num_shards']
+  images, annotations = [], []
+  output_path = args['output_path'] + '-%05d-of-%05d.tfrecord' % (shard,
+                                                                  num_shards)
+  with tf.io.TFRecordWriter(output_path) as writer:
+    image_id_offset = 0
+    for annotations_dir, examples_list in args['examples']:
+      for idx in range(shard, len(examples_list), num_shards):
+        data = _read_example_data(annotations_dir, examples_list[idx])
+        img_dir = os.path.join(args['data_dir'], data['folder'], 'JPEGImages')
+        ann_json_dict = {'images': [], 'annotations': []}
+        tf_example = dict_to_tf_example(
+            data,
+            img_dir,
+            args['label_map_dict'],
+            args['ignore_difficult_instances'],
+            ann_json_dict=ann_json_dict,
+            image_id=image_id_offset + idx + 1)
+        images.extend(ann_json_dict['images'])
+        annotations.extend(ann_json_dict['annotations'])
+        # Sort the feature map, whose order otherwise depends on the process.
+        writer.write(tf_example.SerializeToString(deterministic=True))
+      image_id_offset += len(examples_list)
+  return images, annotations
+
+
+def _write_shards_in_parallel(examples, label_map_dict, ann_json_dict):
+  """Writes all shards with a pool of shard writers.
+
+  Args:
+    examples: list of (annotations_dir, examples_list) tuples, one per year.
+    label_map_dict: A map from string label names to integers ids.
+    ann_json_dict: annotation json dictionary to fill with images and
+      annotations, in the same order as the serial path.
+  """
+  shard_writer_args = {
+      'examples': examples,
+      'data_dir': FLAGS.data_dir,
+      'label_map_dict': label_map_dict,
+      'ignore_difficult_instances': FLAGS.ignore_difficult_instances,
+      'output_path': FLAGS.output_path,
+      'num_shards': FLAGS.num_shards,
+  }
+  num_workers = min(FLAGS.num_threads or os.cpu_count(), FLAGS.num_shards)
+  images, annotations = [], []
+  with multiprocessing.Pool(num_workers, _init_shard_writer,
+                            (shard_writer_args,)) as pool:
+    for shard, (shard_images, shard_annotations) in enumerate(
+        pool.imap(_pool_write_shard, range(FLAGS.num_shards))):
+      logging.info('Finished shard %d of %d', shard, FLAGS.num_shards)
+      images.extend(shard_images)
+      annotations.extend(shard_annotations)
+
+  # Restore the serial order; sorting is stable so annotations of the same
+  # image keep their order.
+  images.sort(key=lambda image: image['id'])
+  annotations.sort(key=lambda ann: ann['image_id'])
+  for ann_id, ann in enumerate(annotations, GLOBAL_ANN_ID + 1):
+    ann['id'] = ann_id
+  ann_json_dict['images'].extend(images)
+  ann_json_dict['annotations'].extend(annotations)
+
+
 def main(_):
   if FLAGS.set not in SETS:
     raise ValueError('set must be in : {}'.format(SETS))
@@ -257,12 +358,6 @@ def main(_):
     tf.io.gfile.makedirs(output_dir)
   logging.info('Writing to output directory: %s', output_dir)
 
-  writers = [
-      tf.io.TFRecordWriter(FLAGS.output_path + '-%05d-of-%05d.tfrecord' %
-                           (i, FLAGS.num_shards))
-      for i in range(FLAGS.num_shards)
-  ]
-
   if FLAGS.label_map_json_path:
     with tf.io.gfile.GFile(FLAGS.label_map_json_path, 'rb') as f:
       label_map_dict = json.load(f)
@@ -275,40 +370,48 @@ def main(_):
       'annotations': [],
       'categories': []
   }
+  examples = []
   for year in years:
     example_class = list(label_map_dict.keys())[1]
     examples_path = os.path.join(data_dir, year, 'ImageSets', 'Main',
                                  example_class + '_' + FLAGS.set + '.txt')
     examples_list = tfrecord_util.read_examples_list(examples_path)
+    if FLAGS.num_images:
+      examples_list = examples_list[:FLAGS.num_images]
     annotations_dir = os.path.join(data_dir, year, FLAGS.annotations_dir)
+    examples.append((annotations_dir, examples_list))
 
     for class_name, class_id in label_map_dict.items():
       cls = {'supercategory': 'none', 'id': class_id, 'name': class_name}
       ann_json_dict['categories'].append(cls)
 
-    logging.info('Reading from PASCAL %s dataset.', year)
-    for idx, example in enumerate(examples_list):
-      if FLAGS.num_images and idx >= FLAGS.num_images:
-        break
-      if idx % 100 == 0:
-        logging.info('On image %d of %d', idx, len(examples_list))
-      path = os.path.join(annotations_dir, example + '.xml')
-      with tf.io.gfile.GFile(path, 'r') as fid:
-        xml_str = fid.read()
-      xml = etree.fromstring(xml_str)
-      data = tfrecord_util.recursive_parse_xml_to_dict(xml)['annotation']
-
-      img_dir = os.path.join(FLAGS.data_dir, data['folder'], 'JPEGImages')
-      tf_example = dict_to_tf_example(
-          data,
-          img_dir,
-          label_map_dict,
-          FLAGS.ignore_difficult_instances,
-          ann_json_dict=ann_json_dict)
-      writers[idx % FLAGS.num_shards].write(tf_example.SerializeToString())
-
-  for writer in writers:
-    writer.close()
+  if FLAGS.shard_writers:
+    _write_shards_in_parallel(examples, label_map_dict, ann_json_dict)
+  else:
+    writers = [
+        tf.io.TFRecordWriter(FLAGS.output_path + '-%05d-of-%05d.tfrecord' %
+                             (i, FLAGS.num_shards))
+        for i in range(FLAGS.num_shards)
+    ]
+    for year, (annotations_dir, examples_list) in zip(years, examples):
+      logging.info('Reading from PASCAL %s dataset.', year)
+      for idx, example in enumerate(examples_list):
+        if idx % 100 == 0:
+          logging.info('On image %d of %d', idx, len(examples_list))
+        data = _read_example_data(annotations_dir, example)
+
+        img_dir = os.path.join(FLAGS.data_dir, data['folder'], 'JPEGImages')
+        tf_example = dict_to_tf_example(
+            data,
+            img_dir,
+            label_map_dict,
+            FLAGS.ignore_difficult_instances,
+            ann_json_dict=ann_json_dict)
+        writers[idx % FLAGS.num_shards].write(
+            tf_example.SerializeToString(deterministic=True))
+
+    for writer in writers:
+      writer.close()
 
   json_file_path = os.path.join(
       os.path.dirname(FLAGS.output_path),
@@ -14,8 +14,10 @@
 # ==============================================================================
 """Test for create_pascal_tfrecord.py."""
 
+import json
 import os
 
+from absl import flags
 from absl import logging
 import numpy as np
 import PIL.Image
@@ -24,6 +26,8 @@ import tensorflow as tf
 
 from dataset import create_pascal_tfrecord
 
+create_pascal_tfrecord.define_flags()
+
 
 class CreatePascalTFRecordTest(tf.test.TestCase):
 
@@ -117,6 +121,98 @@ class CreatePascalTFRecordTest(tf.test.TestCase):
         example.features.feature['image/object/view'].bytes_list.value,
         [six.b('')])
 
+  def test_dict_to_tf_example_with_image_id(self):
+    image_file_name = '2012_13.jpg'
+    image_data = np.random.rand(64, 64, 3)
+    save_path = os.path.join(self.get_temp_dir(), image_file_name)
+    PIL.Image.fromarray(image_data, 'RGB').save(save_path)
+    data = {
+        'folder': '',
+        'filename': image_file_name,
+        'size': {
+            'height': 64,
+            'width': 64,
+        },
+        'object': [
+            {
+                'difficult': 0,
+                'bndbox': {
+                    'xmin': 16,
+                    'ymin': 16,
+                    'xmax': 48,
+                    'ymax': 48,
+                },
+                'name': 'person',
+                'truncated': 0,
+                'pose': '',
+            },
+        ],
+    }
+    ann_json_dict = {'images': [], 'annotations': []}
+    example = create_pascal_tfrecord.dict_to_tf_example(
+        data,
+        self.get_temp_dir(), {'person': 1},
+        ann_json_dict=ann_json_dict,
+        image_id=42)
+    self._assertProtoEqual(
+        example.features.feature['image/source_id'].bytes_list.value,
+        [six.b(str(42))])
+    self.assertEqual(ann_json_dict['images'][0]['id'], 42)
+    self.assertEqual(ann_json_dict['annotations'][0]['image_id'], 42)
+    self.assertEqual(ann_json_dict['annotations'][0]['bbox'], [16, 16, 32, 32])
+
+  def test_shard_writers_output_is_deterministic(self):
+    data_dir = self.get_temp_dir()
+    voc_dir = os.path.join(data_dir, 'VOC2007')
+    for sub_dir in ('Annotations', 'JPEGImages', 'ImageSets/Main'):
+      os.makedirs(os.path.join(voc_dir, sub_dir), exist_ok=True)
+    rng = np.random.RandomState(0)
+    examples = ['%06d' % i for i in range(7)]
+    for i, example in enumerate(examples):
+      image_data = rng.randint(0, 255, size=(32, 48, 3), dtype=np.uint8)
+      PIL.Image.fromarray(image_data, 'RGB').save(
+          os.path.join(voc_dir, 'JPEGImages', example + '.jpg'))
+      objects = ''.join(
+          '<object><name>person</name><pose>Left</pose><truncated>0'
+          '</truncated><difficult>0</difficult><bndbox><xmin>%d</xmin>'
+          '<ymin>4</ymin><xmax>%d</xmax><ymax>20</ymax></bndbox></object>' %
+          (j, 10 + j) for j in range(i % 3 + 1))
+      with open(os.path.join(voc_dir, 'Annotations', example + '.xml'),
+                'w') as f:
+        f.write('<annotation><folder>VOC2007</folder><filename>%s.jpg'
+                '</filename><size><width>48</width><height>32</height>'
+                '<depth>3</depth></size>%s</annotation>' % (example, objects))
+    with open(os.path.join(voc_dir, 'ImageSets/Main/aeroplane_train.txt'),
+              'w') as f:
+      f.write(''.join('%s 1\n' % example for example in examples))
+
+    def create(name, num_threads, shard_writers):
+      create_pascal_tfrecord.GLOBAL_IMG_ID = 0
+      create_pascal_tfrecord.GLOBAL_ANN_ID = 0
+      output_path = os.path.join(data_dir, 'out', name)
+      flags.FLAGS.data_dir = data_dir
+      flags.FLAGS.year = 'VOC2007'
+      flags.FLAGS.set = 'train'
+      flags.FLAGS.output_path = output_path
+      flags.FLAGS.num_shards = 3
+      flags.FLAGS.num_threads = num_threads
+      flags.FLAGS.shard_writers = shard_writers
+      create_pascal_tfrecord.main(None)
+      shards = []
+      for i in range(3):
+        with open(output_path + '-%05d-of-00003.tfrecord' % i, 'rb') as f:
+          shards.append(f.read())
+      with open(os.path.join(data_dir, 'out', 'json_%s.json' % name)) as f:
+        ann_json = json.load(f)
+      return shards, ann_json
+
+    expected_shards, expected_json = create('serial', 1, False)
+    self.assertLen(expected_json['annotations'], 13)
+    for name, num_threads in (('one_writer', 1), ('two_writers', 2)):
+      shards, ann_json = create(name, num_threads, True)
+      self.assertAllEqual(shards, expected_shards)
+      self.assertEqual(ann_json, expected_json)
+
 
 if __name__ == '__main__':
   logging.set_verbosity(logging.WARNING)
@@ -186,6 +186,49 @@ def _box_loss(box_outputs, box_targets, num_positives, delta=0.1):
   return box_loss
 
 
+def _concat_levels(tensors, bs, last_dim, data_format='channels_last'):
+  """Flattens the per-level tensors to [bs, total_anchors, last_dim]."""
+  if data_format == 'channels_first':
+    tensors = [tf.transpose(t, [0, 2, 3, 1]) for t in tensors]
+  return tf.concat([tf.reshape(t, [bs, -1, last_dim]) for t in tensors], 1)
+
+
+def _fused_detection_loss(cls_outputs, box_outputs, labels, num_positives_sum,
+                          params):
+  """Computes class and box losses over the anchors of all levels at once."""
+  levels = list(cls_outputs.keys())
+  bs = cls_outputs[levels[0]].get_shape().as_list()[0]
+  data_format = params['data_format']
+  cls_targets = _concat_levels(
+      [labels['cls_targets_%d' % level] for level in levels], bs, 1,
+      data_format)
+  cls_outputs = _concat_levels([cls_outputs[level] for level in levels], bs,
+                               params['num_classes'], data_format)
+  cls_loss = focal_loss(
+      cls_outputs,
+      tf.one_hot(
+          cls_targets[..., 0], params['num_classes'],
+          dtype=cls_outputs.dtype),
+      params['alpha'],
+      params['gamma'],
+      normalizer=num_positives_sum,
+      label_smoothing=params['label_smoothing'])
+  cls_loss *= tf.cast(tf.not_equal(cls_targets, -2), cls_loss.dtype)
+  cls_loss = tf.cast(tf.reduce_sum(cls_loss), tf.float32)
+
+  if params['box_loss_weight']:
+    box_loss = _box_loss(
+        _concat_levels([box_outputs[level] for level in levels], bs, 4,
+                       data_format),
+        _concat_levels([labels['box_targets_%d' % level] for level in levels],
+                       bs, 4, data_format),
+        num_positives_sum,
+        delta=params['delta'])
+  else:
+    box_loss = tf.constant(0.)
+  return cls_loss, box_loss
+
+
 def detection_loss(cls_outputs, box_outputs, labels, params):
   """Computes total detection loss.
 
@@ -228,6 +271,13 @@ def detection_loss(cls_outputs, box_outputs, labels, params):
     num_positives_sum = utils.cross_replica_mean(num_positives_sum)
 
   levels = cls_outputs.keys()
+  if params.get('fused_detection_loss'):
+    cls_loss, box_loss = _fused_detection_loss(cls_outputs, box_outputs,
+                                               labels, num_positives_sum,
+                                               params)
+    total_loss = cls_loss + params['box_loss_weight'] * box_loss
+    return total_loss, cls_loss, box_loss
+
   cls_losses = []
   box_losses = []
   for level in levels:
@@ -475,7 +525,8 @@ def _model_fn(features, labels, mode, params, model, variable_filter_fn=None):
       else:
         logging.info('Eval val with groudtruths %s.', params['val_json_file'])
         eval_metric = coco_metric.EvaluationMetric(
-            filename=params['val_json_file'], label_map=params['label_map'])
+            filename=params['val_json_file'], label_map=params['label_map'],
+            backend=params.get('eval_backend', 'pycocotools'))
         coco_metrics = eval_metric.estimator_metric_fn(
             detections_bs, kwargs['groundtruth_data'])
 
@@ -13,8 +13,10 @@
 # limitations under the License.
 # ==============================================================================
 """Tests for det_model_fn."""
+import collections
 import tensorflow as tf
 import det_model_fn
+import hparams_config
 
 
 def legacy_focal_loss(logits, targets, alpha, gamma, normalizer, _=0):
@@ -64,5 +66,42 @@ class FocalLossTest(tf.test.TestCase):
     self.assertAllClose(presmoothed, unsmoothed)
 
 
+class DetectionLossTest(tf.test.TestCase):
+
+  def test_fused_detection_loss(self):
+    tf.random.set_seed(1111)
+    params = hparams_config.get_detection_config('efficientdet-d0').as_dict()
+    params['num_classes'] = 10
+    cls_outputs = collections.OrderedDict()
+    box_outputs = collections.OrderedDict()
+    labels = {'mean_num_positives': tf.constant([5.0])}
+    for level in range(3, 8):
+      size = 64 // 2**level
+      cls_outputs[level] = tf.random.normal([2, size, size, 9 * 10])
+      box_outputs[level] = tf.random.normal([2, size, size, 9 * 4])
+      labels['cls_targets_%d' % level] = tf.random.uniform(
+          [2, size, size, 9], minval=-2, maxval=10, dtype=tf.int32)
+      labels['box_targets_%d' % level] = tf.random.uniform(
+          [2, size, size, 9 * 4])
+    losses = det_model_fn.detection_loss(cls_outputs, box_outputs, labels,
+                                         params)
+    params['fused_detection_loss'] = True
+    fused_losses = det_model_fn.detection_loss(cls_outputs, box_outputs,
+                                               labels, params)
+    self.assertAllClose(losses, fused_losses)
+
+    # Channels first outputs and labels give the same fused losses.
+    params['data_format'] = 'channels_first'
+    labels = {
+        k: v if k == 'mean_num_positives' else tf.transpose(v, [0, 3, 1, 2])
+        for k, v in labels.items()
+    }
+    fused_losses = det_model_fn.detection_loss(
+        {k: tf.transpose(v, [0, 3, 1, 2]) for k, v in cls_outputs.items()},
+        {k: tf.transpose(v, [0, 3, 1, 2]) for k, v in box_outputs.items()},
+        labels, params)
+    self.assertAllClose(losses, fused_losses)
+
+
 if __name__ == '__main__':
   tf.test.main()
@@ -185,8 +185,15 @@ def default_detection_configs():
   h.jitter_max = 2.0
   h.autoaugment_policy = None
   h.grid_mask = False
+  # Per example probabilities of the augmentations applied after batching, e.g.
+  # {'hflip_prob': 0.5, 'color_prob': 0.5, 'gridmask_prob': 0.3}. The flip
+  # mirrors the padded image, moving the padding of letterboxed examples from
+  # the right to the left.
+  h.batch_augmentation = None
   h.sample_image = None
   h.map_freq = 5  # AP eval frequency in epochs.
+  h.streaming_eval = False  # If True, match AP eval detections per batch.
+  h.eval_backend = 'pycocotools'  # COCO AP backend: pycocotools or numpy.
 
   # dataset specific parameters
   # TODO(tanmingxing): update this to be 91 for COCO, and 21 for pascal.
@@ -198,6 +205,16 @@ def default_detection_configs():
   h.label_map = None  # a dict or a string of 'coco', 'voc', 'waymo'.
   h.max_instances_per_image = 100  # Default to 100 for COCO.
   h.regenerate_source_id = False
+  # If True, read anchor targets created by create_anchor_target_tfrecord.py.
+  h.precomputed_anchor_targets = False
+  # If True, match anchors using only the anchors near each box. Same targets,
+  # less CPU and memory for large image sizes.
+  h.sparse_anchor_matching = False
+  # If set, cache the preprocessed eval examples in a subdir of this dir, keyed
+  # by the input files and the params they depend on, like image_size.
+  h.eval_cache_dir = None
+  # If True, decode large jpegs at a reduced resolution above image_size.
+  h.reduced_jpeg_decode = False
 
   # model architecture
   h.min_level = 3
@@ -226,6 +243,7 @@ def default_detection_configs():
   # Behold the focal loss parameters
   h.alpha = 0.25
   h.gamma = 1.5
+  h.sparse_focal_loss = False  # focal loss without onehot class targets.
 
   # localization loss
   h.delta = 0.1  # regularization parameter of huber loss.
@@ -233,6 +251,8 @@ def default_detection_configs():
   h.box_loss_weight = 50.0
   h.iou_loss_type = None
   h.iou_loss_weight = 1.0
+  # compute the losses over the flattened anchors of all levels at once.
+  h.fused_detection_loss = False
 
   # regularization l2 loss.
   h.weight_decay = 4e-5
@@ -258,6 +278,8 @@ def default_detection_configs():
       'score_thresh': 0.,
       'sigma': None,
       'pyfunc': False,
+      'pyfunc_workers': 0,  # >0: run pyfunc nms of a batch in a thread pool.
+      'class_offset': False,  # per_class tf nms: one nms call per image.
       'max_nms_inputs': 0,
       'max_output_size': 100,
   }
@@ -14,6 +14,8 @@
 # ==============================================================================
 """Anchor definition."""
 import collections
+import threading
+
 import numpy as np
 import tensorflow as tf
 
@@ -25,6 +27,12 @@ from object_detection import region_similarity_calculator
 from object_detection import target_assigner
 
 MAX_DETECTION_POINTS = 5000
+# Max number of anchor configurations kept by the anchor cache. Services that
+# host many image sizes may raise it.
+ANCHOR_CACHE_SIZE = 16
+
+_ANCHOR_CACHE = collections.OrderedDict()
+_ANCHOR_CACHE_LOCK = threading.Lock()
 
 
 def decode_box_outputs(pred_boxes, anchor_boxes):
@@ -58,6 +66,99 @@ def decode_box_outputs(pred_boxes, anchor_boxes):
   return tf.stack([ymin, xmin, ymax, xmax], axis=-1)
 
 
+def _generate_anchor_boxes(min_level, max_level, num_scales, aspect_ratios,
+                           anchor_scales, image_size):
+  """Generates multiscale anchor boxes as a float32 array with shape [N, 4].
+
+  All locations, scales and aspect ratios of a level are generated at once,
+  directly into the float32 output buffer.
+  """
+  feat_sizes = utils.get_feat_sizes(image_size, max_level)
+  levels = range(min_level, max_level + 1)
+  # [L, 2] strides in (y, x) of each level.
+  strides = np.array([[
+      feat_sizes[0]['height'] / float(feat_sizes[level]['height']),
+      feat_sizes[0]['width'] / float(feat_sizes[level]['width'])
+  ] for level in levels])
+  # [S * R, 2] aspect multipliers in (y, x), ordered by scale then ratio.
+  aspects = []
+  for aspect in aspect_ratios:
+    if isinstance(aspect, (list, tuple)):
+      aspect_x, aspect_y = aspect
+    else:
+      aspect_x = np.sqrt(aspect)
+      aspect_y = 1.0 / aspect_x
+    aspects.append((aspect_y, aspect_x))
+  octave_scales = 2**(np.arange(num_scales) / float(num_scales))
+  half_sizes = (octave_scales[:, None, None] * np.array(aspects)[None] /
+                2.0).reshape(-1, 2)
+  # [L, S * R, 2] half anchor sizes of each level.
+  half_sizes = (np.array(anchor_scales, dtype=np.float64)[:, None, None] *
+                strides[:, None, :] * half_sizes[None])
+
+  grids = [(np.arange(stride[0] / 2, image_size[0], stride[0]),
+            np.arange(stride[1] / 2, image_size[1], stride[1]))
+           for stride in strides]
+  boxes = np.empty((sum(len(y) * len(x) for y, x in grids), len(half_sizes[0]),
+                    4), dtype=np.float32)
+  start = 0
+  for (y, x), level_half_sizes in zip(grids, half_sizes):
+    end = start + len(y) * len(x)
+    # [H, W, 1, 2] anchor centers of the level.
+    centers = np.stack(np.meshgrid(y, x, indexing='ij'), axis=-1)[:, :, None]
+    boxes[start:end, :, :2] = (centers - level_half_sizes).reshape(
+        end - start, -1, 2)
+    boxes[start:end, :, 2:] = (centers + level_half_sizes).reshape(
+        end - start, -1, 2)
+    start = end
+  return boxes.reshape(-1, 4)
+
+
+def get_anchor_boxes(min_level, max_level, num_scales, aspect_ratios,
+                     anchor_scales, image_size):
+  """Returns the cached float32 anchor boxes of an anchor configuration.
+
+  The boxes are generated once per process for each configuration and shared
+  by all users. The cache keeps the ANCHOR_CACHE_SIZE most recently used
+  configurations.
+
+  Args:
+    min_level: integer number of minimum level of the output feature pyramid.
+    max_level: integer number of maximum level of the output feature pyramid.
+    num_scales: integer number of intermediate scales on each level.
+    aspect_ratios: list of aspect ratios, each either a float or a (x, y)
+      pair.
+    anchor_scales: list of anchor scales, one value per level.
+    image_size: a tuple of integer (height, width).
+
+  Returns:
+    A read-only float32 numpy array with shape [N, 4].
+  """
+  key = (min_level, max_level, num_scales,
+         tuple(tuple(a) if isinstance(a, (list, tuple)) else a
+               for a in aspect_ratios),
+         tuple(anchor_scales), tuple(image_size))
+  with _ANCHOR_CACHE_LOCK:
+    if key in _ANCHOR_CACHE:
+      _ANCHOR_CACHE.move_to_end(key)
+      return _ANCHOR_CACHE[key]
+  boxes = _generate_anchor_boxes(min_level, max_level, num_scales,
+                                 aspect_ratios, anchor_scales, image_size)
+  boxes.flags.writeable = False
+  with _ANCHOR_CACHE_LOCK:
+    boxes = _ANCHOR_CACHE.setdefault(key, boxes)
+    _ANCHOR_CACHE.move_to_end(key)
+    while len(_ANCHOR_CACHE) > ANCHOR_CACHE_SIZE:
+      _ANCHOR_CACHE.popitem(last=False)
+  return boxes
+
+
+def clear_anchor_cache():
+  """Removes all cached anchor boxes."""
+  with _ANCHOR_CACHE_LOCK:
+    _ANCHOR_CACHE.clear()
+
+
 class Anchors():
   """Multi-scale anchors class."""
 
@@ -108,39 +209,11 @@ class Anchors():
     return anchor_configs
 
   def _generate_boxes(self):
-    """Generates multiscale anchor boxes."""
-    boxes_all = []
-    for _, configs in self.config.items():
-      boxes_level = []
-      for config in configs:
-        stride, octave_scale, aspect, anchor_scale = config
-        base_anchor_size_x = anchor_scale * stride[1] * 2**octave_scale
-        base_anchor_size_y = anchor_scale * stride[0] * 2**octave_scale
-        if isinstance(aspect, list):
-          aspect_x, aspect_y = aspect
-        else:
-          aspect_x = np.sqrt(aspect)
-          aspect_y = 1.0 / aspect_x
-        anchor_size_x_2 = base_anchor_size_x * aspect_x / 2.0
-        anchor_size_y_2 = base_anchor_size_y * aspect_y / 2.0
-
-        x = np.arange(stride[1] / 2, self.image_size[1], stride[1])
-        y = np.arange(stride[0] / 2, self.image_size[0], stride[0])
-        xv, yv = np.meshgrid(x, y)
-        xv = xv.reshape(-1)
-        yv = yv.reshape(-1)
-
-        boxes = np.vstack((yv - anchor_size_y_2, xv - anchor_size_x_2,
-                           yv + anchor_size_y_2, xv + anchor_size_x_2))
-        boxes = np.swapaxes(boxes, 0, 1)
-        boxes_level.append(np.expand_dims(boxes, axis=1))
-      # concat anchors on the same level to the reshape NxAx4
-      boxes_level = np.concatenate(boxes_level, axis=1)
-      boxes_all.append(boxes_level.reshape([-1, 4]))
-
-    anchor_boxes = np.vstack(boxes_all)
-    anchor_boxes = tf.convert_to_tensor(anchor_boxes, dtype=tf.float32)
-    return anchor_boxes
+    """Generates multiscale anchor boxes from the anchor cache."""
+    anchor_boxes = get_anchor_boxes(self.min_level, self.max_level,
+                                    self.num_scales, self.aspect_ratios,
+                                    self.anchor_scales, self.image_size)
+    return tf.convert_to_tensor(anchor_boxes, dtype=tf.float32)
 
   def get_anchors_per_location(self):
     return self.num_scales * len(self.aspect_ratios)
@@ -149,7 +222,11 @@ class Anchors():
 class AnchorLabeler(object):
   """Labeler for multiscale anchor boxes."""
 
-  def __init__(self, anchors, num_classes, match_threshold=0.5):
+  def __init__(self,
+               anchors,
+               num_classes,
+               match_threshold=0.5,
+               sparse_matching=False):
     """Constructs anchor labeler to assign labels to anchors.
 
     Args:
@@ -157,9 +234,12 @@ class AnchorLabeler(object):
       num_classes: integer number representing number of classes in the dataset.
       match_threshold: float number between 0 and 1 representing the threshold
         to assign positive labels for anchors.
+      sparse_matching: if True, only compute the IoU of each groundtruth box
+        with the anchors on grid cells near it, instead of the dense IoU with
+        all anchors. The targets are the same.
     """
     similarity_calc = region_similarity_calculator.IouSimilarity()
-    matcher = argmax_matcher.ArgMaxMatcher(
+    self._matcher = argmax_matcher.ArgMaxMatcher(
         match_threshold,
         unmatched_threshold=match_threshold,
         negatives_lower_than_unmatched=True,
@@ -167,10 +247,107 @@ class AnchorLabeler(object):
     box_coder = faster_rcnn_box_coder.FasterRcnnBoxCoder()
 
     self._target_assigner = target_assigner.TargetAssigner(
-        similarity_calc, matcher, box_coder)
+        similarity_calc, self._matcher, box_coder)
     self._anchors = anchors
     self._match_threshold = match_threshold
     self._num_classes = num_classes
+    self._sparse_matching = sparse_matching
+    if sparse_matching:
+      self._anchor_grids = self._generate_anchor_grids()
+
+  def _generate_anchor_grids(self):
+    """Returns per level grid parameters used to bin anchors.
+
+    Anchors of a level are laid out as [height, width, anchors_per_location]
+    cells with centers at center + index * stride. Each value is a numpy array
+    with one entry per level.
+    """
+    anchors = self._anchors
+    boxes = get_anchor_boxes(anchors.min_level, anchors.max_level,
+                             anchors.num_scales, anchors.aspect_ratios,
+                             anchors.anchor_scales, anchors.image_size)
+    num_per_location = anchors.get_anchors_per_location()
+    grids = collections.defaultdict(list)
+    offset = 0
+    for level in range(anchors.min_level, anchors.max_level + 1):
+      height = anchors.feat_sizes[level]['height']
+      width = anchors.feat_sizes[level]['width']
+      stride_y = anchors.feat_sizes[0]['height'] / float(height)
+      stride_x = anchors.feat_sizes[0]['width'] / float(width)
+      level_boxes = boxes[offset:offset + height * width * num_per_location]
+      grids['offset'].append(offset)
+      grids['height'].append(height)
+      grids['width'].append(width)
+      grids['stride_y'].append(stride_y)
+      grids['stride_x'].append(stride_x)
+      # Largest half size of the anchors, which bounds the cells whose anchors
+      # can overlap a box.
+      grids['half_y'].append(
+          np.max(level_boxes[:, 2] - level_boxes[:, 0]) / 2.0)
+      grids['half_x'].append(
+          np.max(level_boxes[:, 3] - level_boxes[:, 1]) / 2.0)
+      offset += len(level_boxes)
+    return {
+        k: np.array(v, np.int32 if k in ('offset', 'height', 'width') else
+                    np.float32) for k, v in grids.items()
+    }
+
+  def _candidate_pairs(self, gt_boxes):
+    """Returns (gt index, anchor index) pairs of anchors near each box.
+
+    For each box and level, only the grid cells whose anchors can overlap the
+    box are selected, with a margin of one cell. All other anchors have zero
+    IoU with the box.
+    """
+    grids = self._anchor_grids
+    num_levels = len(grids['offset'])
+    num_per_location = self._anchors.get_anchors_per_location()
+    y_min, x_min, y_max, x_max = [
+        coord[:, None] for coord in tf.unstack(gt_boxes, axis=1)
+    ]
+
+    def _cell_range(low, high, half, stride, size):
+      begin = tf.cast(
+          tf.floor((low - half - stride / 2.0) / stride), tf.int32)
+      end = tf.cast(
+          tf.floor((high + half - stride / 2.0) / stride), tf.int32) + 2
+      begin = tf.clip_by_value(begin, 0, size)
+      end = tf.clip_by_value(end, 0, size)
+      return begin, tf.maximum(end - begin, 0)
+
+    # [num_gt, num_levels] ranges of candidate cells.
+    row_begin, num_rows = _cell_range(y_min, y_max, grids['half_y'],
+                                      grids['stride_y'], grids['height'])
+    col_begin, num_cols = _cell_range(x_min, x_max, grids['half_x'],
+                                      grids['stride_x'], grids['width'])
+    num_candidates = tf.reshape(num_rows * num_cols * num_per_location, [-1])
+    candidates = tf.ragged.range(num_candidates)
+    # Each candidate k of a (gt, level) pair is an anchor in the cell range.
+    pair = tf.cast(candidates.value_rowids(), tf.int32)
+    k = candidates.flat_values
+    level = pair % num_levels
+    cell = k // num_per_location
+    pair_num_cols = tf.gather(tf.reshape(num_cols, [-1]), pair)
+    row = tf.gather(tf.reshape(row_begin, [-1]), pair) + cell // pair_num_cols
+    col = tf.gather(tf.reshape(col_begin, [-1]), pair) + cell % pair_num_cols
+    anchor_indices = (
+        tf.gather(grids['offset'], level) +
+        (row * tf.gather(grids['width'], level) + col) * num_per_location +
+        k % num_per_location)
+    return pair // num_levels, anchor_indices
+
+  def _sparse_match(self, gt_boxes):
+    """Matches anchors to boxes from the IoU of the candidate pairs only."""
+    gt_indices, anchor_indices = self._candidate_pairs(gt_boxes)
+    ious = region_similarity_calculator.paired_iou(
+        tf.gather(gt_boxes, gt_indices),
+        tf.gather(self._anchors.boxes, anchor_indices))
+    return self._matcher.match_sparse(gt_indices, anchor_indices, ious,
+                                      tf.shape(gt_boxes)[0], self.num_anchors)
+
+  @property
+  def num_anchors(self):
+    return self._anchors.boxes.shape[0]
 
   def _unpack_labels(self, labels):
     """Unpacks an array of labels into multiscales labels."""
@@ -188,6 +365,26 @@ class AnchorLabeler(object):
           [feat_size['height'], feat_size['width'], -1])
     return labels_unpacked
 
+  def _assign_targets(self, gt_boxes, gt_labels):
+    """Assigns flat targets to all anchors of the image."""
+    gt_box_list = box_list.BoxList(gt_boxes)
+    anchor_box_list = box_list.BoxList(self._anchors.boxes)
+
+    # cls_weights, box_weights are not used
+    if self._sparse_matching:
+      cls_targets, _, box_targets, _, matches = (
+          self._target_assigner.assign_with_match(
+              anchor_box_list, gt_box_list, self._sparse_match(gt_boxes),
+              gt_labels))
+    else:
+      cls_targets, _, box_targets, _, matches = self._target_assigner.assign(
+          anchor_box_list, gt_box_list, gt_labels)
+
+    # class labels start from 1 and the background class = -1
+    cls_targets -= 1
+    cls_targets = tf.cast(cls_targets, tf.int32)
+    return cls_targets, box_targets, matches
+
   def label_anchors(self, gt_boxes, gt_labels):
     """Labels anchors with ground truth inputs.
 
@@ -208,16 +405,8 @@ class AnchorLabeler(object):
         l-th level.
       num_positives: scalar tensor storing number of positives in an image.
     """
-    gt_box_list = box_list.BoxList(gt_boxes)
-    anchor_box_list = box_list.BoxList(self._anchors.boxes)
-
-    # cls_weights, box_weights are not used
-    cls_targets, _, box_targets, _, matches = self._target_assigner.assign(
-        anchor_box_list, gt_box_list, gt_labels)
-
-    # class labels start from 1 and the background class = -1
-    cls_targets -= 1
-    cls_targets = tf.cast(cls_targets, tf.int32)
+    cls_targets, box_targets, matches = self._assign_targets(
+        gt_boxes, gt_labels)
 
     # Unpack labels.
     cls_targets_dict = self._unpack_labels(cls_targets)
@@ -226,3 +415,55 @@ class AnchorLabeler(object):
         tf.cast(tf.not_equal(matches.match_results, -1), tf.float32))
 
     return cls_targets_dict, box_targets_dict, num_positives
+
+  def label_anchors_sparse(self, gt_boxes, gt_labels):
+    """Labels anchors and only returns the targets of matched anchors.
+
+    All other anchors have class target -1 and zero box targets, so the
+    result can be stored compactly and expanded with densify_targets.
+
+    Args:
+      gt_boxes: A float tensor with shape [N, 4] representing groundtruth boxes.
+        For each row, it stores [y0, x0, y1, x1] for four corners of a box.
+      gt_labels: A integer tensor with shape [N, 1] representing groundtruth
+        classes.
+    Returns:
+      indices: int32 tensor with shape [P], the flat indices of the matched
+        anchors.
+      cls_targets: int32 tensor with shape [P], the class targets of the
+        matched anchors.
+      box_targets: float tensor with shape [P, 4], the encoded box targets of
+        the matched anchors.
+      num_positives: scalar tensor storing number of positives in an image.
+    """
+    cls_targets, box_targets, matches = self._assign_targets(
+        gt_boxes, gt_labels)
+    indices = tf.cast(
+        tf.reshape(tf.where(matches.match_results >= 0), [-1]), tf.int32)
+    num_positives = tf.reduce_sum(
+        tf.cast(tf.not_equal(matches.match_results, -1), tf.float32))
+    return (indices, tf.reshape(tf.gather(cls_targets, indices), [-1]),
+            tf.gather(box_targets, indices), num_positives)
+
+  def densify_targets(self, indices, cls_targets, box_targets, num_positives):
+    """Expands the output of label_anchors_sparse to label_anchors format.
+
+    Args:
+      indices: int tensor with shape [P], the flat indices of matched anchors.
+      cls_targets: int tensor with shape [P], their class targets.
+      box_targets: float tensor with shape [P, 4], their encoded box targets.
+      num_positives: scalar tensor storing number of positives in an image.
+    Returns:
+      The same (cls_targets_dict, box_targets_dict, num_positives) tuple as
+      label_anchors.
+    """
+    num_anchors = self.num_anchors
+    indices = tf.reshape(tf.cast(indices, tf.int32), [-1, 1])
+    dense_cls_targets = tf.tensor_scatter_nd_update(
+        tf.fill([num_anchors], -1), indices, tf.cast(cls_targets, tf.int32))
+    dense_box_targets = tf.scatter_nd(indices,
+                                      tf.cast(box_targets, tf.float32),
+                                      [num_anchors, 4])
+    return (self._unpack_labels(dense_cls_targets),
+            self._unpack_labels(dense_box_targets),
+            tf.cast(num_positives, tf.float32))
@@ -0,0 +1,137 @@
+# Copyright 2020 Google Research. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================
+"""Tests for anchors."""
+from absl import logging
+import numpy as np
+import tensorflow as tf
+
+from keras import anchors
+
+
+def _reference_boxes(input_anchors):
+  """Generates anchor boxes with per-config loops like the original code."""
+  boxes_all = []
+  for configs in input_anchors.config.values():
+    boxes_level = []
+    for stride, octave_scale, aspect, anchor_scale in configs:
+      base_anchor_size_x = anchor_scale * stride[1] * 2**octave_scale
+      base_anchor_size_y = anchor_scale * stride[0] * 2**octave_scale
+      if isinstance(aspect, list):
+        aspect_x, aspect_y = aspect
+      else:
+        aspect_x = np.sqrt(aspect)
+        aspect_y = 1.0 / aspect_x
+      anchor_size_x_2 = base_anchor_size_x * aspect_x / 2.0
+      anchor_size_y_2 = base_anchor_size_y * aspect_y / 2.0
+      x = np.arange(stride[1] / 2, input_anchors.image_size[1], stride[1])
+      y = np.arange(stride[0] / 2, input_anchors.image_size[0], stride[0])
+      xv, yv = np.meshgrid(x, y)
+      xv, yv = xv.reshape(-1), yv.reshape(-1)
+      boxes = np.vstack((yv - anchor_size_y_2, xv - anchor_size_x_2,
+                         yv + anchor_size_y_2, xv + anchor_size_x_2))
+      boxes_level.append(np.swapaxes(boxes, 0, 1)[:, None])
+    boxes_all.append(np.concatenate(boxes_level, axis=1).reshape([-1, 4]))
+  return np.vstack(boxes_all).astype(np.float32)
+
+
+class AnchorsTest(tf.test.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    anchors.clear_anchor_cache()
+
+  def test_same_as_reference(self):
+    for aspect_ratios, anchor_scale, image_size in [
+        ([1.0, 2.0, 0.5], 4.0, 512),
+        ([[1.4, 0.7], [1.0, 1.0]], [3.0, 4.0, 4.0, 4.0, 5.0], '640x384'),
+        ([1.0], 4.0, (300, 200)),
+    ]:
+      input_anchors = anchors.Anchors(3, 7, 3, aspect_ratios, anchor_scale,
+                                      image_size)
+      self.assertAllClose(input_anchors.boxes, _reference_boxes(input_anchors))
+
+  def test_anchors_share_boxes(self):
+    anchors_a = anchors.Anchors(3, 7, 3, [1.0, 2.0, 0.5], 4.0, 512)
+    anchors_b = anchors.Anchors(3, 7, 3, [1.0, 2.0, 0.5], 4.0, (512, 512))
+    boxes = anchors.get_anchor_boxes(3, 7, 3, [1.0, 2.0, 0.5], [4.0] * 5,
+                                     (512, 512))
+    self.assertIs(boxes, anchors.get_anchor_boxes(3, 7, 3, (1.0, 2.0, 0.5),
+                                                  (4.0,) * 5, (512, 512)))
+    self.assertEqual(boxes.dtype, np.float32)
+    self.assertFalse(boxes.flags.writeable)
+    self.assertAllEqual(anchors_a.boxes, boxes)
+    self.assertAllEqual(anchors_b.boxes, boxes)
+
+  def test_cache_eviction(self):
+    cache_size = anchors.ANCHOR_CACHE_SIZE
+    anchors.ANCHOR_CACHE_SIZE = 2
+    try:
+      first = anchors.get_anchor_boxes(3, 4, 1, [1.0], [4.0] * 2, (64, 64))
+      anchors.get_anchor_boxes(3, 4, 1, [1.0], [4.0] * 2, (128, 128))
+      self.assertIs(
+          first,
+          anchors.get_anchor_boxes(3, 4, 1, [1.0], [4.0] * 2, (64, 64)))
+      anchors.get_anchor_boxes(3, 4, 1, [1.0], [4.0] * 2, (256, 256))
+      self.assertIs(
+          first,
+          anchors.get_anchor_boxes(3, 4, 1, [1.0], [4.0] * 2, (64, 64)))
+      anchors.get_anchor_boxes(3, 4, 1, [1.0], [4.0] * 2, (128, 128))
+      anchors.get_anchor_boxes(3, 4, 1, [1.0], [4.0] * 2, (256, 256))
+      self.assertIsNot(
+          first,
+          anchors.get_anchor_boxes(3, 4, 1, [1.0], [4.0] * 2, (64, 64)))
+    finally:
+      anchors.ANCHOR_CACHE_SIZE = cache_size
+
+  def test_sparse_targets_densify_to_dense_targets(self):
+    input_anchors = anchors.Anchors(3, 5, 2, [1.0, 2.0], 4.0, 128)
+    anchor_labeler = anchors.AnchorLabeler(input_anchors, 10)
+    gt_boxes = tf.constant([[10., 12., 60., 50.], [64., 64., 120., 100.]])
+    gt_labels = tf.constant([[3.], [7.]])
+    cls_targets, box_targets, num_positives = anchor_labeler.label_anchors(
+        gt_boxes, gt_labels)
+    sparse_targets = anchor_labeler.label_anchors_sparse(gt_boxes, gt_labels)
+    self.assertAllEqual(set(sparse_targets[1].numpy()), {2, 6})
+    dense_targets = anchor_labeler.densify_targets(*sparse_targets)
+    for level in range(3, 6):
+      self.assertAllEqual(dense_targets[0][level], cls_targets[level])
+      self.assertAllEqual(dense_targets[1][level], box_targets[level])
+    self.assertEqual(dense_targets[2], num_positives)
+
+  def test_sparse_matching_same_as_dense(self):
+    input_anchors = anchors.Anchors(3, 6, 3, [1.0, 2.0, 0.5], 4.0, '320x192')
+    dense_labeler = anchors.AnchorLabeler(input_anchors, 10)
+    sparse_labeler = anchors.AnchorLabeler(
+        input_anchors, 10, sparse_matching=True)
+    rng = np.random.RandomState(0)
+    for num_boxes in [0, 1, 5, 30]:
+      corners = rng.uniform(-10, 330, size=(num_boxes, 2, 2))
+      # Add some tiny boxes, which are only matched by force matching.
+      corners[::3, 1] = corners[::3, 0] + rng.uniform(0.5, 4, (2,))
+      gt_boxes = tf.constant(
+          np.concatenate([corners.min(1), corners.max(1)], 1), tf.float32)
+      gt_labels = tf.constant(
+          rng.randint(1, 10, size=(num_boxes, 1)), tf.float32)
+      dense_targets = dense_labeler.label_anchors(gt_boxes, gt_labels)
+      sparse_targets = sparse_labeler.label_anchors(gt_boxes, gt_labels)
+      for level in range(3, 7):
+        self.assertAllEqual(sparse_targets[0][level], dense_targets[0][level])
+        self.assertAllEqual(sparse_targets[1][level], dense_targets[1][level])
+      self.assertEqual(sparse_targets[2], dense_targets[2])
+
+
+if __name__ == '__main__':
+  logging.set_verbosity(logging.WARNING)
+  tf.test.main()
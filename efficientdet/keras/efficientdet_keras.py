@@ -27,6 +27,7 @@ from keras import fpn_configs
 from keras import postprocess
 from keras import tfmot
 from keras import util_keras
+from keras import wbf
 
 
 def add_n(nodes):
@@ -935,20 +936,29 @@ class EfficientDetModel(EfficientDetNet):
     # otherwise treat it as dynamic batch size.
     return tf.vectorized_map(map_fn, raw_images)
 
-  def _postprocess(self, cls_outputs, box_outputs, scales, mode='global'):
+  def _postprocess(self, cls_outputs, box_outputs, scales, mode='global',
+                   image_size=None):
     """Postprocess class and box predictions."""
     if not mode:
       return cls_outputs, box_outputs
 
+    params = self.config.as_dict()
+    if image_size:
+      params['image_size'] = image_size
     if mode == 'global':
-      return postprocess.postprocess_global(self.config.as_dict(), cls_outputs,
-                                            box_outputs, scales)
+      return postprocess.postprocess_global(params, cls_outputs, box_outputs,
+                                            scales)
     if mode == 'per_class':
-      return postprocess.postprocess_per_class(self.config.as_dict(),
-                                               cls_outputs, box_outputs, scales)
+      return postprocess.postprocess_per_class(params, cls_outputs,
+                                               box_outputs, scales)
     raise ValueError('Unsupported postprocess mode {}'.format(mode))
 
-  def call(self, inputs, training=False, pre_mode='infer', post_mode='global'):
+  def call(self,
+           inputs,
+           training=False,
+           pre_mode='infer',
+           post_mode='global',
+           image_size=None):
     """Call this model.
 
     Args:
@@ -956,20 +966,106 @@ class EfficientDetModel(EfficientDetNet):
       training: If true, it is training mode. Otherwise, eval mode.
       pre_mode: preprocessing mode, must be {None, 'infer'}.
       post_mode: postprrocessing mode, must be {None, 'global', 'per_class'}.
+      image_size: the network input size used by pre and postprocessing. If
+        None, use config.image_size.
 
     Returns:
       the output tensor list.
     """
     config = self.config
+    image_size = image_size or config.image_size
 
     # preprocess.
-    inputs, scales = self._preprocessing(inputs, config.image_size, pre_mode)
+    inputs, scales = self._preprocessing(inputs, image_size, pre_mode)
     # network.
     outputs = super().call(inputs, training)
 
     if 'object_detection' in config.heads and post_mode:
       # postprocess for detection
-      det_outputs = self._postprocess(outputs[0], outputs[1], scales, post_mode)
+      det_outputs = self._postprocess(outputs[0], outputs[1], scales, post_mode,
+                                      image_size)
       outputs = det_outputs + outputs[2:]
 
     return outputs
+
+  def call_tta(self, inputs, scales=(1.0,), flip=True, image_size=None):
+    """Test time augmentation with all views in a single forward pass.
+
+    Each image is expanded to views at the given scales, and also flipped
+    horizontally if flip. All views run through the network as one batch, the
+    boxes of each view are decoded, moved back to the original image and nms
+    is applied once for the whole batch, and the detections of the views of
+    each image are fused by weighted box fusion.
+
+    The fusion runs in a tf.numpy_function, so a function calling call_tta
+    cannot be exported to a SavedModel.
+
+    Args:
+      inputs: a tensor of raw images with shape [batch, height, width, 3].
+      scales: factors of the image scale of the views. Views larger than the
+        network input size are cropped.
+      flip: whether to add horizontally flipped views.
+      image_size: the network input size. If None, use config.image_size.
+
+    Returns:
+      A tuple (boxes, scores, classes, valid_len) like call() with
+      post_mode='global'.
+    """
+    config = self.config
+    image_size = utils.parse_image_size(image_size or config.image_size)
+    views = [(scale, False) for scale in scales]
+    if flip:
+      views += [(scale, True) for scale in scales]
+
+    def map_fn(image):
+      view_images, view_scales = [], []
+      for scale, flipped in views:
+        input_processor = dataloader.DetectionInputProcessor(
+            tf.image.flip_left_right(image) if flipped else image, image_size)
+        input_processor.normalize_image()
+        input_processor.set_scale_factors_to_output_size(scale)
+        view_images.append(input_processor.resize_and_crop_image())
+        view_scales.append(input_processor.image_scale_to_original)
+      return tf.stack(view_images), tf.stack(view_scales)
+
+    if inputs.shape.as_list()[0]:  # fixed batch size.
+      outputs = [map_fn(inputs[i]) for i in range(inputs.shape.as_list()[0])]
+      images, image_scales = [tf.stack(y) for y in zip(*outputs)]
+    else:
+      images, image_scales = tf.vectorized_map(map_fn, inputs)
+    # Views of each image are next to each other in the batch.
+    images = tf.reshape(images, [-1, *image_size, 3])
+    image_scales = tf.reshape(image_scales, [-1])
+
+    cls_outputs, box_outputs = super().call(images, training=False)[:2]
+    params = config.as_dict()
+    params['image_size'] = image_size
+    boxes, scores, classes, valid_lens = postprocess.postprocess_global(
+        params, cls_outputs, box_outputs, image_scales)
+    boxes = tf.cast(boxes, tf.float32)
+    # Clip to the original images, since boxes are only clipped to the network
+    # input, and mirror the boxes of flipped views back.
+    height = tf.cast(tf.shape(inputs)[1], tf.float32)
+    width = tf.cast(tf.shape(inputs)[2], tf.float32)
+    boxes = tf.clip_by_value(boxes, 0., tf.stack([height, width] * 2))
+    is_flipped = tf.tile([flipped for _, flipped in views],
+                         tf.shape(inputs)[:1])
+    ymin, xmin, ymax, xmax = tf.unstack(boxes, axis=-1)
+    flipped_boxes = tf.stack([ymin, width - xmax, ymax, width - xmin], -1)
+    boxes = tf.where(is_flipped[:, None, None], flipped_boxes, boxes)
+
+    max_output_size = params['nms_configs']['max_output_size']
+    outputs = tf.numpy_function(
+        functools.partial(
+            wbf.fuse_batch_views,
+            num_views=len(views),
+            max_output_size=max_output_size), [
+                boxes,
+                tf.cast(scores, tf.float32),
+                tf.cast(classes, tf.float32), valid_lens
+            ], [tf.float32, tf.float32, tf.float32, tf.int32])
+    batch_size = inputs.shape.as_list()[0]
+    for output, shape in zip(outputs, [[max_output_size, 4], [max_output_size],
+                                       [max_output_size], []]):
+      output.set_shape([batch_size] + shape)
+    return outputs
@@ -91,8 +91,13 @@ def main(_):
 
     # Evaluator for AP calculation.
     label_map = label_util.get_label_map(config.label_map)
-    evaluator = coco_metric.EvaluationMetric(
-        filename=config.val_json_file, label_map=label_map)
+    if config.streaming_eval:
+      evaluator_cls = coco_metric.StreamingEvaluationMetric
+    else:
+      evaluator_cls = coco_metric.EvaluationMetric
+    evaluator = evaluator_cls(
+        filename=config.val_json_file, label_map=label_map,
+        backend=config.eval_backend)
 
     # dataset
     batch_size = FLAGS.batch_size   # global batch size.
@@ -13,6 +13,10 @@
 # limitations under the License.
 # ==============================================================================
 """Eval libraries. Used for TFLite model without post-processing."""
+import collections
+import concurrent.futures
+import threading
+
 from absl import app
 from absl import flags
 from absl import logging
@@ -36,45 +40,92 @@ flags.DEFINE_string('val_json_file', None,
 flags.DEFINE_string('model_name', 'efficientdet-d0', 'Model name to use.')
 flags.DEFINE_string('tflite_path', None, 'Path to TFLite model.')
 flags.DEFINE_string('hparams', '', 'Comma separated k=v pairs or a yaml file')
+flags.DEFINE_integer('batch_size', 1, 'Batch size of each interpreter run.')
+flags.DEFINE_integer('num_runners', 2,
+                     'Number of interpreters running on separate threads.')
+flags.DEFINE_integer('num_threads', None,
+                     'Number of threads of each interpreter.')
 FLAGS = flags.FLAGS
 
 DEFAULT_SCALE, DEFAULT_ZERO_POINT = 0, 0
 
 
 class LiteRunner(object):
-  """Runs inference with TF Lite model."""
-
-  def __init__(self, tflite_model_path):
-    """Initializes Lite runner with tflite model file."""
-    self.interpreter = tf.lite.Interpreter(tflite_model_path)
+  """Runs inference with TF Lite model.
+
+  The quantized input and dequantized outputs are computed in preallocated
+  buffers, so the outputs of run() are overwritten by the next call.
+  """
+
+  def __init__(self, tflite_model_path, batch_size=None, num_threads=None):
+    """Initializes Lite runner with tflite model file.
+
+    Args:
+      tflite_model_path: path of the TFLite model.
+      batch_size: resize the model input to this batch size if set.
+      num_threads: number of threads of the interpreter.
+    """
+    self.interpreter = tf.lite.Interpreter(
+        tflite_model_path, num_threads=num_threads)
+    input_detail = self.interpreter.get_input_details()[0]
+    if batch_size and batch_size != input_detail['shape'][0]:
+      self.interpreter.resize_tensor_input(
+          input_detail['index'], [batch_size, *input_detail['shape'][1:]])
     self.interpreter.allocate_tensors()
     # Get input and output tensors.
     self.input_details = self.interpreter.get_input_details()
     self.output_details = self.interpreter.get_output_details()
 
+    input_detail = self.input_details[0]
+    self.batch_size = input_detail['shape'][0]
+    self._input = np.zeros(input_detail['shape'], input_detail['dtype'])
+    self._scaled_input = None
+    if input_detail['quantization'] != (DEFAULT_SCALE, DEFAULT_ZERO_POINT):
+      self._scaled_input = np.zeros(input_detail['shape'], np.float32)
+    self._outputs = [
+        np.zeros(d['shape'], np.float32) if d['quantization'] !=
+        (DEFAULT_SCALE, DEFAULT_ZERO_POINT) else None
+        for d in self.output_details
+    ]
+
   def run(self, image):
-    """Runs inference with Lite model."""
+    """Runs inference with Lite model.
+
+    Args:
+      image: a batch of images. Smaller batches are padded to the model batch.
+
+    Returns:
+      A tuple of the class and box outputs of each level, without padding.
+    """
     interpreter = self.interpreter
     input_details = self.input_details
     output_details = self.output_details
 
+    image = np.asarray(image)
+    num_images = image.shape[0]
     input_detail = input_details[0]
-    if input_detail['quantization'] != (DEFAULT_SCALE, DEFAULT_ZERO_POINT):
+    if self._scaled_input is not None:
       scale, zero_point = input_detail['quantization']
-      image = image / scale + zero_point
-      image = np.array(image, dtype=input_detail['dtype'])
-    interpreter.set_tensor(input_detail['index'], image)
+      scaled_input = self._scaled_input[:num_images]
+      np.divide(image, scale, out=scaled_input)
+      scaled_input += zero_point
+      np.copyto(self._input[:num_images], scaled_input, casting='unsafe')
+    else:
+      np.copyto(self._input[:num_images], image, casting='unsafe')
+    self._input[num_images:] = 0
+    interpreter.set_tensor(input_detail['index'], self._input)
     interpreter.invoke()
 
     def get_output(idx):
       output_detail = output_details[idx]
       output_tensor = interpreter.get_tensor(output_detail['index'])
-      if output_detail['quantization'] != (DEFAULT_SCALE, DEFAULT_ZERO_POINT):
+      if self._outputs[idx] is not None:
         # Dequantize the output
         scale, zero_point = output_detail['quantization']
-        output_tensor = output_tensor.astype(np.float32)
-        output_tensor = (output_tensor - zero_point) * scale
-      return output_tensor
+        output_tensor = np.subtract(
+            output_tensor, zero_point, out=self._outputs[idx], dtype=np.float32)
+        output_tensor *= scale
+      return output_tensor[:num_images]
 
     num_boxes = int(len(output_details) / 2)
     cls_outputs, box_outputs = [], []
@@ -94,11 +145,16 @@ def main(_):
 
   # Evaluator for AP calculation.
   label_map = label_util.get_label_map(config.label_map)
-  evaluator = coco_metric.EvaluationMetric(
-      filename=config.val_json_file, label_map=label_map)
+  if config.streaming_eval:
+    evaluator_cls = coco_metric.StreamingEvaluationMetric
+  else:
+    evaluator_cls = coco_metric.EvaluationMetric
+  evaluator = evaluator_cls(
+      filename=config.val_json_file, label_map=label_map,
+      backend=config.eval_backend)
 
   # dataset
-  batch_size = 1
+  batch_size = FLAGS.batch_size
   ds = dataloader.InputReader(
       FLAGS.val_file_pattern,
       is_training=False,
@@ -108,20 +164,33 @@ def main(_):
   if eval_samples:
     ds = ds.take((eval_samples + batch_size - 1) // batch_size)
 
-  # Network
-  lite_runner = LiteRunner(FLAGS.tflite_path)
-  eval_samples = FLAGS.eval_samples or 5000
-  pbar = tf.keras.utils.Progbar((eval_samples + batch_size - 1) // batch_size)
-  for i, (images, labels) in enumerate(ds):
-    cls_outputs, box_outputs = lite_runner.run(images)
+  # Network. Each thread owns an interpreter and runs the postprocessing of
+  # its own batches, while the main thread updates the evaluator in order.
+  local = threading.local()
+
+  def infer(images, labels):
+    if not hasattr(local, 'lite_runner'):
+      local.lite_runner = LiteRunner(FLAGS.tflite_path, batch_size,
+                                     FLAGS.num_threads)
+    cls_outputs, box_outputs = local.lite_runner.run(images)
     detections = postprocess.generate_detections(config, cls_outputs,
                                                  box_outputs,
                                                  labels['image_scales'],
                                                  labels['source_ids'])
     detections = postprocess.transform_detections(detections)
-    evaluator.update_state(labels['groundtruth_data'].numpy(),
-                           detections.numpy())
-    pbar.update(i)
+    return labels['groundtruth_data'].numpy(), detections.numpy()
+
+  eval_samples = FLAGS.eval_samples or 5000
+  pbar = tf.keras.utils.Progbar((eval_samples + batch_size - 1) // batch_size)
+  pending = collections.deque()
+  with concurrent.futures.ThreadPoolExecutor(FLAGS.num_runners) as executor:
+    for i, (images, labels) in enumerate(ds):
+      pending.append(executor.submit(infer, images, labels))
+      if len(pending) > FLAGS.num_runners:
+        evaluator.update_state(*pending.popleft().result())
+      pbar.update(i)
+    while pending:
+      evaluator.update_state(*pending.popleft().result())
 
   # compute the final eval results.
   metrics = evaluator.result()
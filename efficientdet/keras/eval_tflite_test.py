@@ -0,0 +1,105 @@
+# Copyright 2020 Google Research. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Tests for eval_tflite."""
+import os
+
+from absl import logging
+import numpy as np
+import tensorflow as tf
+
+from keras import eval_tflite
+
+
+def reference_run(tflite_path, image):
+  """Runs a single image without preallocated buffers or padding."""
+  interpreter = tf.lite.Interpreter(tflite_path)
+  interpreter.allocate_tensors()
+  input_detail = interpreter.get_input_details()[0]
+  scale, zero_point = input_detail['quantization']
+  if (scale, zero_point) != (0, 0):
+    image = image / scale + zero_point
+  interpreter.set_tensor(input_detail['index'],
+                         image[None].astype(input_detail['dtype']))
+  interpreter.invoke()
+  outputs = []
+  for output_detail in interpreter.get_output_details():
+    output = interpreter.get_tensor(output_detail['index'])
+    scale, zero_point = output_detail['quantization']
+    if (scale, zero_point) != (0, 0):
+      output = (output.astype(np.float32) - zero_point) * scale
+    outputs.append(output[0])
+  return outputs
+
+
+class LiteRunnerTest(tf.test.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    tf.random.set_seed(111111)
+    self.images = np.random.RandomState(0).uniform(
+        -1, 1, size=(6, 8, 8, 3)).astype(np.float32)
+
+  def _convert(self, quantize):
+    inputs = tf.keras.Input([8, 8, 3])
+    cls_output = tf.keras.layers.Conv2D(4, 3, padding='same')(inputs)
+    box_output = tf.keras.layers.Conv2D(8, 3, padding='same')(cls_output)
+    model = tf.keras.Model(inputs, [cls_output, box_output])
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if quantize:
+      converter.optimizations = [tf.lite.Optimize.DEFAULT]
+      converter.representative_dataset = lambda: ([x[None]]
+                                                  for x in self.images)
+      converter.target_spec.supported_ops = [
+          tf.lite.OpsSet.TFLITE_BUILTINS_INT8
+      ]
+      converter.inference_input_type = tf.uint8
+      converter.inference_output_type = tf.uint8
+    tflite_path = os.path.join(self.get_temp_dir(),
+                               'model_%d.tflite' % quantize)
+    with tf.io.gfile.GFile(tflite_path, 'wb') as f:
+      f.write(converter.convert())
+    return tflite_path
+
+  def _test_run(self, quantize):
+    tflite_path = self._convert(quantize)
+    expected = [reference_run(tflite_path, image) for image in self.images]
+    runner = eval_tflite.LiteRunner(tflite_path, batch_size=4)
+    self.assertEqual(runner.batch_size, 4)
+    self.assertEqual(runner.input_details[0]['dtype'],
+                     np.uint8 if quantize else np.float32)
+    # A full batch, then a partial batch padded to the model batch size.
+    for start, end in ((0, 4), (4, 6)):
+      cls_outputs, box_outputs = runner.run(self.images[start:end])
+      self.assertLen(cls_outputs, 1)
+      self.assertEqual(cls_outputs[0].shape, (end - start, 8, 8, 4))
+      self.assertEqual(box_outputs[0].shape, (end - start, 8, 8, 8))
+      outputs = cls_outputs + box_outputs
+      # The converter may reorder the outputs; match them by shape.
+      for i in range(start, end):
+        self.assertAllClose(
+            sorted([o[i - start] for o in outputs], key=np.shape),
+            sorted(expected[i], key=np.shape),
+            atol=1e-5)
+
+  def test_run(self):
+    self._test_run(quantize=False)
+
+  def test_run_quantized(self):
+    self._test_run(quantize=True)
+
+
+if __name__ == '__main__':
+  logging.set_verbosity(logging.WARNING)
+  tf.test.main()
@@ -0,0 +1,138 @@
+# Copyright 2020 Google Research. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+r"""Benchmark the dense and sparse focal loss.
+
+Measures the step time of the classification loss and its gradient over all
+levels with random logits and targets, and the peak memory on GPU.
+
+Example usage:
+    python keras/focal_loss_benchmark.py \
+      --model_names=efficientdet-d0,efficientdet-d4,efficientdet-d7
+"""
+import time
+
+from absl import app
+from absl import flags
+from absl import logging
+import tensorflow as tf
+
+import hparams_config
+import utils
+from keras import train_lib
+
+flags.DEFINE_list('model_names',
+                  'efficientdet-d0,efficientdet-d4,efficientdet-d7',
+                  'Model names to benchmark.')
+flags.DEFINE_integer('batch_size', 4, 'Batch size.')
+flags.DEFINE_integer('num_positives', 100,
+                     'Number of positive anchors per image.')
+flags.DEFINE_integer('warmup_runs', 2, 'Number of warmup runs.')
+flags.DEFINE_integer('bm_runs', 10, 'Number of benchmark runs.')
+FLAGS = flags.FLAGS
+
+
+def random_inputs(config, batch_size, num_positives):
+  """Returns random class logits and targets for all levels."""
+  num_anchors = len(config.aspect_ratios) * config.num_scales
+  feat_sizes = utils.get_feat_sizes(config.image_size, config.max_level)
+  shapes = [[
+      batch_size, feat_sizes[level]['height'], feat_sizes[level]['width'],
+      num_anchors
+  ] for level in range(config.min_level, config.max_level + 1)]
+  positive_rate = num_positives / sum(
+      height * width * anchors for _, height, width, anchors in shapes)
+  cls_outputs, cls_targets = [], []
+  for shape in shapes:
+    cls_outputs.append(
+        tf.random.normal(shape[:-1] + [num_anchors * config.num_classes]))
+    cls_targets.append(
+        tf.where(
+            tf.random.uniform(shape) < positive_rate,
+            tf.random.uniform(shape, maxval=config.num_classes,
+                              dtype=tf.int32), -1))
+  return cls_outputs, cls_targets
+
+
+def dense_focal_loss(focal_loss, normalizer, cls_targets, cls_outputs,
+                     num_classes):
+  """The onehot focal loss as in EfficientDetNetTrain._detection_loss."""
+  targets = tf.one_hot(cls_targets, num_classes)
+  bs, height, width, _, _ = targets.get_shape().as_list()
+  targets = tf.reshape(targets, [bs, height, width, -1])
+  loss = focal_loss([normalizer, targets], cls_outputs)
+  loss = tf.reshape(loss, [bs, height, width, -1, num_classes])
+  loss *= tf.cast(tf.expand_dims(tf.not_equal(cls_targets, -2), -1),
+                  tf.float32)
+  return tf.reduce_sum(loss)
+
+
+def benchmark(model_name, sparse):
+  """Returns the step time in seconds and peak GPU memory in bytes."""
+  config = hparams_config.get_detection_config(model_name)
+  config.image_size = utils.parse_image_size(config.image_size)
+  focal_loss = train_lib.FocalLoss(
+      config.alpha,
+      config.gamma,
+      label_smoothing=config.label_smoothing,
+      reduction=tf.keras.losses.Reduction.NONE)
+  cls_outputs, cls_targets = random_inputs(config, FLAGS.batch_size,
+                                           FLAGS.num_positives)
+  normalizer = tf.constant(float(FLAGS.num_positives * FLAGS.batch_size))
+
+  @tf.function
+  def step(cls_outputs):
+    with tf.GradientTape() as tape:
+      tape.watch(cls_outputs)
+      losses = []
+      for outputs, targets in zip(cls_outputs, cls_targets):
+        if sparse:
+          losses.append(
+              focal_loss.sparse_call([normalizer, targets], outputs))
+        else:
+          losses.append(
+              dense_focal_loss(focal_loss, normalizer, targets, outputs,
+                               config.num_classes))
+      loss = tf.add_n(losses)
+    return loss, tape.gradient(loss, cls_outputs)
+
+  gpus = tf.config.list_logical_devices('GPU')
+  for _ in range(FLAGS.warmup_runs):
+    step(cls_outputs)[0].numpy()
+  if gpus and hasattr(tf.config.experimental, 'reset_memory_stats'):
+    tf.config.experimental.reset_memory_stats(gpus[0].name)
+  start = time.perf_counter()
+  for _ in range(FLAGS.bm_runs):
+    step(cls_outputs)[0].numpy()
+  step_time = (time.perf_counter() - start) / FLAGS.bm_runs
+  peak_memory = None
+  if gpus:
+    peak_memory = tf.config.experimental.get_memory_info(gpus[0].name)['peak']
+  return step_time, peak_memory
+
+
+def main(_):
+  for model_name in FLAGS.model_names:
+    for sparse in (False, True):
+      step_time, peak_memory = benchmark(model_name, sparse)
+      logging.info('%s %s focal loss: %.1f ms/step, peak memory: %s',
+                   model_name, 'sparse' if sparse else 'dense',
+                   step_time * 1000,
+                   'n/a' if peak_memory is None else
+                   '%.1f MB' % (peak_memory / 2**20))
+
+
+if __name__ == '__main__':
+  logging.set_verbosity(logging.INFO)
+  app.run(main)
@@ -13,8 +13,15 @@
 # limitations under the License.
 # ==============================================================================
 r"""Inference related utilities."""
+import asyncio
+import bisect
+import collections
+import concurrent.futures
 import copy
+import operator
 import os
+import queue
+import threading
 import time
 from typing import Text, Dict, Any
 from absl import logging
@@ -26,7 +33,9 @@ import hparams_config
 import utils
 from keras import efficientdet_keras
 from keras import label_util
+from keras import postprocess
 from keras import util_keras
+from keras import wbf
 from visualize import vis_utils
 
 
@@ -72,6 +81,9 @@ def visualize_image(image,
   return img
 
 
+BUCKET_SIGNATURE_PREFIX = 'image_size_'
+
+
 class ExportNetwork(tf.Module):
 
   def __init__(self, model):
@@ -86,15 +98,20 @@ class ExportNetwork(tf.Module):
 class ExportModel(tf.Module):
   """Model to be exported as SavedModel/TFLite format."""
 
-  def __init__(self, model, pre_mode='infer'):
+  def __init__(self, model, pre_mode='infer', image_size=None):
     super().__init__()
     self.model = model
     self.pre_mode = pre_mode
+    self.image_size = image_size
 
   @tf.function
   def __call__(self, imgs):
     return self.model(
-        imgs, training=False, pre_mode=self.pre_mode, post_mode='global')
+        imgs,
+        training=False,
+        pre_mode=self.pre_mode,
+        post_mode='global',
+        image_size=self.image_size)
 
 
 class ServingDriver:
@@ -175,6 +192,9 @@ class ServingDriver:
     self.label_map = self.params.get('label_map', None)
 
     self._model = None
+    self._tta_fn = None
+    # A TFLite interpreter must not be invoked from several threads at once.
+    self._interpreter_lock = threading.Lock()
 
     mixed_precision = self.params.get('mixed_precision', None)
     precision = utils.get_precision(
@@ -246,6 +266,82 @@ class ServingDriver:
       test_func(image_arrays)
       tf.profiler.experimental.stop()
 
+  def profile(self, image_arrays, warmup_runs=3, bm_runs=10):
+    """Profile the latency of each inference stage.
+
+    The stages are preprocess, backbone (with the extra resampled levels),
+    fpn, heads and postprocess, each run as its own tf.function. Preprocess and
+    postprocess are skipped for only_network models.
+
+    Args:
+      image_arrays: a batch of images with shape [batch, height, width, 3].
+      warmup_runs: Number of warmup runs.
+      bm_runs: Number of benchmark runs.
+
+    Returns:
+      A dict from stage name (and 'total') to latency stats in ms: mean, std,
+      min, max and p50/p90/p99.
+    """
+    model = self.model
+    if not isinstance(model, efficientdet_keras.EfficientDetNet):
+      raise ValueError('Profiling needs a keras EfficientDetNet.')
+    config = model.config
+    stage_fns = collections.OrderedDict()
+    # pylint: disable=protected-access
+    if isinstance(model, efficientdet_keras.EfficientDetModel):
+      inputs = (image_arrays,)
+      stage_fns['preprocess'] = tf.function(lambda images: tuple(
+          model._preprocessing(images, config.image_size, 'infer')))
+    else:
+      inputs = (image_arrays, None)
+
+    # Same as EfficientDetNet.call, split into stages.
+    def backbone(images, scales):
+      all_feats = model.backbone(images, training=False, features_only=True)
+      feats = all_feats[config.min_level:config.max_level + 1]
+      for resample_layer in model.resample_layers:
+        feats.append(resample_layer(feats[-1], False, None))
+      return feats, scales
+
+    stage_fns['backbone'] = tf.function(backbone)
+    stage_fns['fpn'] = tf.function(
+        lambda feats, scales: (model.fpn_cells(feats, False), scales))
+    stage_fns['heads'] = tf.function(
+        lambda feats, scales: (model.class_net(feats, False),
+                               model.box_net(feats, False), scales))
+    if isinstance(model, efficientdet_keras.EfficientDetModel):
+      stage_fns['postprocess'] = tf.function(
+          lambda cls_outputs, box_outputs, scales: model._postprocess(
+              cls_outputs, box_outputs, scales, 'global'))
+    # pylint: enable=protected-access
+
+    latencies = collections.defaultdict(list)
+    for run in range(warmup_runs + bm_runs):
+      outputs, run_start = inputs, time.perf_counter()
+      for name, stage_fn in stage_fns.items():
+        start = time.perf_counter()
+        outputs = stage_fn(*outputs)
+        # Wait for the stage to finish before stopping the clock.
+        tf.nest.flatten(outputs)[0].numpy()
+        if run >= warmup_runs:
+          latencies[name].append(time.perf_counter() - start)
+      if run >= warmup_runs:
+        latencies['total'].append(time.perf_counter() - run_start)
+
+    stats = {}
+    for name, seconds in latencies.items():
+      ms = np.array(seconds) * 1000.
+      stats[name] = {
+          'mean_ms': float(np.mean(ms)),
+          'std_ms': float(np.std(ms)),
+          'min_ms': float(np.min(ms)),
+          'max_ms': float(np.max(ms)),
+          'p50_ms': float(np.percentile(ms, 50)),
+          'p90_ms': float(np.percentile(ms, 90)),
+          'p99_ms': float(np.percentile(ms, 99)),
+      }
+    return stats
+
   def serve(self, image_arrays):
     """Serve a list of image arrays.
 
@@ -259,11 +355,123 @@ class ServingDriver:
     if isinstance(self.model, tf.lite.Interpreter):
       input_details = self.model.get_input_details()
       output_details = self.model.get_output_details()
-      self.model.set_tensor(input_details[0]['index'], np.array(image_arrays))
-      self.model.invoke()
-      return [self.model.get_tensor(x['index']) for x in output_details]
+      with self._interpreter_lock:
+        self.model.set_tensor(input_details[0]['index'],
+                              np.array(image_arrays))
+        self.model.invoke()
+        return [self.model.get_tensor(x['index']) for x in output_details]
     return self.model(image_arrays)  # pylint: disable=not-callable
 
+  def serve_tiled(self,
+                  image_array,
+                  tile_size=None,
+                  overlap: float = 0.25,
+                  merge: Text = 'nms',
+                  max_output_size: int = None):
+    """Serve a large image as overlapping tiles at model resolution.
+
+    Tiles are cut from the raw image and run through the model in batches of
+    batch_size, so the peak memory is bounded by one batch of tiles. Their
+    detections are moved to image coordinates, and duplicates across tile
+    seams are merged by per class nms or weighted box fusion.
+
+    Args:
+      image_array: an image with shape [height, width, 3].
+      tile_size: tile size such as 640 or '640x384'. If None, use the model
+        image size.
+      overlap: fraction of a tile shared with its neighbors.
+      merge: how to merge the detections of all tiles, 'nms' or 'wbf'.
+      max_output_size: max number of detections. If None, use the
+        max_output_size of nms_configs.
+
+    Returns:
+      A list of detections (boxes, scores, classes, valid_len) with a batch
+      dimension of 1, like serve().
+    """
+    if merge not in ('nms', 'wbf'):
+      raise ValueError('Invalid merge method {}'.format(merge))
+    if not 0 <= overlap < 1:
+      raise ValueError('overlap must be in [0, 1): {}'.format(overlap))
+    params = copy.deepcopy(self.params)
+    if max_output_size:
+      params['nms_configs']['max_output_size'] = max_output_size
+    max_output_size = params['nms_configs']['max_output_size']
+    image_array = np.asarray(image_array)
+    height, width = image_array.shape[:2]
+    tile_height, tile_width = utils.parse_image_size(tile_size or
+                                                     params['image_size'])
+    offsets = [(y, x) for y in _tile_offsets(height, tile_height, overlap)
+               for x in _tile_offsets(width, tile_width, overlap)]
+
+    batch_size = self.batch_size or 1
+    tiles = np.zeros((batch_size, tile_height, tile_width, 3),
+                     dtype=image_array.dtype)
+    all_boxes, all_scores, all_classes = [], [], []
+    for start in range(0, len(offsets), batch_size):
+      batch_offsets = offsets[start:start + batch_size]
+      tiles[:] = 0
+      for tile, (y, x) in zip(tiles, batch_offsets):
+        crop = image_array[y:y + tile_height, x:x + tile_width]
+        tile[:crop.shape[0], :crop.shape[1]] = crop
+      boxes, scores, classes, valid_lens = tf.nest.map_structure(
+          np.asarray, self.serve(tiles))
+      for i, (y, x) in enumerate(batch_offsets):
+        valid_len = int(valid_lens[i])
+        all_boxes.append(boxes[i, :valid_len] + [y, x, y, x])
+        all_scores.append(scores[i, :valid_len])
+        all_classes.append(classes[i, :valid_len])
+
+    boxes = np.clip(
+        np.concatenate(all_boxes), 0,
+        [height, width, height, width]).astype(np.float32)
+    scores = np.concatenate(all_scores).astype(np.float32)
+    classes = np.concatenate(all_classes).astype(np.float32)
+    if not len(boxes):  # pylint: disable=g-explicit-length-test
+      return [
+          np.zeros((1, max_output_size, 4), np.float32),
+          np.zeros((1, max_output_size), np.float32),
+          np.zeros((1, max_output_size), np.float32),
+          np.zeros((1,), np.int32)
+      ]
+    classes -= postprocess.CLASS_OFFSET
+    if merge == 'nms':
+      outputs = postprocess.class_offset_nms(params, boxes, scores, classes)
+      outputs = tf.nest.map_structure(np.asarray, outputs)
+      boxes, scores, classes, valid_len = outputs
+    else:
+      detections = np.concatenate([
+          np.zeros_like(scores)[:, None], boxes, scores[:, None],
+          classes[:, None]
+      ], 1)
+      # Seed the clusters with the highest scoring detections, as in WBF.
+      detections = detections[np.argsort(-scores, kind='stable')]
+      detections = np.asarray(
+          wbf.ensemble_detections(params, detections, 1))[:max_output_size]
+      valid_len = len(detections)
+      detections = np.pad(detections,
+                          [[0, max_output_size - valid_len], [0, 0]])
+      boxes, scores = detections[:, 1:5], detections[:, 5]
+      classes = detections[:, 6] + postprocess.CLASS_OFFSET
+    return [boxes[None], scores[None], classes[None], np.array([valid_len])]
+
+  def serve_tta(self, image_arrays, scales=(1.0,), flip: bool = True):
+    """Serve images with test time augmentation in one traced function.
+
+    Args:
+      image_arrays: a batch of images with shape [batch, height, width, 3].
+      scales: factors of the image scale of the augmented views.
+      flip: whether to add horizontally flipped views.
+
+    Returns:
+      A list of detections fused by weighted box fusion, like serve().
+    """
+    if not isinstance(self.model, efficientdet_keras.EfficientDetModel):
+      raise ValueError('Test time augmentation needs an EfficientDetModel.')
+    if not self._tta_fn:
+      self._tta_fn = tf.function(self.model.call_tta)
+    return self._tta_fn(
+        tf.convert_to_tensor(image_arrays), tuple(scales), flip)
+
   def load(self, saved_model_dir_or_frozen_graph: Text):
     """Load the model using saved model or a frozen graph."""
     # Load saved model if it is a folder.
@@ -330,7 +538,8 @@ class ServingDriver:
              tensorrt: Text = None,
              tflite: Text = None,
              file_pattern: Text = None,
-             num_calibration_steps: int = 2000):
+             num_calibration_steps: int = 2000,
+             image_size_buckets=None):
     """Export a saved model, frozen graph, and potential tflite/tensorrt model.
 
     Args:
@@ -340,14 +549,29 @@ class ServingDriver:
       file_pattern: Glob for tfrecords, e.g. coco/val-*.tfrecord.
       num_calibration_steps: Number of post-training quantization calibration
         steps to run.
+      image_size_buckets: a list of smaller image sizes, such as 256 or
+        '640x384' (width x height). The saved model gets an extra signature
+        for each of them, named image_size_{width}x{height}, with
+        preprocessing and anchors of that size. Use BucketedServingDriver to
+        serve it.
     """
     export_model, input_spec = self._get_model_and_spec(tflite)
     image_size = utils.parse_image_size(self.params['image_size'])
     if output_dir:
-      tf.saved_model.save(
-          export_model,
-          output_dir,
-          signatures=export_model.__call__.get_concrete_function(input_spec))
+      signatures = export_model.__call__.get_concrete_function(input_spec)
+      if image_size_buckets:
+        if self.only_network or tflite:
+          raise ValueError('Image size buckets need pre and postprocessing.')
+        signatures = {'serving_default': signatures}
+        export_model.buckets = []
+        for bucket_size in image_size_buckets:
+          bucket_size = utils.parse_image_size(bucket_size)
+          bucket_model = ExportModel(self.model, image_size=bucket_size)
+          export_model.buckets.append(bucket_model)
+          name = BUCKET_SIGNATURE_PREFIX + '%dx%d' % bucket_size[::-1]
+          signatures[name] = bucket_model.__call__.get_concrete_function(
+              input_spec)
+      tf.saved_model.save(export_model, output_dir, signatures=signatures)
       logging.info('Model saved at %s', output_dir)
 
       # also save freeze pb file.
@@ -417,3 +641,767 @@ class ServingDriver:
       converter.convert()
       converter.save(trt_path)
       logging.info('TensorRT model is saved at %s', trt_path)
+
+
+class BucketedServingDriver:
+  """Serves a saved model exported with image size buckets.
+
+  Each batch runs on the smallest bucket that fits its image size without
+  upscaling, or on the full image size if none fits, so small images don't
+  pay for the compute of the full image size.
+
+  Example:
+
+    driver = inference.ServingDriver('efficientdet-d0', '/tmp/efficientdet-d0')
+    driver.export('/tmp/saved_model', image_size_buckets=[256, 384])
+    bucketed_driver = inference.BucketedServingDriver('/tmp/saved_model')
+    boxes, scores, classes, valid_len = bucketed_driver.serve(images)
+  """
+
+  def __init__(self, saved_model_dir: Text):
+    """Load the saved model and its image size buckets.
+
+    Args:
+      saved_model_dir: a saved model exported with image_size_buckets.
+    """
+    self.model = tf.saved_model.load(saved_model_dir)
+    self.buckets = []
+    for name in self.model.signatures:
+      if name.startswith(BUCKET_SIGNATURE_PREFIX):
+        size = utils.parse_image_size(name[len(BUCKET_SIGNATURE_PREFIX):])
+        self.buckets.append((size[0] * size[1], size, name))
+    self.buckets.sort()
+
+  def select_bucket(self, height, width):
+    """Returns the signature name of the images with the given size."""
+    for _, (bucket_height, bucket_width), name in self.buckets:
+      if height <= bucket_height and width <= bucket_width:
+        return name
+    return 'serving_default'
+
+  def serve(self, image_arrays):
+    """Serve a batch of images with the same size.
+
+    Args:
+      image_arrays: a batch of uint8 images with shape [batch, height, width,
+        3].
+
+    Returns:
+      A list of detections, like ServingDriver.serve().
+    """
+    image_arrays = tf.convert_to_tensor(image_arrays, dtype=tf.uint8)
+    height, width = image_arrays.shape[1:3]
+    outputs = self.model.signatures[self.select_bucket(height, width)](
+        image_arrays)
+    return [outputs['output_%d' % i] for i in range(len(outputs))]
+
+
+class BatchingServingDriver:
+  """Dynamically batches concurrent single image requests for a driver.
+
+  Requests are queued and a worker thread forms batches of up to batch_size
+  images with the same shape, or fewer once the oldest request has waited
+  max_wait_ms. Each batch is padded to batch_size so it matches the shape the
+  model was built or exported with, and each caller gets its own slice of the
+  outputs.
+
+  Example:
+
+    driver = inference.ServingDriver(
+      'efficientdet-d0', '/tmp/efficientdet-d0', batch_size=8)
+    batcher = inference.BatchingServingDriver(driver, max_wait_ms=5)
+    # Called concurrently from request handler threads.
+    boxes, scores, classes, valid_len = batcher.serve(image)
+    ...
+    batcher.close()
+  """
+
+  def __init__(self, driver: ServingDriver, max_wait_ms: float = 5.0):
+    """Initialize the batcher and start its worker thread.
+
+    Args:
+      driver: a ServingDriver, used with its serve() and batch_size.
+      max_wait_ms: max time in milliseconds a request waits for a batch to
+        fill up.
+    """
+    self.driver = driver
+    self.batch_size = driver.batch_size
+    self.max_wait = max_wait_ms / 1000.
+    self._queue = collections.deque()
+    self._cond = threading.Condition()
+    self._closed = False
+    self._num_batches = 0
+    self._num_images = 0
+    self._worker = threading.Thread(target=self._run, daemon=True)
+    self._worker.start()
+
+  def submit(self, image_array) -> concurrent.futures.Future:
+    """Queues an image and returns a future of its detections.
+
+    Args:
+      image_array: image content with shape [height, width, 3].
+
+    Returns:
+      A future resolving to the driver outputs of this image, without the
+      batch dimension.
+    """
+    future = concurrent.futures.Future()
+    with self._cond:
+      if self._closed:
+        raise RuntimeError('Cannot submit to a closed batcher.')
+      self._queue.append((np.asarray(image_array), future, time.monotonic()))
+      self._cond.notify()
+    return future
+
+  def serve(self, image_array):
+    """Serve a single image array, blocking until its batch is done."""
+    return self.submit(image_array).result()
+
+  def stats(self):
+    """Returns the queue depth and how full the batches were on average."""
+    with self._cond:
+      capacity = self._num_batches * self.batch_size
+      return {
+          'queue_depth': len(self._queue),
+          'num_batches': self._num_batches,
+          'batch_fill_ratio': self._num_images / capacity if capacity else 0.,
+      }
+
+  def close(self):
+    """Serves the queued requests and stops the worker thread."""
+    with self._cond:
+      self._closed = True
+      self._cond.notify()
+    self._worker.join()
+
+  def _next_batch(self):
+    """Waits for and pops the next batch of requests with the same shape.
+
+    Requests cancelled by their callers are dropped, so the batch may be
+    empty.
+
+    Returns:
+      A list of requests whose futures are claimed, or None once closed and
+      drained.
+    """
+    with self._cond:
+      while not self._queue and not self._closed:
+        self._cond.wait()
+      if not self._queue:
+        return None
+      shape = self._queue[0][0].shape
+      deadline = self._queue[0][2] + self.max_wait
+      while not self._closed:
+        same_shape = sum(r[0].shape == shape for r in self._queue)
+        timeout = deadline - time.monotonic()
+        if same_shape >= self.batch_size or timeout <= 0:
+          break
+        self._cond.wait(timeout)
+      batch, rest = [], collections.deque()
+      for request in self._queue:
+        if len(batch) < self.batch_size and request[0].shape == shape:
+          # False if the caller cancelled the request; drop it.
+          if request[1].set_running_or_notify_cancel():
+            batch.append(request)
+        else:
+          rest.append(request)
+      self._queue = rest
+      if batch:
+        self._num_batches += 1
+        self._num_images += len(batch)
+      return batch
+
+  def _run(self):
+    """Forms batches and runs them until closed."""
+    while True:
+      batch = self._next_batch()
+      if batch is None:
+        return
+      if not batch:
+        continue
+      images = np.stack([r[0] for r in batch])
+      if len(batch) < self.batch_size:
+        padding = np.zeros((self.batch_size - len(batch),) + images.shape[1:],
+                           dtype=images.dtype)
+        images = np.concatenate([images, padding])
+      try:
+        outputs = tf.nest.map_structure(np.asarray,
+                                        self.driver.serve(images))
+      except Exception as e:  # pylint: disable=broad-except
+        for _, future, _ in batch:
+          _resolve(future, exception=e)
+        continue
+      for i, (_, future, _) in enumerate(batch):
+        _resolve(future,
+                 result=tf.nest.map_structure(operator.itemgetter(i), outputs))
+
+
+class LatencyHistogram:
+  """A thread-safe histogram of latencies with exponential buckets."""
+
+  def __init__(self, min_ms: float = 0.1, max_ms: float = 1e5,
+               growth: float = 1.25):
+    self.bounds = []
+    bound = min_ms
+    while bound < max_ms:
+      self.bounds.append(bound)
+      bound *= growth
+    self.counts = [0] * (len(self.bounds) + 1)
+    self.count = 0
+    self.total_ms = 0.
+    self.observed_max_ms = 0.
+    self._lock = threading.Lock()
+
+  def record(self, seconds: float):
+    """Records a latency in seconds."""
+    ms = seconds * 1000.
+    with self._lock:
+      self.counts[bisect.bisect_left(self.bounds, ms)] += 1
+      self.count += 1
+      self.total_ms += ms
+      self.observed_max_ms = max(self.observed_max_ms, ms)
+
+  def percentile(self, q: float) -> float:
+    """Returns the bucket upper bound in ms of the q-th percentile."""
+    with self._lock:
+      return self._percentile(q)
+
+  def summary(self):
+    """Returns the count, mean, max and p50/p90/p99 latencies in ms."""
+    with self._lock:
+      return {
+          'count': self.count,
+          'mean_ms': self.total_ms / self.count if self.count else 0.,
+          'max_ms': self.observed_max_ms,
+          'p50_ms': self._percentile(50),
+          'p90_ms': self._percentile(90),
+          'p99_ms': self._percentile(99),
+      }
+
+  def _percentile(self, q):
+    """Like percentile(), with the lock held."""
+    rank, seen = q / 100. * self.count, 0
+    for i, count in enumerate(self.counts):
+      seen += count
+      if count and seen >= rank:
+        # Latencies above the last bound are reported as the observed max.
+        return self.bounds[i] if i < len(self.bounds) else self.observed_max_ms
+    return 0.
+
+
+class PipelinedServingDriver:
+  """Serves a keras ServingDriver model as a pipeline of three stages.
+
+  Host preprocessing (decode/resize), the network forward pass and the
+  postprocessing (box decoding and nms) run on separate thread pools connected
+  by bounded queues, so batch N+1 is preprocessed while batch N is in the
+  network and batch N-1 is in nms.
+
+  Example:
+
+    driver = inference.ServingDriver('efficientdet-d0', '/tmp/efficientdet-d0')
+    pipeline = inference.PipelinedServingDriver(driver)
+    # In a coroutine, with many concurrent requests.
+    boxes, scores, classes, valid_len = await pipeline.serve(images)
+    ...
+    pipeline.close()
+    print(pipeline.stats())
+  """
+
+  STAGES = ('preprocess', 'network', 'postprocess')
+
+  def __init__(self,
+               driver: ServingDriver,
+               num_workers: int = 1,
+               queue_size: int = 2,
+               post_mode: Text = 'global'):
+    """Initialize the pipeline and start its stage workers.
+
+    Args:
+      driver: a ServingDriver with a keras EfficientDetModel, e.g. not loaded
+        from a SavedModel.
+      num_workers: number of worker threads of each stage.
+      queue_size: max number of batches waiting for each stage.
+      post_mode: postprocessing mode, must be {'global', 'per_class'}.
+    """
+    model = driver.model
+    if not isinstance(model, efficientdet_keras.EfficientDetModel):
+      raise ValueError('Pipelined serving needs an EfficientDetModel.')
+    image_size = model.config.image_size
+    # pylint: disable=protected-access
+
+    @tf.function(experimental_relax_shapes=True)
+    def preprocess(images):
+      with tf.device('/cpu:0'):
+        return model._preprocessing(images, image_size, 'infer')
+
+    @tf.function
+    def network(images, scales):
+      cls_outputs, box_outputs = model(
+          images, training=False, pre_mode=None, post_mode=None)[:2]
+      return cls_outputs, box_outputs, scales
+
+    @tf.function
+    def postprocess(cls_outputs, box_outputs, scales):
+      return model._postprocess(cls_outputs, box_outputs, scales, post_mode)
+
+    # pylint: enable=protected-access
+    self._stage_fns = (preprocess, network, postprocess)
+    self._queues = [queue.Queue(queue_size) for _ in self.STAGES]
+    self._lock = threading.Lock()
+    self._closed = False
+    self.histograms = {name: LatencyHistogram() for name in self.STAGES}
+    self.histograms['total'] = LatencyHistogram()
+    self._workers = [[
+        threading.Thread(target=self._run_stage, args=(i,), daemon=True)
+        for _ in range(num_workers)
+    ] for i in range(len(self.STAGES))]
+    for workers in self._workers:
+      for worker in workers:
+        worker.start()
+
+  def submit(self, image_arrays) -> concurrent.futures.Future:
+    """Queues a batch of images, blocking while the first queue is full.
+
+    Args:
+      image_arrays: a batch of images with shape [batch, height, width, 3].
+
+    Returns:
+      A future resolving to the detections of the batch, like
+      ServingDriver.serve().
+    """
+    future = concurrent.futures.Future()
+    with self._lock:
+      if self._closed:
+        raise RuntimeError('Cannot submit to a closed pipeline.')
+      self._queues[0].put((future, (image_arrays,), time.perf_counter()))
+    return future
+
+  async def serve(self, image_arrays):
+    """Serves a batch of images without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    future = await loop.run_in_executor(None, self.submit, image_arrays)
+    return await asyncio.wrap_future(future)
+
+  def stats(self):
+    """Returns the latency summary of each stage and of whole requests."""
+    return {name: h.summary() for name, h in self.histograms.items()}
+
+  def close(self):
+    """Finishes the queued batches and stops all stage workers."""
+    with self._lock:
+      self._closed = True
+    for q, workers in zip(self._queues, self._workers):
+      for _ in workers:
+        q.put(None)
+      for worker in workers:
+        worker.join()
+
+  def _run_stage(self, index):
+    """Runs a stage on batches from its queue until it gets None."""
+    stage_fn = self._stage_fns[index]
+    histogram = self.histograms[self.STAGES[index]]
+    is_last = index == len(self.STAGES) - 1
+    while True:
+      item = self._queues[index].get()
+      if item is None:
+        return
+      future, args, start = item
+      # Once claimed by the first stage, a request can no longer be
+      # cancelled; requests cancelled before are dropped.
+      if index == 0 and not future.set_running_or_notify_cancel():
+        continue
+      stage_start = time.perf_counter()
+      try:
+        outputs = stage_fn(*args)
+      except Exception as e:  # pylint: disable=broad-except
+        _resolve(future, exception=e)
+        continue
+      end = time.perf_counter()
+      histogram.record(end - stage_start)
+      if is_last:
+        self.histograms['total'].record(end - start)
+        _resolve(future, result=outputs)
+      else:
+        self._queues[index + 1].put((future, outputs, start))
+
+
+class VideoPipeline:
+  """Runs detection over a stream of video frames with threaded stages.
+
+  A reader thread pulls frames from an iterator, such as a cv2.VideoCapture
+  loop, a serving thread groups them into batches for the driver, a thread pool
+  draws the detections, and the calling thread passes the drawn frames to a
+  sink in their original order, so the sink may use APIs bound to the main
+  thread such as cv2.imshow. The stages are connected by bounded queues, so a
+  slow encoder or model blocks the reader instead of buffering the video.
+
+  With frame_stride > 1 only every frame_stride-th frame is a keyframe sent to
+  the model, and the frames in between are drawn with the detections of their
+  last keyframe.
+
+  Example:
+
+    driver = inference.ServingDriver(
+      'efficientdet-d0', '/tmp/efficientdet-d0', batch_size=4)
+    pipeline = inference.VideoPipeline(driver, frame_stride=2)
+    stats = pipeline.run(read_frames(cap), out_ptr.write)
+    print('%.1f fps' % stats['fps'])
+  """
+
+  def __init__(self,
+               driver: ServingDriver,
+               batch_size: int = None,
+               frame_stride: int = 1,
+               num_workers: int = 2,
+               queue_size: int = 16,
+               **kwargs):
+    """Initialize the pipeline.
+
+    Args:
+      driver: a ServingDriver, used with its serve() and visualize().
+      batch_size: number of keyframes per serve() call. If None, use the
+        batch size of the driver, or 1.
+      frame_stride: run the model on every frame_stride-th frame only.
+      num_workers: number of visualization threads.
+      queue_size: max number of frames waiting for each stage.
+      **kwargs: extra parameters for driver.visualize().
+    """
+    if frame_stride < 1:
+      raise ValueError('frame_stride must be positive: %d' % frame_stride)
+    self.driver = driver
+    self.batch_size = batch_size or driver.batch_size or 1
+    self.frame_stride = frame_stride
+    self.num_workers = num_workers
+    self.queue_size = queue_size
+    self.kwargs = kwargs
+
+  def run(self, frames, write_fn):
+    """Runs all frames through the pipeline.
+
+    Args:
+      frames: an iterable of frames with shape [height, width, 3].
+      write_fn: called on the calling thread with each drawn frame in order.
+        Returning True stops reading more frames, e.g. when the user closes an
+        online display.
+
+    Returns:
+      A dict with the number of frames and keyframes, the elapsed seconds and
+      the sustained frames per second.
+    """
+    read_queue = queue.Queue(self.queue_size)
+    write_queue = queue.Queue(self.queue_size)
+    stop = threading.Event()
+    errors = []
+    counts = collections.Counter()
+
+    def read():
+      try:
+        for frame in frames:
+          if stop.is_set():
+            break
+          read_queue.put(np.asarray(frame))
+      except Exception as e:  # pylint: disable=broad-except
+        errors.append(e)
+      finally:
+        read_queue.put(None)
+
+    def serve():
+      groups, done = [], False
+      try:
+        with concurrent.futures.ThreadPoolExecutor(
+            self.num_workers) as executor:
+          while not done:
+            frame = read_queue.get()
+            done = frame is None
+            if not done:
+              if counts['read'] % self.frame_stride == 0:
+                groups.append([])
+              groups[-1].append(frame)
+              counts['read'] += 1
+            if stop.is_set():
+              continue
+            # A batch is complete once the keyframe after it is read, so that
+            # all frames following its last keyframe are in the batch.
+            if len(groups) > self.batch_size or (done and groups):
+              batch = groups[:self.batch_size]
+              groups = groups[self.batch_size:]
+              self._serve_and_draw(batch, executor, write_queue)
+              counts['keyframes'] += len(batch)
+      except Exception as e:  # pylint: disable=broad-except
+        errors.append(e)
+        stop.set()
+      finally:
+        # Unblock the reader and let it stop.
+        while not done:
+          done = read_queue.get() is None
+        write_queue.put(None)
+
+    start = time.perf_counter()
+    reader = threading.Thread(target=read, daemon=True)
+    server = threading.Thread(target=serve, daemon=True)
+    reader.start()
+    server.start()
+    done = False
+    try:
+      while not done:
+        future = write_queue.get()
+        done = future is None
+        if done or errors or stop.is_set():
+          continue
+        try:
+          if write_fn(future.result()):
+            stop.set()
+          counts['frames'] += 1
+        except Exception as e:  # pylint: disable=broad-except
+          errors.append(e)
+          stop.set()
+    finally:
+      if not done:
+        # Unblock the serving thread and let it stop.
+        stop.set()
+        while write_queue.get() is not None:
+          pass
+      server.join()
+      reader.join()
+    if errors:
+      raise errors[0]
+    elapsed = time.perf_counter() - start
+    return {
+        'frames': counts['frames'],
+        'keyframes': counts['keyframes'],
+        'elapsed': elapsed,
+        'fps': counts['frames'] / elapsed if elapsed else 0.,
+    }
+
+  def _serve_and_draw(self, groups, executor, write_queue):
+    """Serves the keyframes of groups and queues drawing all their frames."""
+    images = np.stack([group[0] for group in groups])
+    if len(groups) < self.batch_size:
+      # Repeat the last keyframe so that the batch has a fixed shape.
+      images = np.concatenate(
+          [images] + [images[-1:]] * (self.batch_size - len(groups)))
+    boxes, scores, classes, _ = tf.nest.map_structure(
+        np.asarray, self.driver.serve(images))
+    for i, group in enumerate(groups):
+      for frame in group:
+        write_queue.put(
+            executor.submit(self.driver.visualize, frame, boxes[i], classes[i],
+                            scores[i], **self.kwargs))
+
+
+class ModelRegistry:
+  """Keeps several served models warm within a memory budget.
+
+  Models are registered by name with the path of a saved model, frozen graph
+  or TFLite file, and loaded on first use or by load(). Loading runs warmup
+  batches for the configured batch sizes, so the first request does not pay for
+  the function initialization. Names registered with the same path share one
+  loaded model, and TFLite models are memory-mapped from their files. When the
+  total size of the loaded models exceeds the budget, the least recently used
+  models are unloaded. Models load outside the registry lock, so a miss does
+  not block requests to loaded models, and concurrent misses on the same path
+  wait for a single load.
+
+  Example:
+
+    registry = inference.ModelRegistry(memory_budget_bytes=2 << 30)
+    registry.register('a/efficientdet-d0', '/tmp/d0_saved_model',
+                      batch_sizes=[1, 8])
+    registry.register('b/efficientdet-d0', '/tmp/d0_saved_model')
+    registry.register('b/efficientdet-d4', '/tmp/d4_saved_model',
+                      model_name='efficientdet-d4')
+    registry.load('a/efficientdet-d0')
+    boxes, scores, classes, valid_len = registry.serve('b/efficientdet-d0',
+                                                       images)
+    print(registry.stats())
+  """
+
+  def __init__(self, memory_budget_bytes: int = None):
+    """Initialize an empty registry.
+
+    Args:
+      memory_budget_bytes: max total size of the loaded models, measured by
+        their file sizes. None means no limit.
+    """
+    self.memory_budget_bytes = memory_budget_bytes
+    self._configs = {}
+    # Loaded drivers and their sizes by path, from least recently used.
+    self._loaded = collections.OrderedDict()
+    # Futures of the drivers being loaded, by path.
+    self._loading = {}
+    self._lock = threading.RLock()
+    self._stats = collections.Counter()
+
+  def register(self,
+               name: Text,
+               path: Text,
+               model_name: Text = 'efficientdet-d0',
+               batch_sizes=(1,),
+               image_size=None):
+    """Register a model without loading it.
+
+    Args:
+      name: the name to serve the model with.
+      path: a saved model dir, a frozen graph or a TFLite file.
+      model_name: the model name, such as efficientdet-d0, for its config.
+      batch_sizes: batch sizes to warm up. TFLite models are warmed up with
+        their own input shape.
+      image_size: image size of the warmup batches for inputs with unknown
+        height and width. If None, use the image size of model_name.
+    """
+    with self._lock:
+      self._configs[name] = dict(
+          path=path,
+          model_name=model_name,
+          batch_sizes=tuple(batch_sizes),
+          image_size=image_size)
+
+  def get(self, name: Text) -> ServingDriver:
+    """Returns the loaded driver of the model, loading it on a miss."""
+    with self._lock:
+      config = self._configs[name]
+      path = config['path']
+      if path in self._loaded:
+        self._stats['hits'] += 1
+        self._loaded.move_to_end(path)
+        return self._loaded[path][0]
+      self._stats['misses'] += 1
+      future = self._loading.get(path)
+      if future is None:
+        future = self._loading[path] = concurrent.futures.Future()
+        is_loader = True
+      else:
+        is_loader = False
+    if not is_loader:
+      return future.result()
+
+    try:
+      driver = self._load_and_warmup(config)
+      size = _file_size(path)
+    except Exception as e:  # pylint: disable=broad-except
+      with self._lock:
+        del self._loading[path]
+      future.set_exception(e)
+      raise
+    with self._lock:
+      del self._loading[path]
+      self._loaded[path] = (driver, size)
+      self._evict(keep=path)
+    future.set_result(driver)
+    return driver
+
+  def load(self, name: Text):
+    """Loads and warms up the model if it is not loaded."""
+    self.get(name)
+
+  def serve(self, name: Text, image_arrays):
+    """Serves a batch of images with the named model."""
+    return self.get(name).serve(image_arrays)
+
+  def unload(self, name: Text):
+    """Unloads the model of name, and of all names sharing its path."""
+    with self._lock:
+      self._loaded.pop(self._configs[name]['path'], None)
+
+  def stats(self):
+    """Returns the hit/miss, load, warmup and eviction counters."""
+    with self._lock:
+      stats = dict(self._stats)
+      stats['loaded_models'] = len(self._loaded)
+      stats['loaded_bytes'] = sum(size for _, size in self._loaded.values())
+      return stats
+
+  def _load_and_warmup(self, config):
+    """Loads a driver and runs a warmup batch for each batch size.
+
+    Called without the registry lock, so that a load does not block requests
+    to other models.
+    """
+    start = time.perf_counter()
+    driver = ServingDriver(config['model_name'])
+    driver.load(config['path'])
+    load_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    image_size = utils.parse_image_size(config['image_size'] or
+                                        driver.params['image_size'])
+    if isinstance(driver.model, tf.lite.Interpreter):
+      input_details = driver.model.get_input_details()[0]
+      warmup_inputs = [
+          np.zeros(input_details['shape'], dtype=input_details['dtype'])
+      ]
+    else:
+      if hasattr(driver.model, 'signatures'):
+        spec = tf.nest.flatten(driver.model.signatures['serving_default']
+                               .structured_input_signature)[0]
+      else:
+        spec = driver.model.inputs[0]
+      warmup_inputs = []
+      for batch_size in config['batch_sizes']:
+        shape = spec.shape.as_list()
+        if shape[0] not in (None, batch_size):
+          logging.warning('Skip warmup of batch size %d for %s with batch size '
+                          '%d.', batch_size, config['path'], shape[0])
+          continue
+        # Use image_size only for unknown height and width.
+        shape = [batch_size] + [
+            dim or size for dim, size in zip(shape[1:3], image_size)
+        ] + [3]
+        warmup_inputs.append(np.zeros(shape, dtype=spec.dtype.as_numpy_dtype))
+    for warmup_input in warmup_inputs:
+      driver.serve(warmup_input)
+    with self._lock:
+      self._stats['loads'] += 1
+      self._stats['load_time'] += load_time
+      self._stats['warmups'] += len(warmup_inputs)
+      self._stats['warmup_time'] += time.perf_counter() - start
+    return driver
+
+  def _evict(self, keep):
+    """Unloads least recently used models until the budget is met."""
+    if self.memory_budget_bytes is None:
+      return
+    loaded_bytes = sum(size for _, size in self._loaded.values())
+    for path in list(self._loaded):
+      if loaded_bytes <= self.memory_budget_bytes:
+        break
+      if path == keep:
+        continue
+      loaded_bytes -= self._loaded.pop(path)[1]
+      self._stats['evictions'] += 1
+      logging.info('Evicted %s from the model registry.', path)
+
+
+def _resolve(future, result=None, exception=None):
+  """Sets the result or exception of a future unless it is already done."""
+  try:
+    if exception is not None:
+      future.set_exception(exception)
+    else:
+      future.set_result(result)
+  except concurrent.futures.InvalidStateError:
+    logging.warning('Dropped the outputs of a request that was already done.')
+
+
+def _tile_offsets(size, tile_size, overlap):
+  """Returns the start offsets of tiles covering size with some overlap."""
+  if size <= tile_size:
+    return [0]
+  stride = max(int(tile_size * (1 - overlap)), 1)
+  num_tiles = -(-(size - tile_size) // stride) + 1
+  # Spread the tiles evenly, so the last one ends at the image border.
+  return [
+      int(round(i * (size - tile_size) / (num_tiles - 1)))
+      for i in range(num_tiles)
+  ]
+
+
+def _file_size(path):
+  """Returns the size of a file, or of all files in a directory."""
+  if not tf.io.gfile.isdir(path):
+    return tf.io.gfile.stat(path).length
+  return sum(
+      tf.io.gfile.stat(os.path.join(dirname, filename)).length
+      for dirname, _, filenames in tf.io.gfile.walk(path)
+      for filename in filenames)
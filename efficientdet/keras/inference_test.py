@@ -13,9 +13,14 @@
 # limitations under the License.
 # ==============================================================================
 r"""Inference test cases."""
+import asyncio
+import concurrent.futures
 import os
 import tempfile
+import threading
+import time
 from absl import logging
+import numpy as np
 import tensorflow as tf
 import test_util
 from keras import efficientdet_keras
@@ -40,6 +45,94 @@ class InferenceTest(tf.test.TestCase):
     driver.load(saved_model_path)
     driver.load(os.path.join(saved_model_path, 'efficientdet-d0_frozen.pb'))
 
+  def test_export_image_size_buckets(self):
+    saved_model_path = os.path.join(self.tmp_path, 'saved_model')
+    driver = inference.ServingDriver('efficientdet-d0', self.tmp_path)
+    driver.export(saved_model_path, image_size_buckets=[256, '384x640'])
+    bucketed_driver = inference.BucketedServingDriver(saved_model_path)
+    self.assertEqual(bucketed_driver.select_bucket(200, 250),
+                     'image_size_256x256')
+    self.assertEqual(bucketed_driver.select_bucket(200, 300),
+                     'image_size_384x640')
+    self.assertEqual(bucketed_driver.select_bucket(720, 1280),
+                     'serving_default')
+    images = np.random.RandomState(0).randint(
+        0, 255, size=(1, 200, 250, 3), dtype=np.uint8)
+    expected = driver.model(images, image_size=(256, 256))
+    outputs = bucketed_driver.serve(images)
+    self.assertAllClose(outputs[0], expected[0], atol=1e-3)
+    self.assertAllClose(outputs[1], expected[1], atol=1e-5)
+    self.assertAllEqual(outputs[2], expected[2])
+
+  def test_model_registry(self):
+    saved_model_path = os.path.join(self.tmp_path, 'saved_model')
+    driver = inference.ServingDriver(
+        'efficientdet-lite0', self.tmp_path, batch_size=None)
+    driver.export(saved_model_path)
+    tflite_dir = os.path.join(self.tmp_path, 'tflite')
+    driver = inference.ServingDriver('efficientdet-lite0', self.tmp_path)
+    driver.export(tflite_dir, tflite='FP32')
+    tflite_path = os.path.join(tflite_dir, 'fp32.tflite')
+    registry = inference.ModelRegistry(
+        memory_budget_bytes=inference._file_size(saved_model_path))
+    registry.register('a', saved_model_path, 'efficientdet-lite0', [1, 2])
+    registry.register('b', saved_model_path, 'efficientdet-lite0')
+    registry.register('c', tflite_path, 'efficientdet-lite0')
+    registry.load('a')
+    self.assertEqual(registry.stats()['warmups'], 2)
+    images = np.zeros((2, 320, 320, 3), dtype=np.uint8)
+    self.assertLen(registry.serve('b', images), 4)
+    registry.load('c')  # evicts the saved model.
+    registry.load('a')  # evicts the tflite model.
+    stats = registry.stats()
+    self.assertEqual(stats['hits'], 1)
+    self.assertEqual(stats['misses'], 3)
+    self.assertEqual(stats['loads'], 3)
+    self.assertEqual(stats['evictions'], 2)
+    self.assertEqual(stats['loaded_models'], 1)
+
+    # Concurrent requests to a TFLite model match serial ones.
+    images = np.random.RandomState(0).randint(
+        0, 255, size=(4, 1, 320, 320, 3)).astype(np.float32)
+    expected = [registry.serve('c', batch) for batch in images]
+    with concurrent.futures.ThreadPoolExecutor(4) as executor:
+      outputs = list(executor.map(lambda b: registry.serve('c', b), images))
+    for output, expected_output in zip(outputs, expected):
+      self.assertAllClose(output, expected_output)
+
+  def test_model_registry_concurrent_loads(self):
+    started, release = threading.Event(), threading.Event()
+    loads = []
+
+    class BlockingRegistry(inference.ModelRegistry):
+
+      def _load_and_warmup(self, config):
+        loads.append(config['path'])
+        if config['model_name'] == 'slow':
+          started.set()
+          release.wait()
+        return config['path']  # Stands in for the driver.
+
+    paths = [os.path.join(self.tmp_path, name) for name in ('fast', 'slow')]
+    for path in paths:
+      with open(path, 'w') as f:
+        f.write(path)
+    registry = BlockingRegistry()
+    registry.register('fast', paths[0], 'fast')
+    registry.register('slow', paths[1], 'slow')
+    registry.register('slow_alias', paths[1], 'slow')
+    registry.load('fast')
+    with concurrent.futures.ThreadPoolExecutor(3) as executor:
+      slow = [executor.submit(registry.get, n) for n in ('slow', 'slow_alias')]
+      started.wait()
+      # A hit is not blocked by the load of another model.
+      self.assertEqual(
+          executor.submit(registry.get, 'fast').result(timeout=10), paths[0])
+      release.set()
+      self.assertEqual([f.result() for f in slow], [paths[1]] * 2)
+    self.assertEqual(loads, paths)
+    self.assertEqual(registry.stats()['loaded_models'], 2)
+
   def test_export_tflite_only_network(self):
     saved_model_path = os.path.join(self.tmp_path, 'saved_model')
     driver = inference.ServingDriver(
@@ -124,6 +217,182 @@ class InferenceTest(tf.test.TestCase):
     self.assertEqual(classes.shape, (1, 100))
     self.assertEqual(valid_lens.shape, (1,))
 
+  def test_batching_serving_driver(self):
+    driver = inference.ServingDriver(
+        'efficientdet-d0', self.tmp_path, batch_size=2)
+    images = np.random.RandomState(0).randint(
+        0, 255, size=(3, 512, 512, 3), dtype=np.uint8)
+    expected = [driver.serve(images[i:i + 1]) for i in range(3)]
+    batcher = inference.BatchingServingDriver(driver, max_wait_ms=100)
+    with concurrent.futures.ThreadPoolExecutor(3) as executor:
+      outputs = list(executor.map(batcher.serve, images))
+    batcher.close()
+    for output, expected_output in zip(outputs, expected):
+      boxes, scores, classes, valid_len = output
+      self.assertEqual(boxes.shape, (100, 4))
+      self.assertAllClose(boxes, expected_output[0][0], atol=1e-3)
+      self.assertAllClose(scores, expected_output[1][0], atol=1e-5)
+      self.assertAllEqual(classes, expected_output[2][0])
+      self.assertEqual(valid_len, expected_output[3][0])
+    stats = batcher.stats()
+    self.assertEqual(stats['queue_depth'], 0)
+    self.assertEqual(stats['num_batches'], 2)
+    self.assertAllClose(stats['batch_fill_ratio'], 0.75)
+
+  def test_batching_serving_driver_cancel(self):
+    driver = inference.ServingDriver(
+        'efficientdet-d0', self.tmp_path, batch_size=2)
+    image = np.zeros((128, 128, 3), dtype=np.uint8)
+    batcher = inference.BatchingServingDriver(driver, max_wait_ms=100)
+    cancelled = batcher.submit(image)
+    self.assertTrue(cancelled.cancel())
+    # The cancelled request forms an empty batch, which must not stop the
+    # worker.
+    time.sleep(0.2)
+    outputs = batcher.submit(image).result(timeout=60)
+    batcher.close()
+    self.assertEqual(outputs[0].shape, (100, 4))
+    self.assertTrue(cancelled.cancelled())
+    self.assertEqual(batcher.stats()['num_batches'], 1)
+
+  def test_pipelined_serving_driver(self):
+    driver = inference.ServingDriver('efficientdet-d0', self.tmp_path)
+    images = np.random.RandomState(0).randint(
+        0, 255, size=(3, 1, 320, 480, 3), dtype=np.uint8)
+    expected = [driver.serve(batch) for batch in images]
+    pipeline = inference.PipelinedServingDriver(driver)
+
+    async def serve_all():
+      return await asyncio.gather(*[pipeline.serve(b) for b in images])
+
+    outputs = asyncio.run(serve_all())
+    pipeline.close()
+    for output, expected_output in zip(outputs, expected):
+      self.assertAllClose(output[0], expected_output[0], atol=1e-3)
+      self.assertAllClose(output[1], expected_output[1], atol=1e-5)
+      self.assertAllEqual(output[2], expected_output[2])
+      self.assertAllEqual(output[3], expected_output[3])
+    stats = pipeline.stats()
+    for stage in ('preprocess', 'network', 'postprocess', 'total'):
+      self.assertEqual(stats[stage]['count'], 3)
+      self.assertGreater(stats[stage]['p50_ms'], 0)
+
+  def test_pipelined_serving_driver_cancel(self):
+    driver = inference.ServingDriver('efficientdet-d0', self.tmp_path)
+    images = np.zeros((1, 128, 128, 3), dtype=np.uint8)
+    pipeline = inference.PipelinedServingDriver(driver)
+    for _ in range(3):
+      pipeline.submit(images).cancel()
+
+    async def serve_with_timeout():
+      try:
+        await asyncio.wait_for(pipeline.serve(images), timeout=1e-3)
+      except asyncio.TimeoutError:
+        pass
+      return await asyncio.wait_for(pipeline.serve(images), timeout=60)
+
+    outputs = asyncio.run(serve_with_timeout())
+    pipeline.close()
+    self.assertEqual(outputs[0].shape, (1, 100, 4))
+    with self.assertRaises(RuntimeError):
+      pipeline.submit(images)
+
+  def test_video_pipeline(self):
+    driver = inference.ServingDriver(
+        'efficientdet-d0', self.tmp_path, batch_size=2)
+    frames = [np.full((64, 96, 3), i, dtype=np.uint8) for i in range(5)]
+    outputs, threads = [], set()
+
+    def write(frame):
+      # Display sinks such as cv2.imshow must run on the calling thread.
+      threads.add(threading.get_ident())
+      outputs.append(frame)
+
+    pipeline = inference.VideoPipeline(
+        driver, frame_stride=2, queue_size=2, min_score_thresh=1.1)
+    stats = pipeline.run(iter(frames), write)
+    self.assertEqual(threads, {threading.get_ident()})
+    # No boxes are drawn above the score threshold, so frames are unchanged.
+    self.assertAllEqual(outputs, frames)
+    self.assertEqual(stats['frames'], 5)
+    self.assertEqual(stats['keyframes'], 3)
+    self.assertGreater(stats['fps'], 0)
+
+    outputs = []
+    stats = pipeline.run(iter(frames), lambda f: outputs.append(f) or True)
+    self.assertLen(outputs, 1)
+    self.assertEqual(stats['frames'], 1)
+
+    def fail(_):
+      raise ValueError('sink error')
+
+    with self.assertRaisesRegex(ValueError, 'sink error'):
+      pipeline.run(iter(frames * 4), fail)
+
+  def test_serve_tiled(self):
+    self.assertEqual(inference._tile_offsets(300, 512, 0.25), [0])
+    self.assertEqual(inference._tile_offsets(1000, 512, 0.25), [0, 244, 488])
+    driver = inference.ServingDriver(
+        'efficientdet-d0', self.tmp_path, batch_size=4)
+    image = np.random.RandomState(0).randint(
+        0, 255, size=(700, 1000, 3), dtype=np.uint8)
+    for merge in ('nms', 'wbf'):
+      boxes, scores, classes, valid_len = driver.serve_tiled(
+          image, overlap=0.25, merge=merge, max_output_size=50)
+      self.assertEqual(boxes.shape, (1, 50, 4))
+      self.assertEqual(scores.shape, (1, 50))
+      self.assertEqual(classes.shape, (1, 50))
+      self.assertBetween(int(valid_len[0]), 1, 50)
+      self.assertAllInRange(boxes[..., 0::2], 0, 700)
+      self.assertAllInRange(boxes[..., 1::2], 0, 1000)
+      valid_scores = scores[0, :int(valid_len[0])]
+      self.assertAllEqual(valid_scores, np.sort(valid_scores)[::-1])
+
+  def test_serve_tta(self):
+    driver = inference.ServingDriver('efficientdet-d0', self.tmp_path)
+    images = np.random.RandomState(0).randint(
+        0, 255, size=(2, 160, 480, 3), dtype=np.uint8)
+    boxes, scores, classes, valid_lens = driver.serve_tta(
+        images, scales=(1.0, 0.8), flip=True)
+    self.assertEqual(boxes.shape, (2, 100, 4))
+    self.assertEqual(scores.shape, (2, 100))
+    self.assertEqual(classes.shape, (2, 100))
+    self.assertEqual(valid_lens.shape, (2,))
+    for i in range(2):
+      valid_scores = scores[i, :valid_lens[i]].numpy()
+      self.assertAllEqual(valid_scores, np.sort(valid_scores)[::-1])
+    self.assertAllInRange(boxes[..., 0::2], 0, 160)
+    self.assertAllInRange(boxes[..., 1::2], 0, 480)
+
+  def test_profile(self):
+    driver = inference.ServingDriver('efficientdet-d0', self.tmp_path)
+    stats = driver.profile(tf.ones((1, 512, 512, 3)), warmup_runs=1, bm_runs=2)
+    self.assertEqual(
+        list(stats),
+        ['preprocess', 'backbone', 'fpn', 'heads', 'postprocess', 'total'])
+    for stage_stats in stats.values():
+      self.assertBetween(stage_stats['p50_ms'], stage_stats['min_ms'],
+                         stage_stats['max_ms'])
+    driver = inference.ServingDriver(
+        'efficientdet-d0', self.tmp_path, only_network=True)
+    stats = driver.profile(tf.ones((1, 512, 512, 3)), warmup_runs=1, bm_runs=2)
+    self.assertEqual(list(stats), ['backbone', 'fpn', 'heads', 'total'])
+
+  def test_latency_histogram(self):
+    histogram = inference.LatencyHistogram()
+    for ms in range(1, 101):
+      histogram.record(ms / 1000.)
+    summary = histogram.summary()
+    self.assertEqual(summary['count'], 100)
+    self.assertAllClose(summary['mean_ms'], 50.5)
+    self.assertBetween(summary['p50_ms'], 50, 50 * 1.25)
+    self.assertBetween(summary['p99_ms'], 99, 99 * 1.25)
+    self.assertAllClose(summary['max_ms'], 100)
+    # Latencies past the last bucket are reported as the observed max.
+    histogram = inference.LatencyHistogram(max_ms=10)
+    histogram.record(1.)
+    self.assertAllClose(histogram.percentile(50), 1000)
+
 
 if __name__ == '__main__':
   logging.set_verbosity(logging.WARNING)
@@ -46,11 +46,21 @@ flags.DEFINE_string(
 
 flags.DEFINE_string('input_image', None, 'Input image path for inference.')
 flags.DEFINE_string('output_image_dir', None, 'Output dir for inference.')
+flags.DEFINE_bool('tiled', False,
+                  'Infer large images as overlapping tiles at model size.')
+flags.DEFINE_float('tile_overlap', 0.25, 'Overlap fraction of the tiles.')
+flags.DEFINE_string('tile_merge', 'nms',
+                    'Merge tile detections by: {nms, wbf}.')
 
 # For video.
 flags.DEFINE_string('input_video', None, 'Input video path for inference.')
 flags.DEFINE_string('output_video', None,
                     'Output video path. If None, play it online instead.')
+flags.DEFINE_integer('frame_stride', 1,
+                     'Run the model on every frame_stride-th video frame, and '
+                     'draw the frames in between with its detections.')
+flags.DEFINE_integer('num_video_workers', 2,
+                     'Number of threads drawing the video frames.')
 
 # For saved model.
 flags.DEFINE_string('saved_model_dir', None, 'Folder path for saved model.')
@@ -60,6 +70,9 @@ flags.DEFINE_string('file_pattern', None,
 flags.DEFINE_integer(
     'num_calibration_steps', 2000,
     'Number of post-training quantization calibration steps to run.')
+flags.DEFINE_list(
+    'image_size_buckets', None, 'Smaller image sizes, such as 256,640x384, '
+    'exported as extra saved model signatures.')
 flags.DEFINE_bool('debug', False, 'Debug mode.')
 flags.DEFINE_bool('only_network', False, 'Model only contains network')
 FLAGS = flags.FLAGS
@@ -91,8 +104,11 @@ def main(_):
     model_dir = FLAGS.saved_model_dir
     if tf.io.gfile.exists(model_dir):
       tf.io.gfile.rmtree(model_dir)
+    image_size_buckets = [
+        int(s) if s.isdigit() else s for s in FLAGS.image_size_buckets or []
+    ]
     driver.export(model_dir, FLAGS.tensorrt, FLAGS.tflite, FLAGS.file_pattern,
-                  FLAGS.num_calibration_steps)
+                  FLAGS.num_calibration_steps, image_size_buckets)
     print('Model are exported to %s' % model_dir)
   elif FLAGS.mode == 'infer':
     image_file = tf.io.read_file(FLAGS.input_image)
@@ -105,7 +121,11 @@ def main(_):
         image_size = utils.parse_image_size(model_config.image_size)
         image_arrays = tf.image.resize_with_pad(image_arrays, *image_size)
         image_arrays = tf.cast(image_arrays, tf.uint8)
-    detections_bs = driver.serve(image_arrays)
+    if FLAGS.tiled:
+      detections_bs = driver.serve_tiled(
+          image_arrays[0], overlap=FLAGS.tile_overlap, merge=FLAGS.tile_merge)
+    else:
+      detections_bs = driver.serve(image_arrays)
     boxes, scores, classes, _ = tf.nest.map_structure(np.array, detections_bs)
     raw_image = Image.fromarray(np.array(image_arrays)[0])
     img = driver.visualize(
@@ -155,32 +175,37 @@ def main(_):
                                 cv2.VideoWriter_fourcc('m', 'p', '4', 'v'), 25,
                                 (frame_width, frame_height))
 
-    while cap.isOpened():
-      # Capture frame-by-frame
-      ret, frame = cap.read()
-      if not ret:
-        break
-
-      raw_frames = np.array([frame])
-      detections_bs = driver.serve(raw_frames)
-      boxes, scores, classes, _ = tf.nest.map_structure(np.array, detections_bs)
-      new_frame = driver.visualize(
-          raw_frames[0],
-          boxes[0],
-          classes[0],
-          scores[0],
-          min_score_thresh=model_config.nms_configs.score_thresh or 0.4,
-          max_boxes_to_draw=model_config.nms_configs.max_output_size)
+    def read_frames():
+      while cap.isOpened():
+        # Capture frame-by-frame
+        ret, frame = cap.read()
+        if not ret:
+          break
+        yield frame
 
+    def write_frame(new_frame):
       if out_ptr:
         # write frame into output file.
         out_ptr.write(new_frame)
-      else:
-        # show the frame online, mainly used for real-time speed test.
-        cv2.imshow('Frame', new_frame)
-        # Press Q on keyboard to  exit
-        if cv2.waitKey(1) & 0xFF == ord('q'):
-          break
+        return False
+      # show the frame online, mainly used for real-time speed test.
+      cv2.imshow('Frame', new_frame)
+      # Press Q on keyboard to  exit
+      return cv2.waitKey(1) & 0xFF == ord('q')
+
+    pipeline = inference.VideoPipeline(
+        driver,
+        frame_stride=FLAGS.frame_stride,
+        num_workers=FLAGS.num_video_workers,
+        min_score_thresh=model_config.nms_configs.score_thresh or 0.4,
+        max_boxes_to_draw=model_config.nms_configs.max_output_size)
+    stats = pipeline.run(read_frames(), write_frame)
+    cap.release()
+    if out_ptr:
+      out_ptr.release()
+    print('%d frames (%d keyframes) in %.1fs: %.1f fps' %
+          (stats['frames'], stats['keyframes'], stats['elapsed'],
+           stats['fps']))
 
 
 if __name__ == '__main__':
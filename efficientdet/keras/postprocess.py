@@ -14,6 +14,7 @@
 # =============================================================================
 """Postprocessing for anchor-based detection."""
 import functools
+import math
 from typing import List, Tuple
 
 from absl import logging
@@ -149,22 +150,9 @@ def pre_nms(params, cls_outputs, box_outputs, topk=True):
   return boxes, scores, classes
 
 
-def nms(params, boxes: T, scores: T, classes: T,
-        padded: bool) -> Tuple[T, T, T, T]:
-  """Non-maximum suppression.
-
-  Args:
-    params: a dict of parameters.
-    boxes: a tensor with shape [N, 4], where N is the number of boxes. Box
-      format is [y_min, x_min, y_max, x_max].
-    scores: a tensor with shape [N].
-    classes: a tensor with shape [N].
-    padded: a bool vallue indicating whether the results are padded.
-
-  Returns:
-    A tuple (boxes, scores, classes, valid_lens), where valid_lens is a scalar
-    denoting the valid length of boxes/scores/classes outputs.
-  """
+def _nms_indices(params, boxes: T, scores: T,
+                 padded: bool) -> Tuple[T, T, T]:
+  """Runs nms and returns (selected_indices, selected_scores, valid_lens)."""
   nms_configs = params['nms_configs']
   method = nms_configs['method']
   max_output_size = nms_configs['max_output_size']
@@ -183,7 +171,7 @@ def nms(params, boxes: T, scores: T, classes: T,
 
   # TF API's sigma is twice as the paper's value, so here we divide it by 2:
   # https://github.com/tensorflow/tensorflow/issues/40253.
-  nms_top_idx, nms_scores, nms_valid_lens = tf.raw_ops.NonMaxSuppressionV5(
+  return tf.raw_ops.NonMaxSuppressionV5(
       boxes=boxes,
       scores=scores,
       max_output_size=max_output_size,
@@ -192,12 +180,74 @@ def nms(params, boxes: T, scores: T, classes: T,
       soft_nms_sigma=(sigma / 2),
       pad_to_max_output_size=padded)
 
+
+def nms(params, boxes: T, scores: T, classes: T,
+        padded: bool) -> Tuple[T, T, T, T]:
+  """Non-maximum suppression.
+
+  Args:
+    params: a dict of parameters.
+    boxes: a tensor with shape [N, 4], where N is the number of boxes. Box
+      format is [y_min, x_min, y_max, x_max].
+    scores: a tensor with shape [N].
+    classes: a tensor with shape [N].
+    padded: a bool vallue indicating whether the results are padded.
+
+  Returns:
+    A tuple (boxes, scores, classes, valid_lens), where valid_lens is a scalar
+    denoting the valid length of boxes/scores/classes outputs.
+  """
+  nms_top_idx, nms_scores, nms_valid_lens = _nms_indices(
+      params, boxes, scores, padded)
+
   nms_boxes = tf.gather(boxes, nms_top_idx)
   nms_classes = tf.cast(
       tf.gather(classes, nms_top_idx) + CLASS_OFFSET, tf.float32)
   return nms_boxes, nms_scores, nms_classes, nms_valid_lens
 
 
+def class_offset_nms(params, boxes: T, scores: T,
+                     classes: T) -> Tuple[T, T, T, T]:
+  """Per-class nms of a single image with a single nms call.
+
+  Boxes of each class are moved to their own tile of a grid, so boxes of
+  different classes never overlap and one nms over all boxes gives the same
+  result as one nms per class, up to float rounding of the shifted boxes.
+
+  Args:
+    params: a dict of parameters.
+    boxes: a tensor with shape [N, 4], where N is the number of boxes. Box
+      format is [y_min, x_min, y_max, x_max].
+    scores: a tensor with shape [N].
+    classes: a tensor with shape [N].
+
+  Returns:
+    A tuple (boxes, scores, classes, valid_lens), padded to max_output_size.
+  """
+  # A 2D grid of tiles keeps the shifted coordinates small for float32.
+  grid_size = int(math.ceil(math.sqrt(params['num_classes'])))
+  coord_min = tf.reduce_min(boxes)
+  tile_size = tf.reduce_max(boxes) - coord_min + 1
+  class_ids = tf.cast(classes, tf.int32)
+  offset_y = tf.cast(class_ids // grid_size, boxes.dtype) * tile_size
+  offset_x = tf.cast(class_ids % grid_size, boxes.dtype) * tile_size
+  offsets = tf.stack([offset_y, offset_x, offset_y, offset_x], axis=-1)
+  nms_top_idx, nms_scores, nms_valid_len = _nms_indices(
+      params, boxes - coord_min + offsets, scores, False)
+
+  # Pad zeros and sort like per_class_nms.
+  max_output_size = params['nms_configs'].get('max_output_size', 100)
+  nms_boxes = tf.pad(
+      tf.gather(boxes, nms_top_idx), [[0, max_output_size], [0, 0]])
+  nms_scores = tf.pad(nms_scores, [[0, max_output_size]])
+  nms_classes = tf.pad(
+      tf.cast(tf.gather(classes, nms_top_idx) + CLASS_OFFSET, tf.float32),
+      [[0, max_output_size]])
+  _, indices = tf.math.top_k(nms_scores, k=max_output_size, sorted=True)
+  return (tf.gather(nms_boxes, indices), tf.gather(nms_scores, indices),
+          tf.gather(nms_classes, indices), nms_valid_len)
+
+
 def postprocess_combined(params, cls_outputs, box_outputs, image_scales=None):
   """Post processing with combined NMS.
 
@@ -288,6 +338,8 @@ def per_class_nms(params, boxes, scores, classes, image_scales=None):
   """
   def single_batch_fn(element):
     """A mapping function for a single batch."""
+    if params['nms_configs'].get('class_offset', False):
+      return class_offset_nms(params, element[0], element[1], element[2])
     boxes_i, scores_i, classes_i = element[0], element[1], element[2]
     nms_boxes_cls, nms_scores_cls, nms_classes_cls = [], [], []
     nms_valid_len_cls = []
@@ -373,8 +425,33 @@ def generate_detections(params,
     # the reason why is unknown
     detections_bs = []
     boxes, scores, classes = pre_nms(params, cls_outputs, box_outputs)
+    nms_configs = params['nms_configs']
+    if nms_configs.get('pyfunc_workers'):
+      # Send the whole batch to a worker pool in a single pyfunc call.
+      detections_bs = tf.numpy_function(
+          functools.partial(
+              nms_np.batch_per_class_nms, nms_configs=nms_configs), [
+                  boxes,
+                  scores,
+                  classes,
+                  image_ids,
+                  image_scales,
+                  params['num_classes'],
+                  nms_configs['max_output_size'],
+              ], tf.float32)
+      if flip:
+        detections_bs = tf.stack([
+            detections_bs[:, :, 0],
+            original_image_widths - detections_bs[:, :, 3],
+            detections_bs[:, :, 2],
+            original_image_widths - detections_bs[:, :, 1],
+            detections_bs[:, :, 4],
+            detections_bs[:, :, 5],
+            detections_bs[:, :, 6],
+        ], axis=-1)
+      return tf.identity(detections_bs, name='detnections')
+
     for index in range(boxes.shape[0]):
-      nms_configs = params['nms_configs']
       detections = tf.numpy_function(
           functools.partial(nms_np.per_class_nms, nms_configs=nms_configs), [
               boxes[index],
@@ -104,6 +104,44 @@ class PostprocessTest(tf.test.TestCase):
          [[1., 4.589919, 13.529362, 10.114573, 14.154047, 0.884544, 1.],
           [1., 1.826027, -9.660868, 7.854128, 10.41237, 0.815883, 2.]]])
 
+  def test_postprocess_per_class_numpy_nms_workers(self):
+    """Test postprocess with per class numpy nms in a worker pool."""
+    tf.random.set_seed(1111)
+    cls_outputs = {
+        1: tf.random.normal([2, 4, 4, 2]),
+        2: tf.random.normal([2, 2, 2, 2])
+    }
+    box_outputs = {
+        1: tf.random.normal([2, 4, 4, 4]),
+        2: tf.random.normal([2, 2, 2, 4])
+    }
+    cls_outputs_list = [cls_outputs[1], cls_outputs[2]]
+    box_outputs_list = [box_outputs[1], box_outputs[2]]
+    scales = [1.0, 2.0]
+    ids = [0, 1]
+
+    self.params['max_detection_points'] = 10
+    self.params['nms_configs']['pyfunc_workers'] = 2
+    outputs = postprocess.generate_detections(self.params, cls_outputs_list,
+                                              box_outputs_list, scales, ids)
+    self.assertAllClose(
+        outputs.numpy(),
+        [[[0., -1.177383, 1.793507, 8.340945, 4.418388, 0.901576, 2.],
+          [0., 5.676410, 6.102146, 7.785691, 8.537168, 0.888125, 1.]],
+         [[1., 5.885427, 13.529362, 11.410081, 14.154047, 0.884544, 1.],
+          [1., 8.145872, -9.660868, 14.173973, 10.41237, 0.815883, 2.]]])
+
+    outputs_flipped = postprocess.generate_detections(self.params,
+                                                      cls_outputs_list,
+                                                      box_outputs_list, scales,
+                                                      ids, True)
+    self.assertAllClose(
+        outputs_flipped.numpy(),
+        [[[0., -0.340945, 1.793507, 9.177383, 4.418388, 0.901576, 2.],
+          [0., 0.214309, 6.102146, 2.32359, 8.537168, 0.888125, 1.]],
+         [[1., 4.589919, 13.529362, 10.114573, 14.154047, 0.884544, 1.],
+          [1., 1.826027, -9.660868, 7.854128, 10.41237, 0.815883, 2.]]])
+
   def test_postprocess_per_class_tf_nms(self):
     """Test postprocess with per class nms using the tensorflow nms."""
     tf.random.set_seed(1111)
@@ -142,6 +180,52 @@ class PostprocessTest(tf.test.TestCase):
          [[1., 4.589919, 13.529362, 10.114573, 14.154047, 0.884544, 1.],
           [1., 1.826027, -9.660868, 7.854128, 10.41237, 0.815883, 2.]]])
 
+  def test_postprocess_per_class_class_offset_nms(self):
+    """Test postprocess with per class nms in a single tf nms call."""
+    tf.random.set_seed(1111)
+    cls_outputs = {
+        1: tf.random.normal([2, 4, 4, 2]),
+        2: tf.random.normal([2, 2, 2, 2])
+    }
+    box_outputs = {
+        1: tf.random.normal([2, 4, 4, 4]),
+        2: tf.random.normal([2, 2, 2, 4])
+    }
+    cls_outputs_list = [cls_outputs[1], cls_outputs[2]]
+    box_outputs_list = [box_outputs[1], box_outputs[2]]
+    scales = [1.0, 2.0]
+    ids = [0, 1]
+
+    self.params['max_detection_points'] = 10
+    self.params['nms_configs']['pyfunc'] = False
+    self.params['nms_configs']['class_offset'] = True
+    outputs = postprocess.generate_detections(self.params, cls_outputs_list,
+                                              box_outputs_list, scales, ids)
+    self.assertAllClose(
+        outputs.numpy(),
+        [[[0., -1.177383, 1.793507, 8.340945, 4.418388, 0.901576, 2.],
+          [0., 5.676410, 6.102146, 7.785691, 8.537168, 0.888125, 1.]],
+         [[1., 5.885427, 13.529362, 11.410081, 14.154047, 0.884544, 1.],
+          [1., 8.145872, -9.660868, 14.173973, 10.41237, 0.815883, 2.]]])
+
+  def test_class_offset_nms_same_as_per_class_nms(self):
+    tf.random.set_seed(1111)
+    centers = tf.random.uniform([2, 200, 2], 0, 64)
+    sizes = tf.random.uniform([2, 200, 2], 2, 24)
+    boxes = tf.concat([centers - sizes / 2, centers + sizes / 2], -1)
+    scores = tf.random.uniform([2, 200])
+    classes = tf.random.uniform([2, 200], 0, 5, dtype=tf.int32)
+    self.params['num_classes'] = 5
+    self.params['nms_configs']['max_output_size'] = 30
+    for method in ['hard', 'gaussian']:
+      self.params['nms_configs']['method'] = method
+      self.params['nms_configs']['class_offset'] = False
+      expected = postprocess.per_class_nms(self.params, boxes, scores, classes)
+      self.params['nms_configs']['class_offset'] = True
+      outputs = postprocess.per_class_nms(self.params, boxes, scores, classes)
+      for output, expected_output in zip(outputs, expected):
+        self.assertAllClose(output, expected_output)
+
   def test_transform_detections(self):
     corners = tf.constant(
         [[[0., -1.177383, 1.793507, 8.340945, 4.418388, 0.901576, 2.],
@@ -0,0 +1,133 @@
+# Copyright 2020 Google Research. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+r"""Per-stage latency benchmark suite for the keras ServingDriver.
+
+Runs ServingDriver.profile with random weights and synthetic images over
+model names, batch sizes and image sizes, writes the stage latencies as JSON,
+and compares the p50 latencies to a baseline JSON from a previous run. Exits
+with a non-zero status if any stage regresses by more than max_regression.
+
+Example usage:
+    python keras/serving_benchmark.py --model_names=efficientdet-d0 \
+      --batch_sizes=1,8 --output_json=/tmp/bm.json \
+      --baseline_json=/tmp/baseline.json
+"""
+import json
+import platform
+
+from absl import app
+from absl import flags
+from absl import logging
+import numpy as np
+import tensorflow as tf
+
+import utils
+from keras import inference
+
+flags.DEFINE_list('model_names', ['efficientdet-d%d' % i for i in range(8)],
+                  'Model names to benchmark.')
+flags.DEFINE_list('batch_sizes', ['1'], 'Batch sizes to benchmark.')
+flags.DEFINE_list(
+    'image_sizes', [], 'Image sizes to benchmark, such as 512 or 640x384. '
+    'Empty means the image size of each model.')
+flags.DEFINE_integer('warmup_runs', 3, 'Number of warmup runs.')
+flags.DEFINE_integer('bm_runs', 10, 'Number of benchmark runs.')
+flags.DEFINE_bool('use_cpu', True, 'Whether to hide the GPUs.')
+flags.DEFINE_string('output_json', None, 'Path of the output JSON.')
+flags.DEFINE_string('baseline_json', None, 'Path of a baseline JSON.')
+flags.DEFINE_float('max_regression', 0.1,
+                   'Max relative increase of p50 latency over the baseline.')
+FLAGS = flags.FLAGS
+
+
+def run_suite(model_names, batch_sizes, image_sizes, warmup_runs, bm_runs):
+  """Profiles all combinations and returns a list of results."""
+  results = []
+  for model_name in model_names:
+    for image_size in image_sizes or [None]:
+      for batch_size in batch_sizes:
+        model_params = {'image_size': image_size} if image_size else None
+        driver = inference.ServingDriver(
+            model_name, '_', batch_size, model_params=model_params)
+        height, width = utils.parse_image_size(driver.params['image_size'])
+        images = np.random.randint(
+            0, 256, [batch_size, height, width, 3], dtype=np.uint8)
+        stats = driver.profile(images, warmup_runs, bm_runs)
+        logging.info('%s batch %d %dx%d: %s', model_name, batch_size, height,
+                     width, ', '.join('%s %.1f ms' % (name, s['p50_ms'])
+                                      for name, s in stats.items()))
+        results.append({
+            'model_name': model_name,
+            'batch_size': batch_size,
+            'image_size': '%dx%d' % (height, width),
+            'stages': stats,
+        })
+  return results
+
+
+def compare_to_baseline(results, baseline, max_regression):
+  """Returns the regressions of p50 stage latencies over the baseline."""
+
+  def _key(result):
+    return (result['model_name'], result['batch_size'], result['image_size'])
+
+  baseline_stages = {_key(r): r['stages'] for r in baseline['results']}
+  regressions = []
+  for result in results:
+    for name, stats in result['stages'].items():
+      base_stats = baseline_stages.get(_key(result), {}).get(name)
+      if not base_stats:
+        continue
+      ratio = stats['p50_ms'] / max(base_stats['p50_ms'], 1e-6) - 1
+      if ratio > max_regression:
+        regressions.append(
+            '%s batch %d %s %s: %.1f ms vs baseline %.1f ms (+%.0f%%)' %
+            (*_key(result), name, stats['p50_ms'], base_stats['p50_ms'],
+             ratio * 100))
+  return regressions
+
+
+def main(_):
+  if FLAGS.use_cpu:
+    tf.config.set_visible_devices([], 'GPU')
+  image_sizes = [int(s) if s.isdigit() else s for s in FLAGS.image_sizes]
+  results = run_suite(FLAGS.model_names, [int(b) for b in FLAGS.batch_sizes],
+                      image_sizes, FLAGS.warmup_runs, FLAGS.bm_runs)
+  output = {
+      'environment': {
+          'tensorflow': tf.__version__,
+          'machine': platform.machine(),
+          'devices': [d.name for d in tf.config.list_logical_devices()],
+      },
+      'results': results,
+  }
+  if FLAGS.output_json:
+    with tf.io.gfile.GFile(FLAGS.output_json, 'w') as f:
+      json.dump(output, f, indent=2)
+
+  if FLAGS.baseline_json:
+    with tf.io.gfile.GFile(FLAGS.baseline_json) as f:
+      baseline = json.load(f)
+    regressions = compare_to_baseline(results, baseline, FLAGS.max_regression)
+    for regression in regressions:
+      logging.error('Regression: %s', regression)
+    if regressions:
+      return 1
+    logging.info('No regression over %s', FLAGS.baseline_json)
+
+
+if __name__ == '__main__':
+  logging.set_verbosity(logging.INFO)
+  app.run(main)
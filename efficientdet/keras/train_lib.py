@@ -331,8 +331,13 @@ class COCOCallback(tf.keras.callbacks.Callback):
     label_map = label_util.get_label_map(config.label_map)
     log_dir = os.path.join(config.model_dir, 'coco')
     self.file_writer = tf.summary.create_file_writer(log_dir)
-    self.evaluator = coco_metric.EvaluationMetric(
-        filename=config.val_json_file, label_map=label_map)
+    if config.streaming_eval:
+      evaluator_cls = coco_metric.StreamingEvaluationMetric
+    else:
+      evaluator_cls = coco_metric.EvaluationMetric
+    self.evaluator = evaluator_cls(
+        filename=config.val_json_file, label_map=label_map,
+        backend=config.eval_backend)
 
   @tf.function
   def _get_detections(self, images, labels):
@@ -527,6 +532,64 @@ class FocalLoss(tf.keras.losses.Loss):
     # compute the final loss and return
     return alpha_factor * modulating_factor * ce / normalizer
 
+  @tf.autograph.experimental.do_not_convert
+  def sparse_call(self, y, y_pred):
+    """Compute the summed focal loss for sparse class targets.
+
+    Same as summing `call` with one-hot targets where ignored anchors are
+    masked out, but no one-hot tensor is built: every entry is first computed
+    as a negative in closed form, then only the positive (anchor, class)
+    entries are corrected by gather.
+
+    Args:
+      y: A tuple of (normalizer, cls_targets), where cls_targets is an int
+        tensor of target classes per anchor, with -1 for negatives and -2 for
+        ignored anchors.
+      y_pred: A float32 tensor with num_classes logits per anchor, in the same
+        anchor order as cls_targets.
+
+    Returns:
+      the focal loss sum.
+    """
+    normalizer, cls_targets = y
+    alpha = tf.convert_to_tensor(self.alpha, dtype=y_pred.dtype)
+    gamma = tf.convert_to_tensor(self.gamma, dtype=y_pred.dtype)
+    y_pred = tf.reshape(y_pred, tf.concat([tf.shape(cls_targets), [-1]], 0))
+
+    def _sigmoid_cross_entropy(label, logits):
+      # Same formula as tf.nn.sigmoid_cross_entropy_with_logits, but with a
+      # scalar label so that no label tensor is needed.
+      return (tf.nn.relu(logits) - logits * label +
+              tf.math.log1p(tf.exp(-tf.abs(logits))))
+
+    def _negative_loss(logits):
+      # (1 - p_t) is computed as in `call` to keep the same numerics.
+      pred_prob = tf.sigmoid(logits)
+      return ((1 - alpha) * (1.0 - (1 - pred_prob))**gamma *
+              _sigmoid_cross_entropy(0.5 * self.label_smoothing, logits))
+
+    def _positive_loss(logits):
+      pred_prob = tf.sigmoid(logits)
+      label = (1.0 - self.label_smoothing) + 0.5 * self.label_smoothing
+      return (alpha * (1.0 - pred_prob)**gamma *
+              _sigmoid_cross_entropy(label, logits))
+
+    valid_mask = tf.cast(
+        tf.expand_dims(tf.not_equal(cls_targets, -2), -1), y_pred.dtype)
+    negative_loss = tf.reduce_sum(_negative_loss(y_pred) * valid_mask)
+
+    positive_indices = tf.where(cls_targets >= 0)
+    positive_classes = tf.gather_nd(cls_targets, positive_indices)
+    positive_logits = tf.gather_nd(
+        y_pred,
+        tf.concat([
+            positive_indices,
+            tf.cast(tf.expand_dims(positive_classes, -1), tf.int64)
+        ], -1))
+    correction = tf.reduce_sum(
+        _positive_loss(positive_logits) - _negative_loss(positive_logits))
+    return (negative_loss + correction) / normalizer
+
 
 class BoxLoss(tf.keras.losses.Loss):
   """L2 box regression loss."""
@@ -612,6 +675,81 @@ class EfficientDetNetTrain(efficientdet_keras.EfficientDetNet):
         tf.nn.l2_loss(v) for v in self._freeze_vars() if var_match.match(v.name)
     ])
 
+  def _fused_detection_loss(self, cls_outputs, box_outputs, labels,
+                            num_positives_sum, loss_vals):
+    """Computes total detection loss over the anchors of all levels at once.
+
+    Same losses as the per-level loop in `_detection_loss`, but the outputs and
+    targets of all levels are flattened once to [batch_size, total_anchors,
+    ...], so that each loss is computed in a single pass.
+
+    Args:
+      cls_outputs: a list of class logits for each level.
+      box_outputs: a list of box regression outputs for each level.
+      labels: the dictionary that returned from dataloader that includes
+        groundtruth targets.
+      num_positives_sum: the normalizer of the losses.
+      loss_vals: A dict of loss values.
+
+    Returns:
+      total_loss: a float tensor representing total detection loss.
+    """
+    dtype = cls_outputs[0].dtype
+    bs = cls_outputs[0].get_shape().as_list()[0]
+    levels = range(len(cls_outputs))
+
+    def _concat_levels(tensors, last_dim):
+      if self.config.data_format == 'channels_first':
+        tensors = [tf.transpose(v, [0, 2, 3, 1]) for v in tensors]
+      return tf.concat([tf.reshape(v, [bs, -1, last_dim]) for v in tensors],
+                       axis=1)
+
+    cls_targets = _concat_levels([
+        labels['cls_targets_%d' % (level + self.config.min_level)]
+        for level in levels
+    ], 1)[..., 0]
+    cls_outputs = _concat_levels(cls_outputs, self.config.num_classes)
+    class_loss_layer = self.loss.get(FocalLoss.__name__, None)
+    cls_loss = 0
+    if class_loss_layer and self.config.get('sparse_focal_loss'):
+      cls_loss = tf.cast(
+          class_loss_layer.sparse_call([num_positives_sum, cls_targets],
+                                       cls_outputs), dtype)
+    elif class_loss_layer:
+      cls_loss = class_loss_layer([
+          num_positives_sum,
+          tf.one_hot(cls_targets, self.config.num_classes, dtype=dtype)
+      ], cls_outputs)
+      cls_loss *= tf.cast(
+          tf.expand_dims(tf.not_equal(cls_targets, -2), -1), dtype)
+      cls_loss = tf.cast(tf.reduce_sum(cls_loss), dtype)
+
+    box_targets = _concat_levels([
+        labels['box_targets_%d' % (level + self.config.min_level)]
+        for level in levels
+    ], 4)
+    box_outputs = _concat_levels(box_outputs, 4)
+    box_loss = 0
+    if self.config.box_loss_weight and self.loss.get(BoxLoss.__name__, None):
+      box_loss = self.loss[BoxLoss.__name__]([num_positives_sum, box_targets],
+                                             box_outputs)
+
+    box_iou_loss = 0
+    if self.config.iou_loss_type:
+      box_iou_loss_layer = self.loss[BoxIouLoss.__name__]
+      box_iou_loss = box_iou_loss_layer(
+          [num_positives_sum, tf.reshape(box_targets, [-1, 4])],
+          tf.reshape(box_outputs, [-1, 4]))
+      loss_vals['box_iou_loss'] = box_iou_loss
+
+    total_loss = (
+        cls_loss + self.config.box_loss_weight * box_loss +
+        self.config.iou_loss_weight * box_iou_loss)
+    loss_vals['det_loss'] = total_loss
+    loss_vals['cls_loss'] = cls_loss
+    loss_vals['box_loss'] = box_loss
+    return total_loss
+
   def _detection_loss(self, cls_outputs, box_outputs, labels, loss_vals):
     """Computes total detection loss.
 
@@ -654,27 +792,37 @@ class EfficientDetNetTrain(efficientdet_keras.EfficientDetNet):
     elif positives_momentum < 0:
       num_positives_sum = utils.cross_replica_mean(num_positives_sum)
     num_positives_sum = tf.cast(num_positives_sum, dtype)
+    if self.config.get('fused_detection_loss'):
+      return self._fused_detection_loss(cls_outputs, box_outputs, labels,
+                                        num_positives_sum, loss_vals)
     levels = range(len(cls_outputs))
     cls_losses = []
     box_losses = []
     for level in levels:
-      # Onehot encoding for classification labels.
-      cls_targets_at_level = tf.one_hot(
-          labels['cls_targets_%d' % (level + self.config.min_level)],
-          self.config.num_classes,
-          dtype=dtype)
+      class_loss_layer = self.loss.get(FocalLoss.__name__, None)
+      if class_loss_layer and self.config.get('sparse_focal_loss'):
+        # Sparse focal loss, which doesn't need onehot classification labels.
+        cls_loss_sum = class_loss_layer.sparse_call([
+            num_positives_sum,
+            labels['cls_targets_%d' % (level + self.config.min_level)]
+        ], cls_outputs[level])
+        cls_losses.append(tf.cast(cls_loss_sum, dtype))
+      elif class_loss_layer:
+        # Onehot encoding for classification labels.
+        cls_targets_at_level = tf.one_hot(
+            labels['cls_targets_%d' % (level + self.config.min_level)],
+            self.config.num_classes,
+            dtype=dtype)
 
-      if self.config.data_format == 'channels_first':
-        bs, _, width, height, _ = cls_targets_at_level.get_shape().as_list()
-        cls_targets_at_level = tf.reshape(cls_targets_at_level,
-                                          [bs, -1, width, height])
-      else:
-        bs, width, height, _, _ = cls_targets_at_level.get_shape().as_list()
-        cls_targets_at_level = tf.reshape(cls_targets_at_level,
-                                          [bs, width, height, -1])
+        if self.config.data_format == 'channels_first':
+          bs, _, width, height, _ = cls_targets_at_level.get_shape().as_list()
+          cls_targets_at_level = tf.reshape(cls_targets_at_level,
+                                            [bs, -1, width, height])
+        else:
+          bs, width, height, _, _ = cls_targets_at_level.get_shape().as_list()
+          cls_targets_at_level = tf.reshape(cls_targets_at_level,
+                                            [bs, width, height, -1])
 
-      class_loss_layer = self.loss.get(FocalLoss.__name__, None)
-      if class_loss_layer:
         cls_loss = class_loss_layer([num_positives_sum, cls_targets_at_level],
                                     cls_outputs[level])
         if self.config.data_format == 'channels_first':
@@ -86,6 +86,62 @@ class TrainLibTest(tf.test.TestCase):
     iou_loss = box_iou_loss([num_positives, box_targets], box_outputs)
     self.assertAlmostEqual(iou_loss.numpy(), 4.924635, places=5)
 
+  def test_sparse_focal_loss(self):
+    tf.random.set_seed(1111)
+    num_classes = 10
+    focal_loss = train_lib.FocalLoss(
+        0.25, 1.5, label_smoothing=0.1,
+        reduction=tf.keras.losses.Reduction.NONE)
+    cls_outputs = tf.random.normal([2, 8, 8, 3 * num_classes]) * 4.
+    cls_targets = tf.random.uniform([2, 8, 8, 3],
+                                    minval=-2,
+                                    maxval=num_classes,
+                                    dtype=tf.int32)
+    num_positives = tf.constant(7.0)
+    dense_loss = focal_loss(
+        [num_positives,
+         tf.reshape(tf.one_hot(cls_targets, num_classes), [2, 8, 8, -1])],
+        cls_outputs)
+    dense_loss = tf.reshape(dense_loss, [2, 8, 8, 3, num_classes])
+    dense_loss *= tf.cast(
+        tf.expand_dims(tf.not_equal(cls_targets, -2), -1), tf.float32)
+    sparse_loss = focal_loss.sparse_call([num_positives, cls_targets],
+                                         cls_outputs)
+    self.assertAllClose(tf.reduce_sum(dense_loss), sparse_loss)
+
+  def test_fused_detection_loss(self):
+    _, x, labels, model = self._build_model()
+    model.config.iou_loss_type = 'ciou'
+    model.loss[train_lib.BoxIouLoss.__name__].iou_loss_type = 'ciou'
+    for level in range(3, 8):
+      labels['cls_targets_%d' % level] = tf.random.uniform(
+          labels['cls_targets_%d' % level].shape,
+          minval=-2,
+          maxval=90,
+          dtype=tf.int32)
+      labels['box_targets_%d' % level] = tf.random.uniform(
+          labels['box_targets_%d' % level].shape)
+    cls_outputs, box_outputs, _ = model(x, training=False)
+    loss_vals = {}
+    model._detection_loss(cls_outputs, box_outputs, labels, loss_vals)
+    for sparse_focal_loss in (False, True):
+      model.config.fused_detection_loss = True
+      model.config.sparse_focal_loss = sparse_focal_loss
+      fused_loss_vals = {}
+      model._detection_loss(cls_outputs, box_outputs, labels, fused_loss_vals)
+      self.assertAllClose(loss_vals, fused_loss_vals, rtol=1e-5)
+
+    # Channels first outputs and labels give the same fused losses.
+    model.config.data_format = 'channels_first'
+    for level in range(3, 8):
+      for name in ('cls_targets_%d' % level, 'box_targets_%d' % level):
+        labels[name] = tf.transpose(labels[name], [0, 3, 1, 2])
+    fused_loss_vals = {}
+    model._detection_loss([tf.transpose(v, [0, 3, 1, 2]) for v in cls_outputs],
+                          [tf.transpose(v, [0, 3, 1, 2]) for v in box_outputs],
+                          labels, fused_loss_vals)
+    self.assertAllClose(loss_vals, fused_loss_vals, rtol=1e-5)
+
   def test_predict(self):
     _, x, _, model = self._build_model()
     cls_outputs, box_outputs, seg_outputs = model(x)
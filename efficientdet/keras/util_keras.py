@@ -13,6 +13,8 @@
 # limitations under the License.
 # ==============================================================================
 """Common keras utils."""
+import concurrent.futures
+import time
 from typing import Text
 from absl import logging
 import tensorflow as tf
@@ -93,10 +95,32 @@ def average_name(ema, var):
       var.name.split(':')[0] + '/' + ema.name, mark_as_used=False)
 
 
+def _read_ckpt_tensors(ckpt_path, keys, dtypes, num_threads):
+  """Reads the checkpoint tensors of keys in parallel restore ops."""
+  num_threads = max(1, min(num_threads, len(keys)))
+  chunks = [list(range(i, len(keys), num_threads)) for i in range(num_threads)]
+
+  def _restore(chunk):
+    with tf.device('/cpu:0'):
+      return tf.raw_ops.RestoreV2(
+          prefix=ckpt_path,
+          tensor_names=[keys[i] for i in chunk],
+          shape_and_slices=[''] * len(chunk),
+          dtypes=[dtypes[i] for i in chunk])
+
+  values = [None] * len(keys)
+  with concurrent.futures.ThreadPoolExecutor(num_threads) as executor:
+    for chunk, tensors in zip(chunks, executor.map(_restore, chunks)):
+      for i, tensor in zip(chunk, tensors):
+        values[i] = tensor
+  return values
+
+
 def restore_ckpt(model,
                  ckpt_path_or_file,
                  ema_decay=0.9998,
-                 skip_mismatch=True):
+                 skip_mismatch=True,
+                 num_threads=16):
   """Restore variables from a given checkpoint.
 
   Args:
@@ -104,16 +128,23 @@ def restore_ckpt(model,
     ckpt_path_or_file: the path or file for checkpoint.
     ema_decay: ema decay rate. If None or zero or negative value, disable ema.
     skip_mismatch: whether to skip variables if shape mismatch.
+    num_threads: number of threads to read the checkpoint tensors.
+
+  Returns:
+    A dict with the restore time in seconds and the restored bytes.
   """
   if ckpt_path_or_file == '_':
     logging.info('Running test: do not load any ckpt.')
-    return
+    return {'restore_time': 0., 'restore_bytes': 0}
+  start_time = time.perf_counter()
   if tf.io.gfile.isdir(ckpt_path_or_file):
     ckpt_path_or_file = tf.train.latest_checkpoint(ckpt_path_or_file)
 
-  if (tf.train.list_variables(ckpt_path_or_file)[0][0] ==
-      '_CHECKPOINTABLE_OBJECT_GRAPH'):
+  reader = tf.train.load_checkpoint(ckpt_path_or_file)
+  ckpt_shapes = reader.get_variable_to_shape_map()
+  if '_CHECKPOINTABLE_OBJECT_GRAPH' in ckpt_shapes:
     model.load_weights(ckpt_path_or_file)
+    restored_vars = model.weights
   else:
     if ema_decay > 0:
       ema = tf.train.ExponentialMovingAverage(decay=0.0)
@@ -132,21 +163,40 @@ def restore_ckpt(model,
         var_dict[v.name.split(':')[0]] = v
     # try to load graph-based checkpoint with ema support,
     # else load checkpoint via keras.load_weights which doesn't support ema.
-    for i, (key, var) in enumerate(var_dict.items()):
-      try:
-        var.assign(tf.train.load_variable(ckpt_path_or_file, key))
-        if i < 10:
-          logging.info('Init %s from %s (%s)', var.name, key, ckpt_path_or_file)
-      except tf.errors.NotFoundError as e:
-        if skip_mismatch:
-          logging.warning('Not found %s in %s', key, ckpt_path_or_file)
-        else:
-          raise e
-      except ValueError as e:
-        if skip_mismatch:
-          logging.warning('%s: %s', key, e)
-        else:
+    ckpt_dtypes = reader.get_variable_to_dtype_map()
+    keys = []
+    for key, var in var_dict.items():
+      if key not in ckpt_shapes:
+        if not skip_mismatch:
+          raise tf.errors.NotFoundError(
+              None, None, 'Key {} not found in checkpoint'.format(key))
+        logging.warning('Not found %s in %s', key, ckpt_path_or_file)
+      elif not var.shape.is_compatible_with(ckpt_shapes[key]):
+        e = ValueError('Shapes {} and {} are incompatible'.format(
+            var.shape, ckpt_shapes[key]))
+        if not skip_mismatch:
           raise e
+        logging.warning('%s: %s', key, e)
+      else:
+        keys.append(key)
+    values = _read_ckpt_tensors(ckpt_path_or_file, keys,
+                                [ckpt_dtypes[key] for key in keys],
+                                num_threads)
+    restored_vars = [var_dict[key] for key in keys]
+    tf.keras.backend.batch_set_value(zip(restored_vars, values))
+    for key, var in zip(keys[:10], restored_vars):
+      logging.info('Init %s from %s (%s)', var.name, key, ckpt_path_or_file)
+
+  restore_stats = {
+      'restore_time':
+          time.perf_counter() - start_time,
+      'restore_bytes':
+          sum(v.shape.num_elements() * v.dtype.size for v in restored_vars),
+  }
+  logging.info('Restored %d variables (%.1f MB) from %s in %.2fs',
+               len(restored_vars), restore_stats['restore_bytes'] / 2**20,
+               ckpt_path_or_file, restore_stats['restore_time'])
+  return restore_stats
 
 
 def fp16_to_fp32_nested(input_nested):
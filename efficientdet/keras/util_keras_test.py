@@ -12,6 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ==============================================================================
+import os
+import tempfile
 from absl import logging
 from absl.testing import parameterized
 import tensorflow as tf
@@ -34,6 +36,30 @@ class KerasUtilTest(tf.test.TestCase, parameterized.TestCase):
     bn_layer = util_keras.build_batch_norm(is_training, strategy=strategy)
     self.assertAllClose(expect_results, bn_layer(inputs, is_training))
 
+  @parameterized.named_parameters(('ema', 0.9998), ('no_ema', 0))
+  def test_restore_ckpt(self, ema_decay):
+    model = tf.keras.Sequential([tf.keras.layers.Dense(4, name='dense')])
+    model.build([None, 3])
+    values = [tf.random.normal(v.shape) for v in model.weights]
+    suffix = '/ExponentialMovingAverage' if ema_decay else ''
+    saved_vars = {
+        v.name.split(':')[0] + suffix: tf.Variable(value)
+        for v, value in zip(model.weights, values)
+    }
+    # A variable with mismatched shape is skipped.
+    saved_vars['dense/bias' + suffix] = tf.Variable(tf.zeros([5]))
+    ckpt_path = os.path.join(tempfile.mkdtemp(), 'ckpt')
+    tf.compat.v1.train.Saver(saved_vars).save(None, ckpt_path)
+
+    restore_stats = util_keras.restore_ckpt(model, ckpt_path, ema_decay)
+    self.assertAllEqual(model.weights[0], values[0])
+    self.assertNotAllClose(model.weights[1], values[1])
+    self.assertEqual(restore_stats['restore_bytes'], 3 * 4 * 4)
+    with self.assertRaises(ValueError):
+      util_keras.restore_ckpt(model, ckpt_path, ema_decay, skip_mismatch=False)
+    self.assertEqual(
+        util_keras.restore_ckpt(model, '_', ema_decay)['restore_bytes'], 0)
+
 
 if __name__ == '__main__':
   logging.set_verbosity(logging.WARNING)
@@ -13,6 +13,7 @@
 # limitations under the License.
 # ==============================================================================
 """WBF for test-time augmentation."""
+import numpy as np
 import tensorflow as tf
 
 
@@ -67,29 +68,135 @@ def average_detections(detections, num_models):
   ]
 
 
+def _box_iou(boxes, box):
+  """Calculates the ious of box [4] with each row of boxes [N, 4]."""
+  xa = np.maximum(boxes[:, 0], box[0])
+  ya = np.maximum(boxes[:, 1], box[1])
+  xb = np.minimum(boxes[:, 2], box[2])
+  yb = np.minimum(boxes[:, 3], box[3])
+  inter_area = np.maximum(xb - xa, 0) * np.maximum(yb - ya, 0)
+  boxa_area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+  boxb_area = (box[2] - box[0]) * (box[3] - box[1])
+  return inter_area / (boxa_area + boxb_area - inter_area)
+
+
+def fuse_detections(detections, num_models, iou_thresh=0.55, per_image=True):
+  """Weighted box fusion of detections of several images at once.
+
+  Detections are clustered per image id and class in their input order, like
+  ensemble_detections. Each cluster keeps running sums of its scores and score
+  weighted boxes, so adding a detection does not recompute the average, and a
+  detection is matched against the average boxes of all clusters of its image
+  and class with one vectorized iou.
+
+  Args:
+    detections: a [N, 7] numpy array or tensor of detections from all models
+      or augmented views, with rows [image_id, box (4), score, class].
+    num_models: number of models or views the detections come from.
+    iou_thresh: min iou of a detection with the average box of a cluster to
+      join it.
+    per_image: whether to cluster the detections of each image id separately.
+      Otherwise clusters take the image id of their first detection.
+
+  Returns:
+    A [M, 7] numpy array of fused detections, sorted by descending score, and
+    by image id first if per_image.
+  """
+  detections = np.asarray(detections)
+  num_detections = len(detections)
+  boxes = detections[:, 1:5].astype(np.float64)
+  scores = detections[:, 5].astype(np.float64)
+  # Sums and average boxes of the clusters, and the detection starting each.
+  score_sums = np.zeros([num_detections])
+  box_sums = np.zeros([num_detections, 4])
+  averages = np.zeros([num_detections, 4])
+  counts = np.zeros([num_detections])
+  firsts = np.zeros([num_detections], np.int64)
+
+  # A stable sort groups detections by image and class in their input order.
+  group_columns = [0, 6] if per_image else [6]
+  order = np.lexsort(detections[:, group_columns[::-1]].T)
+  num_clusters = group_start = 0
+  with np.errstate(divide='ignore', invalid='ignore'):
+    for i, index in enumerate(order):
+      if i and (detections[index, group_columns] !=
+                detections[order[i - 1], group_columns]).any():
+        group_start = num_clusters
+      box, score = boxes[index], scores[index]
+      cluster = num_clusters
+      if num_clusters > group_start:
+        ious = _box_iou(averages[group_start:num_clusters], box)
+        best = np.argmax(ious)
+        if not ious[best] < iou_thresh:
+          cluster = group_start + best
+      if cluster == num_clusters:
+        firsts[cluster] = index
+        num_clusters += 1
+      score_sums[cluster] += score
+      box_sums[cluster] += score * box
+      counts[cluster] += 1
+      averages[cluster] = box_sums[cluster] / score_sums[cluster]
+
+  counts = counts[:num_clusters]
+  fused = np.zeros([num_clusters, 7], detections.dtype)
+  fused[:, 0] = detections[firsts[:num_clusters], 0]
+  fused[:, 1:5] = averages[:num_clusters]
+  fused[:, 5] = score_sums[:num_clusters] / counts * np.minimum(
+      1, counts / num_models)
+  fused[:, 6] = detections[firsts[:num_clusters], 6]
+  if per_image:
+    return fused[np.lexsort((-fused[:, 5], fused[:, 0]))]
+  return fused[np.argsort(-fused[:, 5], kind='stable')]
+
+
 def ensemble_detections(params, detections, num_models):
   """Ensembles a group of detections by clustering the detections and returning the average of the clusters."""
-  all_clusters = []
-
-  for cid in range(params['num_classes']):
-    indices = tf.where(tf.equal(detections[:, 6], cid))
-    if indices.shape[0] == 0:
-      continue
-    class_detections = tf.gather_nd(detections, indices)
-
-    clusters = []
-    cluster_averages = []
-    for d in class_detections:
-      cluster_index = find_matching_cluster(cluster_averages, d)
-      if cluster_index == -1:
-        clusters.append([d])
-        cluster_averages.append(average_detections([d], num_models))
-      else:
-        clusters[cluster_index].append(d)
-        cluster_averages[cluster_index] = average_detections(
-            clusters[cluster_index], num_models)
-
-    all_clusters.extend(cluster_averages)
-
-  all_clusters.sort(reverse=True, key=lambda d: d[5])
-  return tf.stack(all_clusters)
+  detections = np.asarray(detections)
+  classes = detections[:, 6]
+  detections = detections[(classes >= 0) & (classes < params['num_classes'])]
+  return tf.convert_to_tensor(
+      fuse_detections(detections, num_models, per_image=False))
+
+
+def fuse_batch_views(boxes, scores, classes, valid_lens, num_views,
+                     max_output_size):
+  """Fuses the nms outputs of several views of each image in a batch.
+
+  Args:
+    boxes: a [batch * num_views, N, 4] array, with the views of each image
+      next to each other.
+    scores: a [batch * num_views, N] array.
+    classes: a [batch * num_views, N] array.
+    valid_lens: a [batch * num_views] array of valid detections per view.
+    num_views: number of views of each image.
+    max_output_size: max number of fused detections per image.
+
+  Returns:
+    A tuple (boxes, scores, classes, valid_lens) of the fused detections,
+    padded to max_output_size, with a batch dimension of batch.
+  """
+  batch_size = len(boxes) // num_views
+  view_ids = np.repeat(np.arange(len(boxes)), valid_lens)
+  positions = np.concatenate([np.arange(n) for n in valid_lens] + [[]])
+  positions = positions.astype(np.int64)
+  detections = np.concatenate([
+      (view_ids // num_views)[:, None], boxes[view_ids, positions],
+      scores[view_ids, positions][:, None],
+      classes[view_ids, positions][:, None]
+  ], 1).astype(np.float32)
+  # Seed the clusters with the highest scoring detections, as in WBF.
+  detections = detections[np.argsort(-detections[:, 5], kind='stable')]
+  fused = fuse_detections(detections, num_views)
+
+  out_boxes = np.zeros([batch_size, max_output_size, 4], np.float32)
+  out_scores = np.zeros([batch_size, max_output_size], np.float32)
+  out_classes = np.zeros([batch_size, max_output_size], np.float32)
+  out_valid_lens = np.zeros([batch_size], np.int32)
+  for i in range(batch_size):
+    image_fused = fused[fused[:, 0] == i][:max_output_size]
+    num_fused = len(image_fused)
+    out_boxes[i, :num_fused] = image_fused[:, 1:5]
+    out_scores[i, :num_fused] = image_fused[:, 5]
+    out_classes[i, :num_fused] = image_fused[:, 6]
+    out_valid_lens[i] = num_fused
+  return out_boxes, out_scores, out_classes, out_valid_lens
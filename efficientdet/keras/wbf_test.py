@@ -14,6 +14,7 @@
 # ==============================================================================
 """Test for wbf."""
 from absl import logging
+import numpy as np
 import tensorflow as tf
 
 from keras import wbf
@@ -141,6 +142,34 @@ class WbfTest(tf.test.TestCase):
     self.assertAllClose(ensembled,
                         [[1, 2.5, 1, 10, 1, 0.75, 1], [1, 3, 1, 10, 1, 0.5, 2]])
 
+  def test_fuse_detections_per_image(self):
+    d1 = [1, 2, 1, 10, 1, 0.75, 1]
+    d2 = [1, 3, 1, 10, 1, 0.75, 1]
+    d3 = [2, 3, 1, 10, 1, 1, 1]
+    d4 = [2, 3, 1, 10, 1, 0.5, 2]
+
+    fused = wbf.fuse_detections(np.array([d3, d1, d4, d2]), 2)
+
+    self.assertAllClose(fused, [[1, 2.5, 1, 10, 1, 0.75, 1],
+                                [2, 3, 1, 10, 1, 0.5, 1],
+                                [2, 3, 1, 10, 1, 0.25, 2]])
+
+  def test_fuse_batch_views_score_order(self):
+    # The low scoring box of view 0 only overlaps the fused high scoring boxes
+    # of view 1 when it seeds the cluster.
+    boxes = np.array([[[0, 0, 10, 10], [0, 0, 0, 0]],
+                      [[0, 2, 10, 12], [0, 4, 10, 14]]], np.float32)
+    scores = np.array([[0.2, 0], [0.9, 0.8]], np.float32)
+    classes = np.ones([2, 2], np.float32)
+
+    out_boxes, out_scores, out_classes, valid_lens = wbf.fuse_batch_views(
+        boxes, scores, classes, np.array([1, 2]), 2, 3)
+
+    self.assertAllEqual(valid_lens, [2])
+    self.assertAllClose(out_scores, [[0.85, 0.1, 0]])
+    self.assertAllClose(out_boxes[0, 1], [0, 0, 10, 10])
+    self.assertAllEqual(out_classes, [[1, 1, 0]])
+
 
 if __name__ == '__main__':
   logging.set_verbosity(logging.WARNING)
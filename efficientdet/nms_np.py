@@ -13,6 +13,9 @@
 # limitations under the License.
 # ==============================================================================
 """Anchor definition."""
+import concurrent.futures
+import threading
+
 import numpy as np
 
 # The minimum score to consider a logit for identifying detections.
@@ -24,6 +27,13 @@ _DUMMY_DETECTION_SCORE = -1e5
 # The maximum number of (anchor,class) pairs to keep for non-max suppression.
 MAX_DETECTION_POINTS = 5000
 
+# The number of boxes whose pairwise IOU is computed at once in batched nms.
+_NMS_BLOCK_SIZE = 512
+
+# Persistent worker pools for batch_per_class_nms, keyed by number of workers.
+_NMS_POOLS = {}
+_NMS_POOLS_LOCK = threading.Lock()
+
 
 def diou_nms(dets, iou_thresh=None):
   """DIOU non-maximum suppression.
@@ -217,9 +227,247 @@ def nms(dets, nms_configs):
   raise ValueError('Unknown NMS method: {}'.format(method))
 
 
+def _pairwise_iou(boxes1, boxes2):
+  """IOU matrix between boxes with shape (n, 4) and (m, 4)."""
+  areas1 = (boxes1[:, 2] - boxes1[:, 0] + 1) * (boxes1[:, 3] - boxes1[:, 1] + 1)
+  areas2 = (boxes2[:, 2] - boxes2[:, 0] + 1) * (boxes2[:, 3] - boxes2[:, 1] + 1)
+  xx1 = np.maximum(boxes1[:, None, 0], boxes2[None, :, 0])
+  yy1 = np.maximum(boxes1[:, None, 1], boxes2[None, :, 1])
+  xx2 = np.minimum(boxes1[:, None, 2], boxes2[None, :, 2])
+  yy2 = np.minimum(boxes1[:, None, 3], boxes2[None, :, 3])
+
+  w = np.maximum(0.0, xx2 - xx1 + 1)
+  h = np.maximum(0.0, yy2 - yy1 + 1)
+  intersection = w * h
+  return intersection / (areas1[:, None] + areas2[None, :] - intersection)
+
+
+def _pairwise_diou(boxes1, boxes2):
+  """DIOU matrix between boxes with shape (n, 4) and (m, 4)."""
+  iou = _pairwise_iou(boxes1, boxes2)
+  enclosing_x1 = np.minimum(boxes1[:, None, 0], boxes2[None, :, 0])
+  enclosing_y1 = np.minimum(boxes1[:, None, 1], boxes2[None, :, 1])
+  enclosing_x2 = np.maximum(boxes1[:, None, 2], boxes2[None, :, 2])
+  enclosing_y2 = np.maximum(boxes1[:, None, 3], boxes2[None, :, 3])
+  square_of_the_diagonal = ((enclosing_x2 - enclosing_x1)**2 +
+                            (enclosing_y2 - enclosing_y1)**2)
+
+  center_x1 = (boxes1[:, 0] + boxes1[:, 2]) / 2
+  center_y1 = (boxes1[:, 1] + boxes1[:, 3]) / 2
+  center_x2 = (boxes2[:, 0] + boxes2[:, 2]) / 2
+  center_y2 = (boxes2[:, 1] + boxes2[:, 3]) / 2
+  square_of_center_distance = ((center_x1[:, None] - center_x2[None, :])**2 +
+                               (center_y1[:, None] - center_y2[None, :])**2)
+  # Add 1e-10 for numerical stability.
+  return iou - square_of_center_distance / (square_of_the_diagonal + 1e-10)
+
+
+def _batched_greedy_nms(boxes, scores, overlap_fn, iou_thresh,
+                        max_output_size):
+  """Greedy (hard or DIOU) nms over blocks of boxes sorted by score."""
+  order = np.argsort(-scores, kind='stable')
+  keep = np.empty(max_output_size, dtype=np.int64)
+  kept_boxes = np.empty((max_output_size, 4), dtype=boxes.dtype)
+  num_kept = 0
+  for start in range(0, order.size, _NMS_BLOCK_SIZE):
+    if num_kept >= max_output_size:
+      break
+    block = order[start:start + _NMS_BLOCK_SIZE]
+    block_boxes = boxes[block]
+    if num_kept:
+      # Drop boxes suppressed by any box kept from the previous blocks.
+      overlap = overlap_fn(block_boxes, kept_boxes[:num_kept])
+      alive = np.all(overlap <= iou_thresh, axis=1)
+      block, block_boxes = block[alive], block_boxes[alive]
+
+    # Within the block, box j is suppressed by any kept box i < j. Iterating
+    # the suppression to its fixed point gives the greedy result, and it takes
+    # only a few iterations in practice.
+    suppressed = np.triu(~(overlap_fn(block_boxes, block_boxes) <= iou_thresh),
+                         1)
+    alive = np.ones(block.size, dtype=bool)
+    while True:
+      new_alive = ~np.any(suppressed[alive], axis=0)
+      if np.array_equal(new_alive, alive):
+        break
+      alive = new_alive
+
+    block = block[alive][:max_output_size - num_kept]
+    keep[num_kept:num_kept + block.size] = block
+    kept_boxes[num_kept:num_kept + block.size] = boxes[block]
+    num_kept += block.size
+
+  keep = keep[:num_kept]
+  return keep, scores[keep]
+
+
+def _batched_soft_nms(boxes, scores, classes, nms_configs, max_output_size):
+  """Soft nms that updates the scores of all classes in place."""
+  method = nms_configs['method']
+  # Default sigma and iou_thresh are from the original soft-nms paper.
+  sigma = nms_configs['sigma'] or 0.5
+  iou_thresh = nms_configs['iou_thresh'] or 0.3
+  score_thresh = nms_configs['score_thresh'] or 0.001
+
+  # Like `soft_nms`, the top box of each class is retained even if its score
+  # is below score_thresh.
+  protected = np.zeros(scores.size, dtype=bool)
+  if scores.size:
+    order = np.lexsort((-scores, classes))
+    first = np.ones(order.size, dtype=bool)
+    first[1:] = classes[order[1:]] != classes[order[:-1]]
+    protected[order[first]] = True
+  alive = protected | (scores >= score_thresh)
+  scores[~alive] = -np.inf
+
+  keep = np.empty(max_output_size, dtype=np.int64)
+  keep_scores = np.empty(max_output_size, dtype=scores.dtype)
+  num_kept = 0
+  # The selected scores never increase, so the first max_output_size selected
+  # boxes are also the top scoring ones.
+  while num_kept < max_output_size:
+    i = np.argmax(scores)
+    if not alive[i]:
+      break
+    keep[num_kept] = i
+    keep_scores[num_kept] = scores[i]
+    num_kept += 1
+    alive[i] = False
+    scores[i] = -np.inf
+
+    iou = _pairwise_iou(boxes[i:i + 1], boxes)[0]
+    if method == 'linear':
+      weight = np.where(iou > iou_thresh, 1 - iou, 1.0)
+    else:
+      weight = np.exp(-(iou * iou) / sigma)
+    np.multiply(scores, weight, out=scores, where=alive)
+    dropped = alive & ~protected & ~(scores >= score_thresh)
+    alive[dropped] = False
+    scores[dropped] = -np.inf
+
+  return keep[:num_kept], keep_scores[:num_kept]
+
+
+def batched_nms(dets, classes, nms_configs, max_output_size):
+  """Non-maximum suppression for all classes at once.
+
+  Boxes are shifted by an offset proportional to their class, so that boxes
+  of different classes never overlap and a single suppression pass handles
+  all classes. Since retained scores never increase, the pass stops as soon
+  as max_output_size boxes are retained.
+
+  Args:
+    dets: detection with shape (num, 5) and format [x1, y1, x2, y2, score].
+    classes: detection classes with shape (num,).
+    nms_configs: a dict config that may contain parameters.
+    max_output_size: the maximum number of retained boxes.
+
+  Returns:
+    A tuple (indices, scores) of retained boxes sorted by descending scores,
+    where scores are the retained scores (decayed scores for soft nms).
+  """
+  nms_configs = nms_configs or {}
+  method = nms_configs['method']
+
+  boxes = dets[:, :4].astype(np.float64)
+  scores = dets[:, 4].astype(np.float64)
+  if boxes.size:
+    offset = boxes.max() - boxes.min() + 2
+    boxes += (classes.astype(np.float64) * offset)[:, None]
+
+  if method == 'hard' or not method:
+    return _batched_greedy_nms(boxes, scores, _pairwise_iou,
+                               nms_configs['iou_thresh'] or 0.5,
+                               max_output_size)
+
+  if method == 'diou':
+    return _batched_greedy_nms(boxes, scores, _pairwise_diou,
+                               nms_configs['iou_thresh'] or 0.5,
+                               max_output_size)
+
+  if method in ('linear', 'gaussian'):
+    return _batched_soft_nms(boxes, scores, classes, nms_configs,
+                             max_output_size)
+
+  raise ValueError('Unknown NMS method: {}'.format(method))
+
+
 def per_class_nms(boxes, scores, classes, image_id, image_scale, num_classes,
                   max_boxes_to_draw, nms_configs):
-  """Perform per class nms."""
+  """Perform per class nms for all classes at once with `batched_nms`."""
+  boxes = boxes[:, [1, 0, 3, 2]]
+  indices = np.where((classes >= 0) & (classes < num_classes))[0]
+  dets = np.column_stack((boxes[indices, :], scores[indices]))
+  classes = classes[indices]
+  keep, keep_scores = batched_nms(dets, classes, nms_configs,
+                                  max_boxes_to_draw)
+
+  # Dummy detections fill up to max_boxes_to_draw detections.
+  detections = np.zeros((max_boxes_to_draw, 7), dtype=np.float32)
+  detections[:, 0] = image_id[0]
+  detections[:, 5] = _DUMMY_DETECTION_SCORE
+  num_kept = keep.shape[0]
+  detections[:num_kept, 1:5] = dets[keep, :4]
+  detections[:num_kept, 5] = keep_scores
+  detections[:num_kept, 6] = classes[keep] + 1
+
+  detections[:, 1:5] *= image_scale
+
+  return detections
+
+
+def _get_nms_pool(num_workers):
+  """Returns the persistent thread pool with num_workers workers."""
+  with _NMS_POOLS_LOCK:
+    if num_workers not in _NMS_POOLS:
+      _NMS_POOLS[num_workers] = concurrent.futures.ThreadPoolExecutor(
+          max_workers=num_workers, thread_name_prefix='nms_np')
+    return _NMS_POOLS[num_workers]
+
+
+def batch_per_class_nms(boxes, scores, classes, image_ids, image_scales,
+                        num_classes, max_boxes_to_draw, nms_configs):
+  """Perform per class nms for a batch of images in a worker pool.
+
+  Args:
+    boxes: boxes with shape (batch, num, 4) and format [y1, x1, y2, x2].
+    scores: scores with shape (batch, num).
+    classes: classes with shape (batch, num).
+    image_ids: image ids with shape (batch,).
+    image_scales: image scales with shape (batch,).
+    num_classes: the number of classes.
+    max_boxes_to_draw: the number of detections per image.
+    nms_configs: a dict config that may contain parameters. Images are
+      processed by a persistent pool of `pyfunc_workers` threads, or serially
+      if it is not positive.
+
+  Returns:
+    numpy.array: detections with shape (batch, max_boxes_to_draw, 7).
+  """
+  def single_image_nms(i):
+    return per_class_nms(boxes[i], scores[i], classes[i], image_ids[i:i + 1],
+                         image_scales[i:i + 1], num_classes, max_boxes_to_draw,
+                         nms_configs)
+
+  num_workers = nms_configs.get('pyfunc_workers', 0)
+  if num_workers and num_workers > 0:
+    detections = _get_nms_pool(num_workers).map(single_image_nms,
+                                                range(boxes.shape[0]))
+  else:
+    detections = map(single_image_nms, range(boxes.shape[0]))
+  detections = list(detections)
+  if not detections:
+    return np.zeros((0, max_boxes_to_draw, 7), dtype=np.float32)
+  return np.stack(detections)
+
+
+def per_class_nms_loop(boxes, scores, classes, image_id, image_scale,
+                       num_classes, max_boxes_to_draw, nms_configs):
+  """Perform per class nms with a python loop over classes.
+
+  This is the reference implementation of `per_class_nms`, which is kept for
+  equivalence tests and benchmarks.
+  """
   boxes = boxes[:, [1, 0, 3, 2]]
   detections = []
   for c in range(num_classes):
@@ -262,4 +510,3 @@ def per_class_nms(boxes, scores, classes, image_id, image_scale, num_classes,
   detections[:, 1:5] *= image_scale
 
   return detections
-
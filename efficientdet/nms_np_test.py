@@ -0,0 +1,161 @@
+# Copyright 2020 Google Research. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Tests for nms_np."""
+import time
+
+from absl import logging
+import numpy as np
+import tensorflow as tf
+
+import nms_np
+
+
+def _random_detections(num_boxes, num_classes, seed=0):
+  """Generates clustered boxes in [y1, x1, y2, x2], scores and classes."""
+  rng = np.random.RandomState(seed)
+  centers = rng.uniform(0, 512, size=(num_boxes // 20 + 1, 2))
+  yx = centers[rng.randint(len(centers), size=num_boxes)]
+  yx += rng.normal(0, 8, size=(num_boxes, 2))
+  hw = rng.uniform(16, 96, size=(num_boxes, 2))
+  boxes = np.concatenate([yx - hw / 2, yx + hw / 2], axis=1).astype(np.float32)
+  scores = rng.uniform(size=num_boxes).astype(np.float32)
+  classes = rng.randint(num_classes, size=num_boxes).astype(np.int32)
+  return boxes, scores, classes
+
+
+class NmsNpTest(tf.test.TestCase):
+  """Test batched nms against the per class loop."""
+
+  def setUp(self):
+    super().setUp()
+    self.nms_configs = {
+        'method': 'hard',
+        'iou_thresh': None,
+        'score_thresh': None,
+        'sigma': None,
+    }
+
+  def _assert_same_as_loop(self, num_boxes, num_classes, max_boxes_to_draw):
+    boxes, scores, classes = _random_detections(num_boxes, num_classes)
+    args = (boxes, scores, classes, np.array([7]), np.array([2.0]),
+            num_classes, max_boxes_to_draw, self.nms_configs)
+    expected = nms_np.per_class_nms_loop(*args)
+    detections = nms_np.per_class_nms(*args)
+    self.assertEqual(detections.shape, (max_boxes_to_draw, 7))
+    self.assertEqual(detections.dtype, np.float32)
+    self.assertAllClose(detections, expected, rtol=1e-5, atol=1e-4)
+
+  def test_hard_nms(self):
+    self._assert_same_as_loop(2000, 10, 100)
+
+  def test_diou_nms(self):
+    self.nms_configs['method'] = 'diou'
+    self._assert_same_as_loop(2000, 10, 100)
+
+  def test_linear_soft_nms(self):
+    self.nms_configs['method'] = 'linear'
+    self._assert_same_as_loop(2000, 10, 100)
+
+  def test_gaussian_soft_nms(self):
+    self.nms_configs['method'] = 'gaussian'
+    self.nms_configs['score_thresh'] = 0.3
+    self._assert_same_as_loop(2000, 10, 100)
+
+  def test_dummy_detections(self):
+    self._assert_same_as_loop(30, 90, 100)
+    self.nms_configs['method'] = 'gaussian'
+    self._assert_same_as_loop(30, 90, 100)
+
+  def test_no_detections(self):
+    boxes = np.zeros((0, 4), dtype=np.float32)
+    scores = np.zeros((0,), dtype=np.float32)
+    classes = np.zeros((0,), dtype=np.int32)
+    detections = nms_np.per_class_nms(boxes, scores, classes, np.array([3]),
+                                      np.array([1.0]), 90, 5, self.nms_configs)
+    self.assertAllEqual(detections[:, 0], [3] * 5)
+    self.assertAllEqual(detections[:, 5], [-1e5] * 5)
+
+  def test_classes_do_not_suppress_each_other(self):
+    dets = np.array([[0, 0, 10, 10, 0.9], [0, 0, 10, 10, 0.8],
+                     [0, 0, 10, 10, 0.7]], dtype=np.float32)
+    keep, scores = nms_np.batched_nms(dets, np.array([0, 0, 1]),
+                                      self.nms_configs, 10)
+    self.assertAllEqual(keep, [0, 2])
+    self.assertAllClose(scores, [0.9, 0.7])
+
+  def test_batch_per_class_nms(self):
+    boxes, scores, classes = _random_detections(3000, 10)
+    boxes, scores, classes = (boxes.reshape(3, 1000, 4),
+                              scores.reshape(3, 1000), classes.reshape(3, 1000))
+    image_ids = np.array([1, 2, 3])
+    image_scales = np.array([1.0, 2.0, 0.5], dtype=np.float32)
+    expected = np.stack([
+        nms_np.per_class_nms(boxes[i], scores[i], classes[i],
+                             image_ids[i:i + 1], image_scales[i:i + 1], 10, 50,
+                             self.nms_configs) for i in range(3)
+    ])
+    self.nms_configs['pyfunc_workers'] = 2
+    detections = nms_np.batch_per_class_nms(boxes, scores, classes, image_ids,
+                                            image_scales, 10, 50,
+                                            self.nms_configs)
+    self.assertAllEqual(detections, expected)
+
+
+class NmsNpBenchmark(tf.test.Benchmark):
+  """Benchmark batched nms against the per class loop.
+
+  Run with: python nms_np_test.py --benchmark_filter=.
+  """
+
+  def _benchmark(self, method, num_boxes=5000, num_classes=90, iters=5):
+    """Reports the wall time of both implementations."""
+    boxes, scores, classes = _random_detections(num_boxes, num_classes)
+    nms_configs = {
+        'method': method,
+        'iou_thresh': None,
+        'score_thresh': None,
+        'sigma': None,
+    }
+    args = (boxes, scores, classes, np.array([0]), np.array([1.0]),
+            num_classes, 100, nms_configs)
+    wall_times = {}
+    for fn in (nms_np.per_class_nms_loop, nms_np.per_class_nms):
+      start = time.perf_counter()
+      for _ in range(iters):
+        fn(*args)
+      wall_times[fn.__name__] = (time.perf_counter() - start) / iters
+    self.report_benchmark(
+        iters=iters,
+        wall_time=wall_times['per_class_nms'],
+        name='per_class_nms_{}'.format(method),
+        extras={
+            'loop_wall_time': wall_times['per_class_nms_loop'],
+            'speedup': (wall_times['per_class_nms_loop'] /
+                        wall_times['per_class_nms']),
+        })
+
+  def benchmark_hard_nms(self):
+    self._benchmark('hard')
+
+  def benchmark_diou_nms(self):
+    self._benchmark('diou')
+
+  def benchmark_gaussian_nms(self):
+    self._benchmark('gaussian')
+
+
+if __name__ == '__main__':
+  logging.set_verbosity(logging.WARNING)
+  tf.test.main()
@@ -133,28 +133,8 @@ class ArgMaxMatcher(matcher.Matcher):
 
       # Deal with matched and unmatched threshold
       if self._matched_threshold is not None:
-        # Get logical indices of ignored and unmatched columns as tf.int64
         matched_vals = tf.reduce_max(similarity_matrix, 0)
-        below_unmatched_threshold = tf.greater(self._unmatched_threshold,
-                                               matched_vals)
-        between_thresholds = tf.logical_and(
-            tf.greater_equal(matched_vals, self._unmatched_threshold),
-            tf.greater(self._matched_threshold, matched_vals))
-
-        if self._negatives_lower_than_unmatched:
-          matches = self._set_values_using_indicator(matches,
-                                                     below_unmatched_threshold,
-                                                     -1)
-          matches = self._set_values_using_indicator(matches,
-                                                     between_thresholds,
-                                                     -2)
-        else:
-          matches = self._set_values_using_indicator(matches,
-                                                     below_unmatched_threshold,
-                                                     -2)
-          matches = self._set_values_using_indicator(matches,
-                                                     between_thresholds,
-                                                     -1)
+        matches = self._apply_thresholds(matches, matched_vals)
 
       if self._force_match_for_each_row:
         similarity_matrix_shape = shape_utils.combined_static_and_dynamic_shape(
@@ -183,6 +163,103 @@ class ArgMaxMatcher(matcher.Matcher):
           tf.greater(tf.shape(similarity_matrix)[0], 0),
           _match_when_rows_are_non_empty, _match_when_rows_are_empty)
 
+  def _apply_thresholds(self, matches, matched_vals):
+    """Sets matches of columns below the matched threshold to -1 or -2.
+
+    Args:
+      matches: int32 tensor of shape [M] with the argmax row of each column.
+      matched_vals: float tensor of shape [M] with the max value of each column.
+
+    Returns:
+      The matches with unmatched and ignored columns set.
+    """
+    # Get logical indices of ignored and unmatched columns
+    below_unmatched_threshold = tf.greater(self._unmatched_threshold,
+                                           matched_vals)
+    between_thresholds = tf.logical_and(
+        tf.greater_equal(matched_vals, self._unmatched_threshold),
+        tf.greater(self._matched_threshold, matched_vals))
+
+    if self._negatives_lower_than_unmatched:
+      matches = self._set_values_using_indicator(matches,
+                                                 below_unmatched_threshold,
+                                                 -1)
+      matches = self._set_values_using_indicator(matches,
+                                                 between_thresholds,
+                                                 -2)
+    else:
+      matches = self._set_values_using_indicator(matches,
+                                                 below_unmatched_threshold,
+                                                 -2)
+      matches = self._set_values_using_indicator(matches,
+                                                 between_thresholds,
+                                                 -1)
+    return matches
+
+  def match_sparse(self, row_indices, column_indices, similarity, num_rows,
+                   num_columns, scope=None):
+    """Matches columns to rows given only the nonzero similarity entries.
+
+    Returns the same Match as match() on the dense [num_rows, num_columns]
+    matrix which is zero except for the given entries, without building it.
+    Similarity values must be non-negative. Ties are broken towards the
+    smallest index like tf.argmax.
+
+    Args:
+      row_indices: int32 tensor of shape [K] with the row of each entry.
+      column_indices: int32 tensor of shape [K] with the column of each entry.
+      similarity: float tensor of shape [K] with the value of each entry. Each
+        (row, column) pair must appear at most once.
+      num_rows: int32 scalar tensor, the number of rows.
+      num_columns: python int, the number of columns.
+      scope: Op scope name. Defaults to 'MatchSparse' if None.
+
+    Returns:
+      A Match object with the results of matching.
+    """
+    with tf.name_scope(scope, 'MatchSparse'):
+      similarity = tf.convert_to_tensor(similarity)
+      # Max value of each column; columns without entries are all zero.
+      matched_vals = tf.maximum(
+          tf.math.unsorted_segment_max(similarity, column_indices, num_columns),
+          0.)
+      is_column_max = tf.equal(similarity,
+                               tf.gather(matched_vals, column_indices))
+      num_rows = tf.cast(num_rows, tf.int32)
+      matches = tf.math.unsorted_segment_min(
+          tf.where(is_column_max, row_indices,
+                   tf.fill(tf.shape(row_indices), num_rows)), column_indices,
+          num_columns)
+      # Like tf.argmax, an all zero column matches the first row.
+      matches = tf.where(matched_vals > 0, matches, tf.zeros_like(matches))
+
+      if self._matched_threshold is not None:
+        matches = self._apply_thresholds(matches, matched_vals)
+
+      if self._force_match_for_each_row:
+        row_max_vals = tf.maximum(
+            tf.math.unsorted_segment_max(similarity, row_indices, num_rows),
+            0.)
+        is_row_max = tf.equal(similarity, tf.gather(row_max_vals, row_indices))
+        force_match_column_ids = tf.math.unsorted_segment_min(
+            tf.where(is_row_max, column_indices,
+                     tf.fill(tf.shape(column_indices), num_columns)),
+            row_indices, num_rows)
+        force_match_column_ids = tf.where(
+            row_max_vals > 0, force_match_column_ids,
+            tf.zeros_like(force_match_column_ids))
+        # The first row forcing a column wins, as in _match.
+        force_match_row_ids = tf.math.unsorted_segment_min(
+            tf.range(num_rows), force_match_column_ids, num_columns)
+        force_match_column_mask = tf.less(force_match_row_ids, num_rows)
+        matches = tf.where(force_match_column_mask, force_match_row_ids,
+                           matches)
+
+      # Without rows, all columns are unmatched.
+      matches = tf.where(
+          tf.greater(num_rows, 0), matches, -1 * tf.ones_like(matches))
+      return matcher.Match(matches)
+
   def _set_values_using_indicator(self, x, indicator, val):
     """Set the indicated fields of x to val.
 
@@ -86,6 +86,35 @@ def iou(boxlist1, boxlist2, scope=None):
         tf.zeros_like(intersections), tf.truediv(intersections, unions))
 
 
+def paired_iou(boxes1, boxes2, scope=None):
+  """Computes intersection-over-union between corresponding boxes.
+
+  The values are bitwise equal to the matching entries of iou.
+
+  Args:
+    boxes1: a float tensor with shape [K, 4].
+    boxes2: a float tensor with shape [K, 4].
+    scope: name scope.
+
+  Returns:
+    a tensor with shape [K] representing the iou of each pair of boxes.
+  """
+  with tf.name_scope(scope, 'PairedIOU'):
+    y_min1, x_min1, y_max1, x_max1 = tf.unstack(boxes1, axis=1)
+    y_min2, x_min2, y_max2, x_max2 = tf.unstack(boxes2, axis=1)
+    intersect_heights = tf.maximum(
+        0.0, tf.minimum(y_max1, y_max2) - tf.maximum(y_min1, y_min2))
+    intersect_widths = tf.maximum(
+        0.0, tf.minimum(x_max1, x_max2) - tf.maximum(x_min1, x_min2))
+    intersections = intersect_heights * intersect_widths
+    areas1 = (y_max1 - y_min1) * (x_max1 - x_min1)
+    areas2 = (y_max2 - y_min2) * (x_max2 - x_min2)
+    unions = areas1 + areas2 - intersections
+    return tf.where(
+        tf.equal(intersections, 0.0),
+        tf.zeros_like(intersections), tf.truediv(intersections, unions))
+
+
 class RegionSimilarityCalculator(object):
   """Abstract base class for region similarity calculator."""
   __metaclass__ = ABCMeta
@@ -123,6 +123,35 @@ class TargetAssigner(object):
     if not isinstance(groundtruth_boxes, box_list.BoxList):
       raise ValueError('groundtruth_boxes must be an BoxList')
 
+    match_quality_matrix = self._similarity_calc.compare(groundtruth_boxes,
+                                                         anchors)
+    match = self._matcher.match(match_quality_matrix, **params)
+    return self.assign_with_match(anchors, groundtruth_boxes, match,
+                                  groundtruth_labels, groundtruth_weights)
+
+  def assign_with_match(self, anchors, groundtruth_boxes, match,
+                        groundtruth_labels=None, groundtruth_weights=None):
+    """Assign targets to each anchor given an existing match.
+
+    This is the second half of assign, for callers that compute the match
+    without a dense similarity matrix.
+
+    Args:
+      anchors: a BoxList representing N anchors
+      groundtruth_boxes: a BoxList representing M groundtruth boxes
+      match: a matcher.Match object encoding the match between anchors and
+        groundtruth boxes.
+      groundtruth_labels:  a tensor of shape [M, d_1, ... d_k]
+        with labels for each of the ground_truth boxes. When set to None, all
+        ground_truth boxes get a positive label (of 1).
+      groundtruth_weights: a float tensor of shape [M] indicating the weight to
+        assign to all anchors match to a particular groundtruth box. If None,
+        all weights are set to 1.
+
+    Returns:
+      The same (cls_targets, cls_weights, reg_targets, reg_weights, match)
+      tuple as assign.
+    """
     if groundtruth_labels is None:
       groundtruth_labels = tf.ones(tf.expand_dims(groundtruth_boxes.num_boxes(),
                                                   0))
@@ -144,9 +173,6 @@ class TargetAssigner(object):
       groundtruth_weights = tf.ones([num_gt_boxes], dtype=tf.float32)
     with tf.control_dependencies(
         [unmatched_shape_assert, labels_and_box_shapes_assert]):
-      match_quality_matrix = self._similarity_calc.compare(groundtruth_boxes,
-                                                           anchors)
-      match = self._matcher.match(match_quality_matrix, **params)
       reg_targets = self._create_regression_targets(anchors,
                                                     groundtruth_boxes,
                                                     match)
@@ -30,8 +30,29 @@ def _get_source_id_from_encoded_image(parsed_tensors):
 class TfExampleDecoder(object):
   """Tensorflow Example proto decoder."""
 
-  def __init__(self, include_mask=False, regenerate_source_id=False):
+  def __init__(self,
+               include_mask=False,
+               regenerate_source_id=False,
+               include_anchor_targets=False,
+               output_size=None,
+               max_scale=1.0):
+    """Initializes the decoder.
+
+    Args:
+      include_mask: whether to decode instance masks.
+      regenerate_source_id: whether to hash the image as source id.
+      include_anchor_targets: whether to decode precomputed anchor targets.
+      output_size: if set, a (height, width) tuple the image is resized to
+        later. JPEG images are then decoded at the largest power of two
+        reduction, up to 8, that stays above this size scaled by max_scale,
+        and the reduction is returned as decode_ratio.
+      max_scale: the largest scale factor of output_size, such as the max
+        jitter of training.
+    """
     self._include_mask = include_mask
+    self._output_size = output_size
+    self._max_scale = max_scale
+    self._include_anchor_targets = include_anchor_targets
     self._regenerate_source_id = regenerate_source_id
     self._keys_to_features = {
         'image/encoded': tf.FixedLenFeature((), tf.string),
@@ -51,6 +72,19 @@ class TfExampleDecoder(object):
           'image/object/mask':
               tf.VarLenFeature(tf.string),
       })
+    if include_anchor_targets:
+      self._keys_to_features.update({
+          'image/anchor_targets/indices':
+              tf.VarLenFeature(tf.int64),
+          'image/anchor_targets/classes':
+              tf.VarLenFeature(tf.int64),
+          'image/anchor_targets/boxes':
+              tf.VarLenFeature(tf.float32),
+          'image/anchor_targets/num_positives':
+              tf.FixedLenFeature((), tf.float32),
+          'image/anchor_targets/num_anchors':
+              tf.FixedLenFeature((), tf.int64),
+      })
 
   def _decode_image(self, parsed_tensors):
     """Decodes the image and set its static shape."""
@@ -58,6 +92,46 @@ class TfExampleDecoder(object):
     image.set_shape([None, None, 3])
     return image
 
+  def _decode_reduced_image(self, parsed_tensors):
+    """Decodes a JPEG image at a reduced resolution.
+
+    Returns:
+      A tuple of the image, its [height, width, 3] shape before the
+      reduction, and the reduction ratio.
+    """
+    encoded = parsed_tensors['image/encoded']
+
+    def _decode_jpeg():
+      shape = tf.image.extract_jpeg_shape(encoded)
+      size = tf.cast(shape[:2], tf.float32)
+      output_scales = tf.constant(self._output_size, tf.float32) / size
+      scale = self._max_scale * tf.reduce_min(output_scales)
+      # log2 of the largest ratio keeping the image above the output size.
+      index = tf.cast(
+          tf.clip_by_value(
+              tf.floor(tf.math.log(1. / scale) / tf.math.log(2.)), 0, 3),
+          tf.int32)
+
+      def _decode_with_ratio(ratio):
+        return lambda: tf.io.decode_jpeg(encoded, channels=3, ratio=ratio)
+
+      image = tf.switch_case(index,
+                             [_decode_with_ratio(2**i) for i in range(4)])
+      # libjpeg rounds the reduced size up, so the ratio is not exactly
+      # 2**index. Use the ratio of the axis that limits the resize.
+      ratios = size / tf.cast(tf.shape(image)[:2], tf.float32)
+      return image, shape, tf.gather(ratios, tf.argmin(output_scales))
+
+    def _decode_other():
+      image = tf.io.decode_image(
+          encoded, channels=3, expand_animations=False)
+      return image, tf.shape(image), tf.constant(1.0)
+
+    image, shape, ratio = tf.cond(
+        tf.io.is_jpeg(encoded), _decode_jpeg, _decode_other)
+    image.set_shape([None, None, 3])
+    return image, shape, ratio
+
   def _decode_boxes(self, parsed_tensors):
     """Concat box coordinates in the format of [ymin, xmin, ymax, xmax]."""
     xmin = parsed_tensors['image/object/bbox/xmin']
@@ -102,6 +176,8 @@ class TfExampleDecoder(object):
     Returns:
       decoded_tensors: a dictionary of tensors with the following fields:
         - image: a uint8 tensor of shape [None, None, 3].
+        - decode_ratio: a float32 scalar tensor, the factor the image was
+            reduced by at decoding, if output_size is set.
         - source_id: a string scalar tensor.
         - height: an integer scalar tensor.
         - width: an integer scalar tensor.
@@ -112,6 +188,11 @@ class TfExampleDecoder(object):
         - groundtruth_instance_masks: a float32 tensor of shape
             [None, None, None].
         - groundtruth_instance_masks_png: a string tensor of shape [None].
+        - anchor_target_indices: a int64 tensor of shape [None].
+        - anchor_target_classes: a int64 tensor of shape [None].
+        - anchor_target_boxes: a float32 tensor of shape [None, 4].
+        - anchor_target_num_positives: a float32 scalar tensor.
+        - anchor_target_num_anchors: a int64 scalar tensor.
     """
     parsed_tensors = tf.io.parse_single_example(
         serialized_example, self._keys_to_features)
@@ -124,14 +205,19 @@ class TfExampleDecoder(object):
           parsed_tensors[k] = tf.sparse_tensor_to_dense(
               parsed_tensors[k], default_value=0)
 
-    image = self._decode_image(parsed_tensors)
+    if self._output_size:
+      image, image_shape, decode_ratio = self._decode_reduced_image(
+          parsed_tensors)
+    else:
+      image = self._decode_image(parsed_tensors)
+      image_shape = tf.shape(image)
     boxes = self._decode_boxes(parsed_tensors)
     areas = self._decode_areas(parsed_tensors)
 
     decode_image_shape = tf.logical_or(
         tf.equal(parsed_tensors['image/height'], -1),
         tf.equal(parsed_tensors['image/width'], -1))
-    image_shape = tf.cast(tf.shape(image), dtype=tf.int64)
+    image_shape = tf.cast(image_shape, dtype=tf.int64)
 
     parsed_tensors['image/height'] = tf.where(decode_image_shape,
                                               image_shape[0],
@@ -163,9 +249,24 @@ class TfExampleDecoder(object):
         'groundtruth_area': areas,
         'groundtruth_boxes': boxes,
     }
+    if self._output_size:
+      decoded_tensors['decode_ratio'] = decode_ratio
     if self._include_mask:
       decoded_tensors.update({
           'groundtruth_instance_masks': masks,
           'groundtruth_instance_masks_png': parsed_tensors['image/object/mask'],
       })
+    if self._include_anchor_targets:
+      decoded_tensors.update({
+          'anchor_target_indices':
+              parsed_tensors['image/anchor_targets/indices'],
+          'anchor_target_classes':
+              parsed_tensors['image/anchor_targets/classes'],
+          'anchor_target_boxes':
+              tf.reshape(parsed_tensors['image/anchor_targets/boxes'], [-1, 4]),
+          'anchor_target_num_positives':
+              parsed_tensors['image/anchor_targets/num_positives'],
+          'anchor_target_num_anchors':
+              parsed_tensors['image/anchor_targets/num_anchors'],
+      })
     return decoded_tensors
@@ -19,18 +19,18 @@ import tensorflow as tf
 from dataset import tfrecord_util
 
 
-def make_fake_tfrecord(temp_dir):
+def make_fake_tfrecord(temp_dir, height=512, width=512):
   """Makes fake TFRecord to test input."""
   tfrecord_path = os.path.join(temp_dir, 'test.tfrecords')
   writer = tf.io.TFRecordWriter(tfrecord_path)
-  encoded_jpg = tf.io.encode_jpeg(tf.ones([512, 512, 3], dtype=tf.uint8))
+  encoded_jpg = tf.io.encode_jpeg(tf.ones([height, width, 3], dtype=tf.uint8))
   example = tf.train.Example(
       features=tf.train.Features(
           feature={
               'image/height':
-                  tfrecord_util.int64_feature(512),
+                  tfrecord_util.int64_feature(height),
               'image/width':
-                  tfrecord_util.int64_feature(512),
+                  tfrecord_util.int64_feature(width),
               'image/filename':
                   tfrecord_util.bytes_feature('test_file_name.jpg'.encode(
                       'utf8')),